@@ -11,6 +11,11 @@ SSID = "SSID"
 BSSID = "BSSID"
 NEARBY_AP = "nearbyAP"
 RSSI = "level"
+# Batched monitor reports: {END_USER, SERVICE_NAME, BATCH_SENT, BATCH: [
+# {BATCH_TIME, ...report}]}, times in second of the end user clock
+BATCH = "batch"
+BATCH_SENT = "sent"
+BATCH_TIME = "time"
 CHANNEL_MODE = "ChannelMode"
 FREQUENCY = "frequency"
 
@@ -26,6 +31,8 @@ MONITOR_SERVER_ALL = "monitor/server/+"
 MONITOR_CONTAINER = "monitor/container"
 MONITOR_CONTAINER_ALL = "monitor/container/+"
 MONITOR_EU = "monitor/eu"
+# Codebook of the compact monitor/eu and monitor/service encoding
+MONITOR_CODEC = "codec/monitor"
 MONITOR_EU_ALL = "monitor/eu/+"
 MONITOR_SERVICE = 'monitor/service'
 MONITOR_SERVICE_ALL = 'monitor/service/+'
@@ -34,6 +41,7 @@ MIGRATE_REPORT_ALL = 'migrate_report/+/+'
 DISCOVER = "discover"
 DEPLOY = "deploy"
 PRE_MIGRATE = 'pre_migrate'
+PRE_STAGE = 'pre_stage'
 MIGRATE = 'migrate'
 PRE_MIGRATED = 'pre_migrated'
 PRE_MIGRATED_ALL = 'pre_migrated/+'
@@ -52,6 +60,10 @@ LWT_EDGE = "LWT/edge"
 LWT_EDGE_ALL = "LWT/edge/+"
 LWT_EU = "LWT/eu"
 LWT_EU_ALL = "LWT/eu/+"
+PROFILE_SQL = "profile/sql"
+PROFILE_SQL_REPORT = "profile/sql/report"
+PROFILE_DECODE = "profile/decode"
+PROFILE_DECODE_REPORT = "profile/decode/report"
 
 
 ASSOCIATED = "associated"
@@ -73,11 +85,15 @@ YOLO_MINI_DOCKER_IMAGE = "ngovanmao/yolov3-mini-cpu-amd64:01"
 SIMPLE_DOCKER_IMAGE = "gochit/simple_tcp_service:03"
 
 BETWEEN_EDGES_PORT = 5678
+MIGRATE_STREAM_PORT = 5679
+MIGRATE_CHANNEL_PORT = 5680
 BROKER_PORT        = 9999
 
 MIGRATE_METHOD = "migrate_method"
 NON_LIVE_MIGRATION = "non_live_migration"
 PRE_COPY = "pre_copy"
+# pre-copy whose final snapshot is diffed, sent and patched file by file
+PIPELINED_PRE_COPY = "pipelined_pre_copy"
 POST_COPY = "post_copy"
 
 RSSI_THRESHOLD = -76
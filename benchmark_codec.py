@@ -0,0 +1,113 @@
+"""Benchmarks the codecs of migrate_codec on checkpoint images.
+
+The files of `--folder`, such as the checkpoint folder of a service, are
+compressed in the blocks of the data channel with each codec. Without a
+folder, a pages-1.img of `--size` MiB is written where a `--zero` fraction
+of the pages is empty and half of the rest is text-like, as in the memory
+of a service. The time of a transfer over a `--bw` Mbps link is predicted
+like the CompressionPolicy does, with all the cores of this node.
+
+Example::
+
+    python benchmark_codec.py --folder /tmp/openface/checkpoint --bw 100
+"""
+from __future__ import division
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+from page_diff import PAGE_SIZE
+from migrate_channel import BLOCK_SIZE
+from migrate_codec import CODECS, Codec, decode, is_available
+
+def make_image(folder, size_mb, zero, seed=0):
+    rng = np.random.RandomState(seed)
+    n_pages = size_mb * (1 << 20) // PAGE_SIZE
+    pages = rng.randint(0, 256, (n_pages, PAGE_SIZE)).astype(np.uint8)
+    kinds = rng.random_sample(n_pages)
+    pages[kinds < zero] = 0
+    text = (kinds >= zero) & (kinds < zero + (1 - zero) / 2)
+    pages[text] = rng.randint(ord('a'), ord('i'), (text.sum(), PAGE_SIZE))
+    pages.tofile(os.path.join(folder, 'pages-1.img'))
+
+def read_blocks(folder):
+    blocks = []
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                while True:
+                    data = f.read(BLOCK_SIZE)
+                    if not data:
+                        break
+                    blocks.append(data)
+    return blocks
+
+def measure(codec, blocks, repeat):
+    """Returns the compressed size and the min compression time."""
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        payloads = [codec.compress(b) for b in blocks]
+        times.append(time.time() - start)
+    for data, payload in zip(blocks, payloads):
+        if decode(payload) != data:
+            raise RuntimeError("{} does not round trip".format(codec))
+    return sum(len(p) for p in payloads), min(times)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--folder',
+        help="Checkpoint folder, a synthetic image by default.",
+        default=None)
+    parser.add_argument(
+        '--size',
+        type=int,
+        help="Size of the synthetic image in MiB.",
+        default=128)
+    parser.add_argument(
+        '--zero',
+        type=float,
+        help="Fraction of empty pages of the synthetic image.",
+        default=0.3)
+    parser.add_argument(
+        '--bw',
+        type=float,
+        help="BW of the link in Mbps.",
+        default=100)
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        help="Number of compressions per codec.",
+        default=3)
+    args = parser.parse_args()
+    folder = args.folder
+    if folder is None:
+        folder = tempfile.mkdtemp(prefix='benchmark_codec_')
+        make_image(folder, args.size, args.zero)
+    try:
+        blocks = read_blocks(folder)
+        size = sum(len(b) for b in blocks)
+        cores = multiprocessing.cpu_count()
+        rate = args.bw * 1e6 / 8
+        print("{} bytes, {} cores, {} Mbps".format(size, cores, args.bw))
+        print("{:<10}{:>8}{:>12}{:>14}".format('codec', 'ratio', 'MB/s',
+                                               'transfer[s]'))
+        for spec in CODECS:
+            if not is_available(spec):
+                print("{:<10}not installed".format(spec))
+                continue
+            size_out, seconds = measure(Codec(spec), blocks, args.repeat)
+            speed = size / max(seconds, 1e-9)
+            transfer = max(size / (speed * cores), size_out / rate)
+            print("{:<10}{:>8.3f}{:>12.1f}{:>14.3f}".format(spec,
+                size_out / max(size, 1), speed / 1e6, transfer))
+    finally:
+        if args.folder is None:
+            shutil.rmtree(folder, ignore_errors=True)
@@ -0,0 +1,136 @@
+"""Benchmarks the page differ against xdelta on CRIU-like memory images.
+
+A pages-1.img of `--size` MiB of random pages is written, then a copy where
+a `--dirty` fraction of the pages, in runs of `--run` pages, is rewritten,
+like the dump of a service between two checkpoints. Both are diffed and
+patched with the page differ and with xdelta (when it is installed), and
+the rebuilt image is checked. The ``indexed`` row is the page differ when
+the old image is in the page index, as in the later pre-copy rounds.
+
+Without xdelta only the page differ is timed, and the comparison is still
+to be run.
+
+Example::
+
+    python benchmark_diff.py --size 512 --dirty 0.05 --repeat 3
+"""
+from __future__ import division
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+import page_diff
+from page_diff import PAGE_SIZE
+from diff_patch import page_delta, page_patch, xdelta_delta, xdelta_patch
+
+FILENAME = 'pages-1.img'
+
+def has_xdelta():
+    try:
+        subprocess.call(['xdelta', 'help'], stdout=open(os.devnull, 'w'),
+                        stderr=subprocess.STDOUT)
+    except OSError:
+        return False
+    return True
+
+def make_images(folder, size_mb, dirty, run=8, seed=0):
+    """Writes old/ and new/ images, returns the folders with a trailing /."""
+    rng = np.random.RandomState(seed)
+    n_pages = size_mb * (1 << 20) // PAGE_SIZE
+    old = rng.randint(0, 256, n_pages*PAGE_SIZE).astype(np.uint8)
+    new = old.copy().reshape(n_pages, PAGE_SIZE)
+    n_runs = max(int(n_pages * dirty / run), 1)
+    for start in rng.randint(0, n_pages - run, n_runs):
+        new[start:start + run] = rng.randint(0, 256, (run, PAGE_SIZE))
+    folders = []
+    for name, data in [('old', old), ('new', new)]:
+        path = os.path.join(folder, name) + '/'
+        os.mkdir(path)
+        data.tofile(path + FILENAME)
+        folders.append(path)
+    return folders
+
+def measure(delta, patch, old, new, folder, repeat):
+    """Times `repeat` diffs and patches.
+
+    Returns:
+        dict: min diff and patch times in second, patch size in byte.
+    """
+    patch_dir = os.path.join(folder, 'patch') + '/'
+    out_dir = os.path.join(folder, 'out') + '/'
+    diff_times = []
+    patch_times = []
+    for _ in range(repeat):
+        for path in [patch_dir, out_dir]:
+            shutil.rmtree(path, ignore_errors=True)
+            os.mkdir(path)
+        start = time.time()
+        delta(old, new, patch_dir, FILENAME, False)
+        diff_times.append(time.time() - start)
+        start = time.time()
+        patch(old, out_dir, patch_dir, FILENAME, False)
+        patch_times.append(time.time() - start)
+    with open(new + FILENAME, 'rb') as f_new, \
+            open(out_dir + FILENAME, 'rb') as f_out:
+        if f_new.read() != f_out.read():
+            raise RuntimeError("Patched image differs from the new image")
+    return {'diff': min(diff_times), 'patch': min(patch_times),
+            'size': os.path.getsize(patch_dir + FILENAME)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--size',
+        type=int,
+        help="Size of the memory image in MiB.",
+        default=256)
+    parser.add_argument(
+        '--dirty',
+        type=float,
+        help="Fraction of dirty pages.",
+        default=0.05)
+    parser.add_argument(
+        '--run',
+        type=int,
+        help="Number of consecutive pages of a dirty region.",
+        default=8)
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        help="Number of diffs and patches per differ.",
+        default=3)
+    args = parser.parse_args()
+    folder = tempfile.mkdtemp(prefix='benchmark_diff_')
+    try:
+        old, new = make_images(folder, args.size, args.dirty, args.run)
+        differs = [('page', page_delta, page_patch),
+                   ('indexed', page_delta, page_patch)]
+        if has_xdelta():
+            differs.append(('xdelta', xdelta_delta, xdelta_patch))
+        else:
+            print("xdelta is not installed, only the page differ is run")
+        print("{:<10}{:>10}{:>10}{:>14}".format('differ', 'diff[s]',
+                                                'patch[s]', 'patch[B]'))
+        results = {}
+        for name, delta, patch in differs:
+            if name == 'indexed':
+                page_diff.diff_file(new + FILENAME, old + FILENAME,
+                                    os.path.join(folder, 'index'),
+                                    index=page_diff.INDEX)
+            results[name] = measure(delta, patch, old, new, folder,
+                                    args.repeat)
+            print("{:<10}{:>10.3f}{:>10.3f}{:>14}".format(name,
+                results[name]['diff'], results[name]['patch'],
+                results[name]['size']))
+        if 'xdelta' in results:
+            print("speed up diff: {:.1f}x, patch: {:.1f}x".format(
+                results['xdelta']['diff'] / results['page']['diff'],
+                results['xdelta']['patch'] / results['page']['patch']))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
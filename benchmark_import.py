@@ -0,0 +1,70 @@
+"""Benchmarks the start up (import) time of the controllers.
+
+Each module is imported in a fresh interpreter, so that the result includes
+its whole dependency tree, and the heavy optional libraries that were pulled
+in by the import are reported.
+
+Example::
+
+    python benchmark_import.py --repeat 5 centralized_controller planner
+"""
+from __future__ import division
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+#: Libraries that should only be imported when they are used
+HEAVY_MODULES = ['sympy', 'sklearn', 'pulp', 'pandas', 'matplotlib',
+                 'sqlalchemy_utils']
+DEFAULT_MODULES = ['centralized_controller', 'central_database',
+                   'estimator', 'optimization_planner', 'edge_controller']
+
+SCRIPT = """
+import sys, time, json
+start = time.time()
+import {module}
+elapsed = time.time() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{'time': elapsed, 'heavy': heavy}}))
+"""
+
+def measure_import(module, repeat=3, python=sys.executable):
+    """Imports `module` `repeat` times, each in a new interpreter.
+
+    Returns:
+        dict: 'times' (list, in second) and 'heavy' (heavy modules loaded).
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    script = SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    times = []
+    heavy = []
+    for _ in range(repeat):
+        output = subprocess.check_output([python, '-c', script], cwd=cwd)
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        times.append(result['time'])
+        heavy = result['heavy']
+    return {'times': times, 'heavy': heavy}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'modules',
+        help="Modules to import, default: {}".format(
+            ', '.join(DEFAULT_MODULES)),
+        nargs='*')
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        help="Number of imports per module.",
+        default=3)
+    args = parser.parse_args()
+    print("{:<28}{:>10}{:>10}  {}".format('module', 'min[s]', 'max[s]',
+                                          'heavy modules'))
+    for module in args.modules or DEFAULT_MODULES:
+        result = measure_import(module, args.repeat)
+        print("{:<28}{:>10.3f}{:>10.3f}  {}".format(module,
+            min(result['times']), max(result['times']),
+            ', '.join(result['heavy'])))
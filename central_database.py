@@ -3,35 +3,55 @@ from __future__ import division
 import re
 import os
 import time
+import sqlite3
 import logging
+import threading
 import traceback
 import contextlib
+import collections
 
 import Constants
 
 import yaml
 import sqlalchemy
-from sqlalchemy_utils import force_instant_defaults
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship, Session
+from sqlalchemy.pool import QueuePool, StaticPool
 from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey
 import numpy as np
-from sklearn.linear_model import LinearRegression, Ridge
-from sklearn.preprocessing import  PolynomialFeatures
-from sklearn.pipeline import Pipeline
 
 from utilities import get_hostname, get_time, find_velocity
 import communication_models as comm
+from network_matrix import NetworkMatrix
+from sql_profiler import SQLProfiler
 from communication_models import log_rssi_model_real as path_loss
 import estimator
 
 RSSI_LIMIT = -100
+#: RSSI samples per user and BTS kept in memory for warm restarts, as many
+#: as update_rssi_monitor uses to fit the RSSI predictor
+RSSI_HISTORY_SIZE = 10
+#: Monitor tables of which a snapshot only copies the recent rows
+SNAPSHOT_HISTORY_TABLES = ('network_monitor', 'rssi_monitor', 'user_service')
+#: Default age [s] of the oldest monitor rows copied to a snapshot
+SNAPSHOT_HISTORY = 600
 
 Base = declarative_base()
+
 # The default value of a column is only valid when it is inserted to the
-# database. This command makes the default value available when the object is
-# created.
-force_instant_defaults()
+# database. This listener makes the default value available when the object is
+# created, as sqlalchemy_utils.force_instant_defaults, which takes longer to
+# import than sqlalchemy.
+@event.listens_for(Base, 'init', propagate=True)
+def set_instant_defaults(target, args, kwargs):
+    for key, column in sqlalchemy.inspect(target.__class__).columns.items():
+        if getattr(column, 'default', None) is None:
+            continue
+        if callable(column.default.arg):
+            setattr(target, key, column.default.arg(target))
+        else:
+            setattr(target, key, column.default.arg)
 
 def get_exp_moving_average(rssi, RSSI):
     alpha = 0.5 # 2/(N+1) = 2/(4+1), consider upto last 4 rssis
@@ -44,6 +64,8 @@ def get_exp_moving_average(rssi, RSSI):
         return alpha * rssi + (1-alpha) * RSSI
 
 def build_linear_regression(ts, RSSIs):
+    # sklearn is imported here since it is slow to import at start up
+    from sklearn.linear_model import LinearRegression
     X = np.asarray(ts)
     X = X.reshape(len(X), 1)
     y = np.asarray(RSSIs)
@@ -70,6 +92,9 @@ def build_log_regression(ts, RSSIs, n=3, A=-30, t_offset=0):
     # logging.debug("Transform input from {} to {}".format(y, y_transform))
     if len(X) < 2:
         return None, None
+    from sklearn.linear_model import Ridge
+    from sklearn.preprocessing import PolynomialFeatures
+    from sklearn.pipeline import Pipeline
     model = Pipeline([('poly', PolynomialFeatures(2)),
                       ('linear', Ridge(alpha=2))])
     result = model.fit(X, y_transform.reshape(len(y),1))
@@ -243,6 +268,14 @@ class MigrateRecord(Base):
     size_pre_rsync = Column(Integer) # in byte
     size_rsync = Column(Integer) # in byte
     size_final_rsync = Column(Integer) # in byte
+    rounds = Column(Integer) # pre-copy rounds
+    predicted_downtime = Column(Float) # in second
+    downtime = Column(Float) # in second
+    codec = Column(String) # codec of the final transfer
+    size_sent = Column(Integer) # in byte, on the wire
+    dedup_hit_ratio = Column(Float) # pages of the pre-dump held by the dest
+    queue_wait = Column(Float) # in second, for a slot of the link
+    dest_queue_wait = Column(Float) # in second, at the destination
 
     src_server = relationship('EdgeServerInfo',
                               foreign_keys='MigrateRecord.source')
@@ -298,6 +331,10 @@ class RSSIMonitor(Base):
             format(self.timestamp, self.user_id, self.bts, self.rssi,
             self.erssi, self.eta1, self.eta0)
 
+#: RSSIMonitor columns of the in-memory RSSI history
+RSSI_HISTORY_COLUMNS = ('timestamp', 'x', 'y', 'rssi', 'erssi', 'eta2', 'eta1',
+                        'eta0')
+
 class EstimateTime(object):
     def __init__(self, end_user):
         self.end_user = end_user
@@ -350,47 +387,352 @@ class EstimateTime(object):
         else:
             return None
 
+class LockStats(object):
+    """Contention counters of the writer lock and the reader pool."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.write_acquired = 0
+        self.write_contended = 0
+        self.write_wait = 0.0 # in second
+        self.write_wait_max = 0.0 # in second
+        self.read_sessions = 0
+        self.read_active = 0
+        self.read_active_max = 0
+
+    def add_write(self, wait, contended):
+        with self.lock:
+            self.write_acquired += 1
+            self.write_wait += wait
+            self.write_wait_max = max(self.write_wait_max, wait)
+            if contended:
+                self.write_contended += 1
+
+    def add_reader(self, delta):
+        with self.lock:
+            if delta > 0:
+                self.read_sessions += 1
+            self.read_active += delta
+            self.read_active_max = max(self.read_active_max, self.read_active)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'write_acquired': self.write_acquired,
+                'write_contended': self.write_contended,
+                'write_wait': self.write_wait,
+                'write_wait_max': self.write_wait_max,
+                'read_sessions': self.read_sessions,
+                'read_active': self.read_active,
+                'read_active_max': self.read_active_max}
+
+class WriterSession(Session):
+    """Session of the dedicated writer.
+
+    Flushes and commits are serialized by a lock shared with the owning
+    DBCentral, so two threads do not use the connection at once. The objects
+    added or changed by a thread are still pending in the shared session
+    until a commit, so a thread writes inside DBCentral.unit_of_work().
+    """
+    def __init__(self, *args, **kwargs):
+        self.write_lock = kwargs.pop('write_lock')
+        self.lock_stats = kwargs.pop('lock_stats')
+        super(WriterSession, self).__init__(*args, **kwargs)
+
+    @contextlib.contextmanager
+    def writing(self):
+        start = time.time()
+        contended = not self.write_lock.acquire(False)
+        if contended:
+            self.write_lock.acquire()
+        self.lock_stats.add_write(time.time() - start, contended)
+        try:
+            yield
+        finally:
+            self.write_lock.release()
+
+    def flush(self, objects=None):
+        if not (self.new or self.dirty or self.deleted):
+            return super(WriterSession, self).flush(objects)
+        with self.writing():
+            super(WriterSession, self).flush(objects)
+
+    def commit(self):
+        with self.writing():
+            super(WriterSession, self).commit()
+
+class TopologyCache(object):
+    """Identity map of BTSs, edge servers and their associations.
+
+    The topology only changes when a BTS or a server is registered or
+    removed, while it is read for every monitor message. Entries, including
+    unknown names, are kept until invalidate() is called by those writers.
+    The cached BTSs and servers are instances of the writer session, which
+    does not expire them on commit, so a hit does not reload them.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.defaultdict(dict)
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.generation = 0
+
+    def get(self, kind, key, loader):
+        with self.lock:
+            entries = self.entries[kind]
+            if key in entries:
+                self.hits[kind] += 1
+                return entries[key]
+            self.misses[kind] += 1
+            generation = self.generation
+        value = loader()
+        with self.lock:
+            # Do not store a value loaded before an invalidation
+            if generation == self.generation:
+                self.entries[kind][key] = value
+        return value
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = {}
+            for kind in set(self.hits) | set(self.misses):
+                total = self.hits[kind] + self.misses[kind]
+                stats[kind] = {'hits': self.hits[kind],
+                               'misses': self.misses[kind],
+                               'hit_rate': self.hits[kind]/total}
+            stats['invalidations'] = self.generation
+            return stats
+
+def set_sqlite_wal(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
+
+def set_sqlite_reader(dbapi_connection, connection_record):
+    # Disable pysqlite's own transaction handling, so that BEGIN is emitted by
+    # the begin event below and a read session sees one snapshot.
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only=ON')
+    cursor.close()
+
+def begin_sqlite_reader(conn):
+    conn.execute('BEGIN')
+
+def copy_to_memory(reader, since=None, history=()):
+    """Copies the database of a read session into a new in-memory connection.
+
+    The tables are read in the single transaction of `reader`, which gives a
+    consistent snapshot of the committed data. The `history` tables are only
+    copied from the timestamp `since` on.
+
+    Returns:
+        sqlite3.Connection: connection to the in-memory copy.
+    """
+    dst = sqlite3.connect(':memory:', check_same_thread=False)
+    schema = reader.execute("SELECT type, name, sql FROM sqlite_master "
+        "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+        "ORDER BY type DESC").fetchall()
+    for obj_type, name, sql in schema:
+        dst.execute(sql)
+        if obj_type != 'table':
+            continue
+        if since is not None and name in history:
+            rows = reader.execute(sqlalchemy.text('SELECT * FROM "{}" '
+                'WHERE timestamp >= :since'.format(name)), {'since': since})
+        else:
+            rows = reader.execute('SELECT * FROM "{}"'.format(name))
+        insert = 'INSERT INTO "{}" VALUES ({})'.format(name,
+            ', '.join('?'*len(rows.keys())))
+        while True:
+            batch = rows.fetchmany(1000)
+            if not batch:
+                break
+            dst.executemany(insert, [tuple(row) for row in batch])
+    dst.commit()
+    return dst
+
 class DBCentral(object):
     def __init__(self, **kwargs):
         database = kwargs.get('database', '{}central.db'.format(get_hostname()))
-        self.engine = sqlalchemy.create_engine('sqlite:///{}'.format(database))
+        self.database = database
+        url = 'sqlite:///{}'.format(database)
+        # The writer connection is shared by the MQTT and timer threads
+        self.engine = sqlalchemy.create_engine(url,
+            connect_args={'check_same_thread': False})
+        event.listen(self.engine, 'connect', set_sqlite_wal)
         if not os.path.exists(database):
             Base.metadata.create_all(self.engine)
         else:
             Base.metadata.bind = self.engine
-        self.DBSession = sessionmaker(bind=self.engine)
+        self.write_lock = threading.RLock()
+        self.lock_stats = LockStats()
+        # Only this session writes, its instances do not go stale on commit
+        self.DBSession = sessionmaker(bind=self.engine, class_=WriterSession,
+                                      expire_on_commit=False,
+                                      write_lock=self.write_lock,
+                                      lock_stats=self.lock_stats)
         self.session = self.DBSession()
+        # Pool of read-only connections, one scoped session per thread
+        self.read_engine = sqlalchemy.create_engine(url,
+            poolclass=QueuePool,
+            pool_size=kwargs.get('read_pool_size', 4),
+            max_overflow=0,
+            connect_args={'check_same_thread': False})
+        event.listen(self.read_engine, 'connect', set_sqlite_reader)
+        event.listen(self.read_engine, 'begin', begin_sqlite_reader)
+        self.ReadSession = scoped_session(sessionmaker(bind=self.read_engine,
+                                                       autoflush=False))
+        self.net_matrix = NetworkMatrix(window=kwargs.get('network_window', 10))
+        self.watch_network_commits()
+        self.snapshot_history = kwargs.get('snapshot_history',
+                                           SNAPSHOT_HISTORY)
+        self.topology = TopologyCache()
+        self.profiler = None
+        if kwargs.get('profile_sql', False):
+            self.profiler = SQLProfiler()
+            self.profiler.attach(self.engine)
+            self.profiler.attach(self.read_engine)
         self.est_time_users = {}
+        self.rssi_history = {}
         self.t0 = time.time()
 
+    @contextlib.contextmanager
+    def read_session(self):
+        """Yields a read-only session of the calling thread.
+
+        All queries inside the block see the same committed snapshot, writes
+        of the writer session committed meanwhile are not visible.
+        """
+        session = self.ReadSession()
+        self.lock_stats.add_reader(1)
+        try:
+            yield session
+        finally:
+            self.lock_stats.add_reader(-1)
+            session.rollback()
+            self.ReadSession.remove()
+
+    def get_lock_stats(self):
+        """Returns contention counters of the writer and the readers."""
+        return self.lock_stats.get_stats()
+
+    @contextlib.contextmanager
+    def unit_of_work(self):
+        """Holds the writer lock from the first change to the commit.
+
+        Another thread neither flushes nor commits the changes of the block
+        half done. The changes are committed at the end of the block, and
+        rolled back if the block raises.
+        """
+        with self.session.writing():
+            try:
+                yield self.session
+            except Exception:
+                self.session.rollback()
+                raise
+            self.session.commit()
+
+    @contextlib.contextmanager
+    def profile_scope(self, name):
+        """Groups the SQL profile of the block under `name`.
+
+        It does nothing unless the database was created with profile_sql.
+        """
+        if self.profiler is None:
+            yield
+        else:
+            with self.profiler.scope(name):
+                yield
+
+    def get_topology_stats(self):
+        """Returns hits, misses and hit rate of each topology lookup."""
+        return self.topology.get_stats()
+
     def insert_obj(self, obj):
         self.session.add(obj)
+        if isinstance(obj, (BTSInfo, EdgeServerInfo)):
+            self.topology.invalidate()
 
     def delete_obj(self, obj):
         if obj is not None:
             self.session.delete(obj)
+            if isinstance(obj, (BTSInfo, EdgeServerInfo)):
+                self.topology.invalidate()
 
     def delete_est_time(self, end_user):
         del(self.est_time_users[end_user])
 
+    def get_warm_state(self):
+        """Returns the in-memory state needed by a warm restart.
+
+        The state has the time offset of the RSSI predictors, the estimated
+        migration times and the latest RSSI samples of each user and BTS. It
+        only holds plain types, so it can be pickled from another thread.
+        """
+        est_times = {}
+        for user, est in dict(self.est_time_users).items():
+            est_times[user] = (dict(est.t_pre_mig), dict(est.t_mig),
+                               est.no_connect)
+        rssi_history = {key: list(samples) for key, samples in
+                        dict(self.rssi_history).items()}
+        return {'t0': self.t0,
+                'est_time_users': est_times,
+                'rssi_history': rssi_history}
+
+    def restore_warm_state(self, state):
+        """Restores a state returned by get_warm_state.
+
+        RSSI samples of a user and BTS are inserted back only if the
+        database has none, e.g. after the database file was rotated.
+        """
+        self.t0 = state['t0']
+        for user, (t_pre_mig, t_mig, no_connect) in \
+                state['est_time_users'].items():
+            est = EstimateTime(user)
+            est.t_pre_mig = t_pre_mig
+            est.t_mig = t_mig
+            est.no_connect = no_connect
+            self.est_time_users[user] = est
+        for (user, bts), samples in state['rssi_history'].items():
+            self.rssi_history[(user, bts)] = collections.deque(samples,
+                maxlen=RSSI_HISTORY_SIZE)
+            exists = self.session.query(RSSIMonitor.timestamp).\
+                filter(RSSIMonitor.user_id == user,
+                       RSSIMonitor.bts == bts).first()
+            if exists is not None:
+                continue
+            for sample in samples:
+                self.insert_obj(RSSIMonitor(user_id=user, bts=bts,
+                    **dict(zip(RSSI_HISTORY_COLUMNS, sample))))
+        self.session.commit()
+
     def close(self):
         self.session.commit()
         self.session.close()
+        self.ReadSession.remove()
+        self.read_engine.dispose()
 
     def clean_database(self):
         """
         A dangerous function, use it with your own risk.
         """
         self.session.commit()
-        with contextlib.closing(self.engine.connect()) as con:
+        with self.session.writing(), \
+                contextlib.closing(self.engine.connect()) as con:
             trans = con.begin()
             for table in reversed(Base.metadata.sorted_tables):
                 con.execute(table.delete())
             trans.commit()
+        self.topology.invalidate()
 
-    def query_bw(self, source, dest, size=10):
+    def query_bw(self, source, dest, size=10, default=0.001):
         """
-        Get average over size samples.
+        Get average over size samples, `default` if there is no sample.
         """
         results = self.session.query(NetworkRecord.bw).\
                   filter(NetworkRecord.src_node == source,
@@ -401,7 +743,7 @@ class DBCentral(object):
         logging.debug("Most recent BW from {} to {} [Mbps]: {}".\
                       format(source, dest, results_bw))
         if len(results_bw) == 0:
-            return 0.001 # 1kbps
+            return default
         else:
             return sum(results_bw)/len(results_bw)
 
@@ -511,8 +853,9 @@ class DBCentral(object):
             return None
 
     def get_server(self, server_name):
-        return self.session.query(EdgeServerInfo).\
-                    filter(EdgeServerInfo.name == server_name).first()
+        return self.topology.get('server', server_name,
+            lambda: self.session.query(EdgeServerInfo).\
+                    filter(EdgeServerInfo.name == server_name).first())
 
     def query_phi(self, server):
         server = self.get_server(server)
@@ -569,10 +912,77 @@ class DBCentral(object):
         return True
 
     def update_network_monitor(self, source, dest, latency, bandwidth):
+        """Adds a network record, the matrices see it once committed."""
+        self.load_network_matrix()
         obj = NetworkRecord(timestamp=get_time(),
                             src_node=source, dest_node=dest,
                             latency=latency, bw=bandwidth)
         self.insert_obj(obj)
+        self.net_pending.append((source, dest, latency, bandwidth))
+
+    def watch_network_commits(self):
+        """Applies the pending network records to the matrices when the
+        writer session commits them, drops them when it rolls back."""
+        self.net_pending = []
+        event.listen(self.session, 'after_commit', self.apply_network_records)
+        event.listen(self.session, 'after_rollback',
+                     self.discard_network_records)
+
+    def apply_network_records(self, session):
+        pending, self.net_pending = self.net_pending, []
+        for sample in pending:
+            self.net_matrix.update(*sample)
+
+    def discard_network_records(self, session):
+        self.net_pending = []
+
+    def load_network_matrix(self):
+        """Fills the network matrices with the last records of each link.
+
+        It runs once on a read session, later records come through
+        update_network_monitor once committed.
+        """
+        if self.net_matrix.loaded:
+            return
+        window = self.net_matrix.window
+        with self.read_session() as reader:
+            links = reader.query(NetworkRecord.src_node,
+                                 NetworkRecord.dest_node).distinct().all()
+            for source, dest in links:
+                results = reader.query(NetworkRecord.latency,
+                                       NetworkRecord.bw).\
+                          filter(NetworkRecord.src_node == source,
+                                 NetworkRecord.dest_node == dest).\
+                          order_by(sqlalchemy.desc(NetworkRecord.timestamp)).\
+                          limit(window).all()
+                for latency, bw in reversed(results):
+                    self.net_matrix.update(source, dest, latency, bw)
+        self.net_matrix.loaded = True
+
+    def get_network_matrices(self):
+        """Gets the mean BW [Mbps] and RTT [us] between edge nodes.
+
+        Returns:
+            tuple: (names, bw, rtt), see NetworkMatrix.get_matrices.
+        """
+        self.load_network_matrix()
+        return self.net_matrix.get_matrices()
+
+    def get_bts_network_matrices(self):
+        """Gets the mean BW [Mbps] and RTT [us] from BTSs to edge servers.
+
+        Returns:
+            tuple: (bts names, server names, bw, rtt), see
+            NetworkMatrix.get_bts_matrices.
+        """
+        self.load_network_matrix()
+        bts_servers = self.topology.get('bts_servers', None,
+            lambda: self.session.query(BTSInfo.name, BTSInfo.server_id).\
+                    order_by(BTSInfo.name).all())
+        servers = self.topology.get('server_names', None,
+                                    lambda: sorted(self.get_server_names()))
+        return self.net_matrix.get_bts_matrices(
+            [tuple(i) for i in bts_servers], servers)
 
     def update_container_monitor(self, **kwargs):
         container = kwargs.get('container', None)
@@ -710,7 +1120,7 @@ class DBCentral(object):
 
         .. math::
             \max{\{ \text{RSSI}_{ub'}^{t}, \widehat{\text{RSSI}}_{ub'}^{t'} \} }
-            < \text{RSSI}_{\min}
+            > \text{RSSI}_{\min}
 
         Args:
             user (str): user name
@@ -718,23 +1128,67 @@ class DBCentral(object):
             time (float): estimated time in seconds
 
         Returns:
-            A list of BTS objects.
+            A list of BTS names.
         """
-        bts_list = [ i.bts for i in self.query_neighbor(user)]
-        user_obj = self.get_user(user)
-        new_pos = estimator.estimate_new_position(
-            (user_obj.x, user_obj.y),
-            (user_obj.velocity_x, user_obj.velocity_y),
-            time)
-        # Calculates distance for each BTS
-        distances = [estimator.estimate_new_position((b.bts.x,b.bts.y),
-                                                     new_pos)
-                     for b in bts_list]
-        # Calculates RSSI for each BTS
-        rssi = [path_loss(d) for d in distances]
-        # Filters the result
-        return [ i[1].bts for i in zip(rssi, bts_list)
-                 if max(i[0], i[1].rssi) > thresh ]
+        return self.query_estimated_neighbors([user], time, thresh)[user]
+
+    def query_estimated_neighbors(self, users, delta_time,
+                                  thresh=Constants.RSSI_MINIMUM,
+                                  timeout=300000000):
+        """Queries suitable BSs of many users at once.
+
+        The newest RSSI of every (user, BS) pair in the last `timeout` comes
+        from one query. The positions of the users after `delta_time` and the
+        path loss RSSIs at those positions are computed as arrays. A BS is a
+        candidate if its measured or estimated RSSI is above `thresh`, see
+        query_estimated_neighbor. Without the position of the user or of the
+        BS, the RSSI is not estimated and only the measured one counts.
+
+        Args:
+            users (list): user names.
+            delta_time (float): estimated time in seconds.
+            thresh (float): minimum RSSI in dBm.
+            timeout (int): in microseconds. The default value is 5 minutes.
+
+        Returns:
+            dict: user name -> list of BTS names.
+        """
+        neighbors = {u: [] for u in users}
+        if len(users) == 0:
+            return neighbors
+        min_time = get_time() - timeout
+        # SQLite returns the other columns of the row holding the max()
+        rows = self.session.query(RSSIMonitor.user_id, RSSIMonitor.bts,
+                                  RSSIMonitor.rssi, BTSInfo.x, BTSInfo.y,
+                                  sqlalchemy.func.max(RSSIMonitor.timestamp)).\
+               outerjoin(BTSInfo, BTSInfo.name == RSSIMonitor.bts).\
+               filter(RSSIMonitor.user_id.in_(users),
+                      RSSIMonitor.timestamp > min_time).\
+               group_by(RSSIMonitor.user_id, RSSIMonitor.bts).all()
+        if len(rows) == 0:
+            return neighbors
+        positions = {u.name: (u.x, u.y, u.velocity_x, u.velocity_y)
+                     for u in self.session.query(EndUserInfo).\
+                     filter(EndUserInfo.name.in_(users))}
+        user_pos = np.array([positions.get(r[0], (None,)*4) for r in rows],
+                            dtype=float)
+        bts_pos = np.array([(r[3], r[4]) for r in rows], dtype=float)
+        rssi = np.array([r[2] for r in rows], dtype=float)
+        new_pos = user_pos[:, 0:2] + user_pos[:, 2:4] * delta_time
+        d = np.sqrt(((bts_pos - new_pos)**2).sum(axis=1))
+        # Same as communication_models.log_rssi_model_real
+        with np.errstate(invalid='ignore'):
+            # maximum keeps the NaN distance of an unknown position
+            est_rssi = -(10*3*np.log10(np.maximum(d, 1)) + 30)
+            # fmax ignores a NaN: without the position of the user or of
+            # the BS, only the measured RSSI is compared to the threshold
+            selected = np.fmax(rssi, est_rssi) > thresh
+        for r, ok in zip(rows, selected):
+            if ok:
+                neighbors[r[0]].append(r[1])
+        logging.debug("Estimated neighbors after {}s: {}".format(delta_time,
+                                                                neighbors))
+        return neighbors
 
     def get_est_handover_time(self, user, src_bs, dst_bs):
         if src_bs == dst_bs:
@@ -918,12 +1372,14 @@ class DBCentral(object):
         return list(servers)
 
     def get_server_name_from_ip(self, ip):
-        return self.session.query(EdgeServerInfo.name).\
-            filter(EdgeServerInfo.ip == ip).scalar()
+        return self.topology.get('server_name', ip,
+            lambda: self.session.query(EdgeServerInfo.name).\
+            filter(EdgeServerInfo.ip == ip).scalar())
 
     def add_new_server(self, server):
         self.insert_obj(server)
         self.session.commit()
+        self.topology.invalidate()
 
     def get_server_names_with_distance(self, distance):
         query_obj = self.session.query(EdgeServerInfo.name).\
@@ -935,8 +1391,9 @@ class DBCentral(object):
         return [ s[0] for s in query_obj ]
 
     def get_server_ip(self, name):
-        return self.session.query(EdgeServerInfo.ip).\
-            filter(EdgeServerInfo.name == name).scalar()
+        return self.topology.get('server_ip', name,
+            lambda: self.session.query(EdgeServerInfo.ip).\
+            filter(EdgeServerInfo.name == name).scalar())
 
     def register_bts(self, **kwargs):
         bts_name = kwargs.get('name', None)
@@ -953,6 +1410,7 @@ class DBCentral(object):
                       y = kwargs.get('y', 0))
         self.insert_obj(obj)
         self.session.commit()
+        self.topology.invalidate()
 
     def register_server(self, **kwargs):
         # TODO Verify user before register
@@ -981,6 +1439,7 @@ class DBCentral(object):
             server_info.bts_info = None
         self.insert_obj(server_info)
         self.session.commit()
+        self.topology.invalidate()
 
     def get_info_all_servers(self):
         ret = []
@@ -998,9 +1457,11 @@ class DBCentral(object):
                  filter(EdgeServerInfo.name == name).first()
         self.delete_obj(server)
         self.session.commit()
+        self.topology.invalidate()
 
     def is_associated_bts(self, bts):
-        btss = self.get_bts_names()
+        btss = self.topology.get('bts_names', None,
+                                 lambda: frozenset(self.get_bts_names()))
         return bts in btss
 
     def get_bts_names(self):
@@ -1013,9 +1474,9 @@ class DBCentral(object):
         Args:
             name (str): BTS name.
         """
-        query_obj = self.session.query(BTSInfo).\
-                    filter(BTSInfo.name == name).first()
-        return query_obj
+        return self.topology.get('bts', name,
+            lambda: self.session.query(BTSInfo).\
+                    filter(BTSInfo.name == name).first())
 
     def get_user_names(self):
         query_obj = self.session.query(EndUserInfo.name)
@@ -1056,7 +1517,7 @@ class DBCentral(object):
             user.b = b
         self.session.commit()
 
-    def update_eu_service_monitor(self, eu_service):
+    def update_eu_service_monitor(self, eu_service, timestamp=None):
         """Updates service monitor.
 
         Example::
@@ -1077,7 +1538,7 @@ class DBCentral(object):
         """
 
         violate_sla = False
-        t = get_time() # us
+        t = get_time() if timestamp is None else timestamp # us
         # TODO: how to define SLA properly
         SLA_E2E_DELAY = 700 #ms
         try:
@@ -1117,6 +1578,22 @@ class DBCentral(object):
             logging.error(traceback.format_exc())
         return violate_sla
 
+    def update_eu_service_monitor_batch(self, reports):
+        """Stores a batch of service reports in one transaction.
+
+        Args:
+            reports (list): (timestamp in us, report) of one end user.
+
+        Returns:
+            bool: True if a report of the batch violates the SLA.
+        """
+        violate_sla = False
+        for timestamp, eu_service in reports:
+            if self.update_eu_service_monitor(eu_service, timestamp):
+                violate_sla = True
+        self.session.commit()
+        return violate_sla
+
     def query_last_position(self, user, bts, p=5):
         infos = self.session.query(RSSIMonitor).\
               filter(RSSIMonitor.user_id==user, RSSIMonitor.bts==bts).\
@@ -1269,9 +1746,94 @@ class DBCentral(object):
                                   eta1=eta1,
                                   eta0=eta0)
             self.insert_obj(obj)
+            samples = self.rssi_history.get((user, bts), None)
+            if samples is None:
+                samples = collections.deque(maxlen=RSSI_HISTORY_SIZE)
+                self.rssi_history[(user, bts)] = samples
+            samples.append(tuple(getattr(obj, c)
+                                 for c in RSSI_HISTORY_COLUMNS))
         #self.session.commit()
         return current_rssi
 
+    def update_rssi_monitor_batch(self, user, scans, p=10):
+        """Stores a batch of RSSI scans of `user` in one transaction.
+
+        The filtered RSSIs are the same as with one update_rssi_monitor per
+        scan, but the trajectory and the RSSI predictors are fitted once per
+        batch, on its newest samples.
+
+        Args:
+            scans (list): (timestamp in us, nearby APs), oldest first.
+
+        Returns:
+            float: RSSI of the current BTS in the newest scan, 0 if unknown.
+        """
+        current_rssi = 0
+        current_bts = self.get_current_bts_ssid(user)
+        if current_bts is None or len(scans) == 0:
+            return current_rssi
+        ts, last_x, last_y = self.query_last_position(user, current_bts, 5)
+        positions = []
+        for timestamp, aps in scans:
+            x, y = self.find_user_location(aps)
+            positions.append((x, y))
+            ts.append(timestamp)
+            last_x.append(x)
+            last_y.append(y)
+        a, b = build_linear_regression(last_x, last_y)
+        vx = find_velocity(last_x, ts)
+        vy = find_velocity(last_y, ts)
+        histories = {}
+        newest = {}
+        objs = []
+        last_timestamp = 0
+        for (timestamp, aps), (x, y) in zip(scans, positions):
+            current_rssi = 0
+            for ap in aps:
+                # timestamp is the primary key of RSSIMonitor
+                timestamp = max(timestamp, last_timestamp + 1)
+                last_timestamp = timestamp
+                rssi = ap[Constants.RSSI]
+                if rssi < RSSI_LIMIT:
+                    continue
+                bts = ap[Constants.SSID]
+                if current_bts == bts:
+                    current_rssi = rssi
+                if not self.is_associated_bts(bts):
+                    continue
+                if bts not in histories:
+                    histories[bts] = self.query_last_eRSSIs(user, bts, p)
+                bts_ts, last_eRSSIs = histories[bts]
+                if len(last_eRSSIs) < p:
+                    erssi = rssi
+                    newest.pop(bts, None)
+                else:
+                    erssi = get_exp_moving_average(rssi, last_eRSSIs[-1])
+                obj = RSSIMonitor(timestamp=timestamp, user_id=user, x=x,
+                                  y=y, bts=bts, rssi=rssi, erssi=erssi)
+                if len(last_eRSSIs) >= p:
+                    newest[bts] = obj
+                bts_ts.append(timestamp)
+                last_eRSSIs.append(erssi)
+                objs.append(obj)
+        # Fit the predictor of each BTS with its newest p+1 samples
+        for bts, obj in newest.items():
+            bts_ts, last_eRSSIs = histories[bts]
+            obj.eta2, obj.eta1, obj.eta0 = build_log_regression(
+                bts_ts[-(p+1):], last_eRSSIs[-(p+1):], t_offset=self.t0)
+        for obj in objs:
+            self.insert_obj(obj)
+            samples = self.rssi_history.get((user, obj.bts), None)
+            if samples is None:
+                samples = collections.deque(maxlen=RSSI_HISTORY_SIZE)
+                self.rssi_history[(user, obj.bts)] = samples
+            samples.append(tuple(getattr(obj, c)
+                                 for c in RSSI_HISTORY_COLUMNS))
+        x, y = positions[-1]
+        # commits the whole batch
+        self.update_eu_position(user, x, y, vx, vy, a, b)
+        return current_rssi
+
     def update_migrate_record_source(self, **kwargs):
         obj = MigrateRecord(timestamp=get_time(), **kwargs)
         obj.restore = None
@@ -1295,6 +1857,7 @@ class DBCentral(object):
                 return None
             obj.restore = kwargs.get('restore', 0)
             obj.xdelta_dest = kwargs.get('xdelta_dest', None)
+            obj.dest_queue_wait = kwargs.get('queue_wait', None)
             return obj
         return None
 
@@ -1378,8 +1941,7 @@ class DBCentral(object):
 
     def get_bts_info(self, name, bssid):
         # Now, we don't care about BSSID but we will add bssid filter later
-        ap = self.session.query(BTSInfo).filter(BTSInfo.name==name).first()
-        return ap
+        return self.get_bts(name)
 
     def valid_info(self):
         # Check container information
@@ -1393,3 +1955,66 @@ class DBCentral(object):
             logging.debug("Missing information on: {}".\
                           format(self.session.query(ServiceInfo).all()))
             return False
+
+    def snapshot(self):
+        """Takes an in-memory snapshot of the committed database.
+
+        Returns:
+            DBSnapshot: a private copy, changes made on it never reach this
+            database.
+        """
+        start = time.time()
+        snap = DBSnapshot(self)
+        logging.debug("Snapshot of {} taken in {} s".format(self.database,
+                                                           time.time() - start))
+        return snap
+
+class DBSnapshot(DBCentral):
+    """A DBCentral bound to an in-memory copy of another DBCentral.
+
+    A planning round queries the snapshot instead of the live session, so
+    monitor updates arriving meanwhile do not change the inputs of the round.
+    The estimated migration times are shared with the live database, the RSSI
+    history is copied.
+
+    Only the last `snapshot_history` seconds of the monitor tables are
+    copied, the planners query the latest samples. The network matrices,
+    which cover the older samples of the links, are loaded before the copy.
+    """
+    def __init__(self, live):
+        self.database = ':memory:'
+        live.load_network_matrix()
+        with live.read_session() as reader:
+            self.conn = copy_to_memory(reader,
+                get_time() - int(live.snapshot_history*10**6),
+                SNAPSHOT_HISTORY_TABLES)
+        self.engine = sqlalchemy.create_engine('sqlite://',
+            creator=lambda: self.conn, poolclass=StaticPool)
+        self.write_lock = threading.RLock()
+        self.lock_stats = LockStats()
+        self.DBSession = sessionmaker(bind=self.engine, class_=WriterSession,
+                                      expire_on_commit=False,
+                                      write_lock=self.write_lock,
+                                      lock_stats=self.lock_stats)
+        self.session = self.DBSession()
+        self.read_engine = self.engine
+        self.ReadSession = scoped_session(sessionmaker(bind=self.engine,
+                                                       autoflush=False))
+        self.net_matrix = live.net_matrix.copy()
+        self.watch_network_commits()
+        self.topology = TopologyCache()
+        self.profiler = live.profiler
+        if self.profiler is not None:
+            self.profiler.attach(self.engine)
+        self.est_time_users = live.est_time_users
+        self.rssi_history = {key: collections.deque(samples,
+                                 maxlen=RSSI_HISTORY_SIZE)
+                             for key, samples in
+                             dict(live.rssi_history).items()}
+        self.t0 = live.t0
+
+    def close(self):
+        self.session.close()
+        self.ReadSession.remove()
+        self.engine.dispose()
+        self.conn.close()
@@ -4,24 +4,28 @@ import json
 import signal
 import logging
 import argparse
+import threading
 import traceback
 import collections
 from subprocess import check_output
 import sys
 
 import yaml
-import sched, time
-from threading import Timer
 
 import central_database as db
 from planner import RSSIPlanner, RandomPlanner, CloudPlanner
 from optimization_planner import OptimizationPlanner
 import stats_edge
+import controller_state
+from trigger_scheduler import TriggerScheduler
+from monitor_mailbox import LatestValueMailbox
+from snapshot_staging import StagingPolicy, rank_destinations
 from migrate_node import MigrateNode
-from mqtt_protocol import MqttClient
+from mqtt_protocol import MqttClient, STRING, NUMBER, validate
+from compact_codec import Codebook, next_generation
 from discovery_edge import DiscoveryYaml
 import Constants
-from utilities import check_swap_file, handle_exception
+from utilities import check_swap_file, handle_exception, get_time
 
 INIT_STATE           = 0b000000
 RUNNING_STATE        = 0b000001
@@ -31,8 +35,46 @@ MIGRATE_STATE        = 0b001000
 HANDOVER_STATE       = 0b010000
 HANDOVERED_STATE     = 0b100000
 
-def handle_timer_trigger(timeout, trigger_pre_mig_cb, args):
-    Timer(timeout, trigger_pre_mig_cb, args).start()
+def is_batch(report):
+    return isinstance(report, dict) and Constants.BATCH in report
+
+def get_batch_reports(batch_json):
+    """Returns (timestamp in us, report) of each report of a batch.
+
+    Report times are taken relatively to the send time of the batch, so the
+    clock of the end user needs not be synchronized.
+    """
+    now = get_time()
+    sent = batch_json[Constants.BATCH_SENT]
+    reports = []
+    for report in batch_json[Constants.BATCH]:
+        validate(report, {Constants.BATCH_TIME: NUMBER})
+        report = dict(report)
+        report[Constants.END_USER] = batch_json[Constants.END_USER]
+        report[Constants.SERVICE_NAME] = batch_json.get(
+            Constants.SERVICE_NAME, None)
+        age = sent - report.pop(Constants.BATCH_TIME)
+        reports.append((int(now - age*10**6), report))
+    return reports
+
+# Required keys of the payloads, see mqtt_protocol.validate
+REGISTER_SCHEMA = {'server_name': STRING, 'ip': STRING, 'distance': None}
+EDGE_MONITOR_SCHEMA = {'src_node': STRING, 'dest_node': STRING,
+                       'latency': None, 'bw': None}
+DISCOVERY_SCHEMA = {Constants.END_USER: STRING,
+                    Constants.ASSOCIATED_SSID: STRING,
+                    Constants.SERVICE_NAME: STRING}
+MONITOR_EU_SCHEMA = {Constants.END_USER: STRING, Constants.NEARBY_AP: list}
+MONITOR_SERVICE_SCHEMA = {Constants.END_USER: STRING}
+BATCH_SCHEMA = {Constants.END_USER: STRING, Constants.BATCH_SENT: NUMBER,
+                Constants.BATCH: list}
+USER_SCHEMA = {Constants.END_USER: STRING}
+PRE_MIGRATED_SCHEMA = {Constants.END_USER: STRING,
+                       Constants.SERVER_NAME: STRING,
+                       Constants.ASSOCIATED_SSID: STRING}
+HANDOVERED_SCHEMA = {Constants.ASSOCIATED_SSID: STRING,
+                     Constants.ASSOCIATED_BSSID: STRING}
+MIGRATE_REPORT_SCHEMA = {'source': STRING, 'dest': STRING}
 
 class CentralizedController(MqttClient):
     def __init__(self, broker_ip, broker_port, database, **kwargs):
@@ -49,10 +91,15 @@ class CentralizedController(MqttClient):
             broker_port=broker_port,
             keepalive=60,
             lwt_topic=Constants.LWT_CENTRE)
+        # Serializes the handlers of the MQTT, mailbox and scheduler threads
+        self.handler_lock = threading.RLock()
+        # Depth of the serialized calls and planning rounds deferred until
+        # the outermost one releases the locks, per thread
+        self.handler_local = threading.local()
         self.message_callback_add(Constants.REGISTER,
                                   self.process_edge_register)
         self.message_callback_add(Constants.MONITOR_EU_ALL,
-                                  self.process_monitor_eu)
+                                  self.process_monitor_eu, serialize=False)
         self.message_callback_add(Constants.MONITOR_SERVICE_ALL,
                                   self.process_monitor_service)
         self.message_callback_add(Constants.MONITOR_SERVER_ALL,
@@ -77,10 +124,20 @@ class CentralizedController(MqttClient):
                                   self.process_eu_notification)
         self.message_callback_add(Constants.LWT_EDGE_ALL,
                                   self.process_edge_notification)
+        self.message_callback_add(Constants.PROFILE_SQL,
+                                  self.process_profile_sql)
+        self.message_callback_add(Constants.PROFILE_DECODE,
+                                  self.process_profile_decode,
+                                  serialize=False)
         method = kwargs.get('planner', 'random')
         self.migrate_method = kwargs.get(Constants.MIGRATE_METHOD,
                                          Constants.PRE_COPY)
         self.db = database
+        # Interned BTS names of the compact monitor reports, the generation
+        # is persisted next to the database
+        self.codebook = Codebook(generation=next_generation(
+            '{}.codebook'.format(self.db.database)))
+        self.decoder.codebook = self.codebook
         self.stats = stats_edge.StatsEdgeSql(db_control=self.db)
         if method == Constants.RANDOM_PLAN:
             logging.info("Start RSSI-threshold + random server planner")
@@ -102,6 +159,57 @@ class CentralizedController(MqttClient):
         self.migration_state = {}
         self.migrating_plan = {}
         self.handover_plan = {}
+        # Delayed triggers, keyed by (end user, trigger). They run one at a
+        # time under handler_lock: a pool would not run them in parallel
+        # and could reorder the triggers of a user. They only publish
+        # commands, their lateness is in the runtime stats.
+        self.scheduler = TriggerScheduler()
+        self.scheduler.start()
+        # Coalesce the monitor/eu reports of a user while the previous ones
+        # are processed, None processes them on the MQTT thread
+        self.mailbox = None
+        policy = kwargs.get('monitor_policy', None)
+        if policy is not None:
+            self.mailbox = LatestValueMailbox(
+                self.serialized(self.handle_monitor_eu), policy,
+                kwargs.get('monitor_max_samples', 20))
+            self.mailbox.start()
+        # Snapshots staged at the likely destinations, for the pipelined
+        # pre-copy whose pre-dump is deduplicated against them
+        self.staging = None
+        top_k = kwargs.get('stage_top_k', 0)
+        if top_k > 0 and self.migrate_method == Constants.PIPELINED_PRE_COPY:
+            self.staging = StagingPolicy(top_k,
+                ttl=kwargs.get('stage_ttl', 120),
+                budget=kwargs.get('stage_budget', 20))
+
+    def get_state(self):
+        """Returns a picklable copy of the state kept in memory."""
+        return controller_state.capture_state(self.db, self.migration_state,
+                                              self.migrating_plan,
+                                              self.handover_plan)
+
+    def warm_start(self, path):
+        """Reloads the state saved in `path` by a previous controller.
+
+        Triggers scheduled by the previous controller are lost. Pending plans
+        are kept, so they are resumed by the next pre-migrated report, or
+        replaced by the next planning round.
+
+        Returns:
+            bool: True if the state was restored.
+        """
+        state = controller_state.load_state(path)
+        if state is None:
+            return False
+        restored = controller_state.restore_state(self.db, state)
+        if restored is None:
+            return False
+        (self.migration_state, self.migrating_plan,
+         self.handover_plan) = restored
+        logging.info("Warm start with {} users from {}".format(
+            len(self.migration_state), path))
+        return True
 
     def on_connect(self, client, userdata, flag, rc):
         logging.info("Connected to broker with result code {}".format(rc))
@@ -111,21 +219,168 @@ class CentralizedController(MqttClient):
             (Constants.DISCOVER, 1), (Constants.ALLOCATED_ALL, 1),
             (Constants.MIGRATED_ALL, 1), (Constants.LWT_ALL, 1),
             (Constants.PRE_MIGRATED_ALL, 1), (Constants.HANDOVERED_ALL, 1),
-            (Constants.MIGRATE_REPORT_ALL, 1)])
+            (Constants.MIGRATE_REPORT_ALL, 1), (Constants.PROFILE_SQL, 1),
+            (Constants.PROFILE_DECODE, 1)])
         self.publish_list_servers()
 
+    def message_callback_add(self, sub, callback, serialize=True):
+        """Adds a callback whose SQL statements are profiled under the
+        topic it subscribes.
+
+        Args:
+            serialize (bool): the callback runs under handler_lock. A callback
+                that does not touch the database or the migration states
+                may run without it.
+        """
+        if serialize:
+            callback = self.serialized(callback)
+        def profiled_callback(client, userdata, message):
+            with self.db.profile_scope('mqtt:{}'.format(sub)):
+                return callback(client, userdata, message)
+        super(CentralizedController, self).message_callback_add(sub,
+            profiled_callback)
+
+    def serialized(self, func):
+        """Wraps `func` to run under handler_lock.
+
+        The MQTT callbacks, the monitor mailbox and the scheduled triggers
+        run on their own threads but share the writer session and the
+        migration states, so they run one at a time, each as one unit of
+        work of the writer session. The planning rounds they trigger run
+        after the locks are released, see defer_planning.
+        """
+        def wrapper(*args, **kwargs):
+            local = self.handler_local
+            local.depth = getattr(local, 'depth', 0) + 1
+            if local.depth == 1:
+                local.deferred = []
+            try:
+                with self.handler_lock, self.db.unit_of_work():
+                    ret = func(*args, **kwargs)
+            finally:
+                local.depth -= 1
+            if local.depth == 0:
+                deferred, local.deferred = local.deferred, []
+                for compute, apply_plans in deferred:
+                    self.run_planning(compute, apply_plans)
+            return ret
+        return wrapper
+
+    def defer_planning(self, compute, apply_plans):
+        """Runs compute() in a planning round once the handler releases the
+        locks, so that ingest keeps writing meanwhile, then
+        apply_plans(plans) under the locks. It runs now outside a handler.
+        """
+        if getattr(self.handler_local, 'depth', 0) > 0:
+            self.handler_local.deferred.append((compute, apply_plans))
+        else:
+            self.run_planning(compute, apply_plans)
+
+    def run_planning(self, compute, apply_plans):
+        with self.stats.planning_round():
+            migrate_plans = compute()
+        logging.debug("New plan: {}".format(migrate_plans))
+        self.serialized(apply_plans)(migrate_plans)
+
+    def get_runtime_stats(self):
+        """Returns the payload decode times of each topic, the stats of the
+        monitor mailbox, of the database locks, of the topology cache and of
+        the trigger scheduler."""
+        stats = {'decode': self.decoder.get_stats(),
+                 'locks': self.db.get_lock_stats(),
+                 'topology': self.db.get_topology_stats(),
+                 'scheduler': self.scheduler.get_stats()}
+        if self.mailbox is not None:
+            stats['monitor_eu'] = self.mailbox.get_stats()
+        return stats
+
+    def process_profile_sql(self, client, userdata, message):
+        """Dumps the SQL profile.
+
+        Example::
+
+            {'reset': true}
+
+        The profile, with the stats of get_runtime_stats, is published to
+        profile/sql/report. The requests are not
+        authenticated, so they cannot name a file: the profile is written to
+        the --sql_profile file on SIGUSR1 and at exit.
+        """
+        msg = message.payload
+        logging.info("Process topic {}, payload: {}".format(message.topic,
+                                                           msg))
+        if self.db.profiler is None:
+            logging.warn("SQL profiling is disabled")
+            return
+        try:
+            msg_json = self.decode_payload(message)
+        except yaml.YAMLError:
+            logging.error("Error parsing YAML msg {}".format(msg))
+            return
+        if not isinstance(msg_json, dict):
+            msg_json = {}
+        if 'path' in msg_json:
+            logging.warn("Ignore the path {} of the SQL profile request".\
+                         format(msg_json['path']))
+        report = self.db.profiler.get_json()
+        report.update(self.get_runtime_stats())
+        self.publish(Constants.PROFILE_SQL_REPORT, json.dumps(report))
+        if msg_json.get('reset', False):
+            self.db.profiler.reset()
+
+    def process_profile_decode(self, client, userdata, message):
+        """Dumps the stats of get_runtime_stats.
+
+        Example::
+
+            {'reset': true}
+
+        The stats are published to profile/decode/report, whether SQL
+        profiling is enabled or not.
+        """
+        msg = message.payload
+        logging.info("Process topic {}, payload: {}".format(message.topic,
+                                                           msg))
+        try:
+            msg_json = self.decode_payload(message)
+        except yaml.YAMLError:
+            logging.error("Error parsing YAML msg {}".format(msg))
+            return
+        if not isinstance(msg_json, dict):
+            msg_json = {}
+        report = self.get_runtime_stats()
+        self.publish(Constants.PROFILE_DECODE_REPORT, json.dumps(report))
+        if msg_json.get('reset', False):
+            self.decoder.reset()
+
     def update_user_monitor_info(self, user_info):
         logging.info("Update user info {}".format(user_info))
         user = user_info[Constants.END_USER]
         aps=user_info[Constants.NEARBY_AP]
         return self.db.update_rssi_monitor(user=user, aps=aps)
 
+    def update_user_monitor_batch(self, end_user, reports):
+        logging.info("Update user info batch {}".format(reports))
+        return self.db.update_rssi_monitor_batch(end_user,
+            [(t, report[Constants.NEARBY_AP]) for t, report in reports])
+
     def publish_list_servers(self):
         all_servers = self.db.get_info_all_servers()
         topic = Constants.UPDATED_SERVERS
         payload = json.dumps(all_servers)
         self.publish(topic, payload)
         logging.info('Publish topic {} payload {}'.format(topic, payload))
+        self.publish_codebook()
+
+    def publish_codebook(self):
+        """Publishes the codebook of the compact monitor reports, with the
+        BTS registered so far."""
+        for name in self.db.get_bts_names():
+            self.codebook.add(name)
+        topic = Constants.MONITOR_CODEC
+        payload = json.dumps(self.codebook.get_json())
+        self.publish(topic, payload, retain=True)
+        logging.info('Publish topic {} payload {}'.format(topic, payload))
 
     def process_edge_register(self, client, userdata, message):
         """Processes a register message from a edge node.
@@ -141,7 +396,7 @@ class CentralizedController(MqttClient):
         msg = message.payload
         logging.info("process topic {}, payload: {}".format(topic, msg))
         try:
-            msg_json = yaml.safe_load(msg)
+            msg_json = self.decode_payload(message, REGISTER_SCHEMA)
             self.db.register_server(name=msg_json['server_name'],
                                     ip=msg_json['ip'],
                                     bs=msg_json.get('bs', None),
@@ -161,7 +416,7 @@ class CentralizedController(MqttClient):
                                  "", topic)
         logging.info("Process topic {}, payload: {}".format(topic, msg))
         try:
-            msg_json = yaml.safe_load(msg)
+            msg_json = self.decode_payload(message, EDGE_MONITOR_SCHEMA)
             src_ip = msg_json['src_node']
             dst_ip = msg_json['dest_node']
             server = self.db.get_server_name_from_ip(src_ip)
@@ -183,7 +438,7 @@ class CentralizedController(MqttClient):
         logging.info("process topic {}, payload: {}".format(topic, msg))
         payload = {}
         try:
-            service_json = yaml.safe_load(msg)
+            service_json = self.decode_payload(message, DISCOVERY_SCHEMA)
             service_json[Constants.MIGRATE_METHOD] = self.migrate_method
             end_user = service_json[Constants.END_USER]
             ssid = service_json[Constants.ASSOCIATED_SSID]
@@ -239,8 +494,10 @@ class CentralizedController(MqttClient):
 
     def trigger_other_planners(self):
         self.db.session.commit()
-        migrate_plans = self.planner.compute_plan()
-        logging.debug("New plan: {}".format(migrate_plans))
+        self.defer_planning(self.planner.compute_plan,
+                            self.apply_other_plans)
+
+    def apply_other_plans(self, migrate_plans):
         for plan in migrate_plans:
             service = self.db.get_service(plan.user)
             end_user = plan.user
@@ -286,6 +543,8 @@ class CentralizedController(MqttClient):
                 service_json[Constants.SERVER_NAME] = plan.next_server
                 service_json['ip'] = self.db.get_server_ip(plan.next_server)
                 service_json[Constants.ASSOCIATED_SSID] = plan.next_bts
+                self.add_link_bw(source_mig_server_name, service_json)
+                self.use_staging(end_user, plan.next_server)
                 payload = json.dumps(service_json)
                 topic = '{}/{}'.format(Constants.PRE_MIGRATE, source_mig_server_name)
                 self.publish(topic, payload)
@@ -299,8 +558,10 @@ class CentralizedController(MqttClient):
     def run_optimization_planner(self, delta_time):
         # This is used for OPTIMIZED_PLAN only
         self.db.session.commit()
-        migrate_plans = self.planner.compute_plan(delta_time)
-        logging.debug("New plan: {}".format(migrate_plans))
+        self.defer_planning(lambda: self.planner.compute_plan(delta_time),
+                            self.apply_optimization_plans)
+
+    def apply_optimization_plans(self, migrate_plans):
         for plan in migrate_plans:
             service = self.db.get_service(plan.user)
             source_mig_server_name = service.server_name
@@ -325,6 +586,11 @@ class CentralizedController(MqttClient):
                 return
             if not (m_state & PRE_MIGRATE_STATE or m_state & PRE_MIGRATED_STATE or\
                 m_state & MIGRATE_STATE):
+                if plan.next_server == service.server_name and \
+                    self.scheduler.cancel((end_user, 'pre_migrate')):
+                    logging.debug("Cancel superseded pre-migration of {}".
+                        format(end_user))
+                    self.migrating_plan.pop(end_user, None)
                 if plan.next_server != service.server_name:
                     service_json = service.get_json()
                     if service_json is None:
@@ -336,8 +602,10 @@ class CentralizedController(MqttClient):
                     service_json['ip'] = self.db.get_server_ip(plan.next_server)
                     service_json[Constants.ASSOCIATED_SSID] = plan.next_bts
                     if time_to_pre_mig is not None and time_to_pre_mig < 60:
-                        Timer(time_to_pre_mig, self.trigger_pre_migration,
-                                (source_mig_server_name, service_json,)).start()
+                        self.scheduler.schedule((end_user, 'pre_migrate'),
+                            time_to_pre_mig,
+                            self.serialized(self.trigger_pre_migration),
+                            (source_mig_server_name, service_json,))
                         # store plan for calling trigger_migration when PRE_MIGRATED
                         store_obj = {'plan':plan, 'service': service_json}
                         self.migrating_plan[end_user] = store_obj
@@ -372,8 +640,10 @@ class CentralizedController(MqttClient):
                             format(end_user, handover_json, lifetime_to_mig))
                         # store plan for calling trigger_handover later
                         self.handover_plan[end_user] = handover_json
-                        Timer(lifetime_to_mig, self.trigger_handover,
-                            (end_user, handover_json,)).start()
+                        self.scheduler.schedule((end_user, 'handover'),
+                            lifetime_to_mig,
+                            self.serialized(self.trigger_handover),
+                            (end_user, handover_json,))
                     else:
                         logging.warn("lifetime_to_mig for u-s-nexts [{}-{}-{}]={} > 2s".
                             format(end_user, source_mig_server_name,
@@ -406,6 +676,42 @@ class CentralizedController(MqttClient):
         if self.handover_plan.get(end_user, None) is not None:
             del(self.handover_plan[end_user])
 
+    def add_link_bw(self, source, service_json):
+        """Adds the BW of the link to the destination in Mbps, the source
+        paces its pre-copy rounds with it. It is None without measurement,
+        the source then relies on the throughput it measured."""
+        service_json['bw'] = self.db.query_bw(source,
+            service_json[Constants.SERVER_NAME], default=None)
+
+    def stage_snapshots(self, end_user):
+        """Asks the server of the service of `end_user` to stage its
+        snapshot at the servers the user is likely to reach next."""
+        service = self.db.get_service(end_user)
+        if service is None or service.server_name is None:
+            return
+        candidates = rank_destinations(self.db, end_user,
+            self.staging.horizon, self.staging.top_k)
+        # a link without measurement is unknown, not 1 kbps
+        servers = self.staging.select(end_user, service.server_name,
+            service.pre_checkpoint, candidates,
+            lambda src, dst: self.db.query_bw(src, dst, default=None))
+        for server in servers:
+            service_json = service.get_json()
+            if service_json is None:
+                return
+            service_json[Constants.SERVER_NAME] = server
+            service_json['ip'] = self.db.get_server_ip(server)
+            self.add_link_bw(service.server_name, service_json)
+            topic = '{}/{}'.format(Constants.PRE_STAGE, service.server_name)
+            payload = json.dumps(service_json)
+            self.publish(topic, payload)
+            logging.info("Publish topic: {}, payload: {}".format(topic,
+                                                                 payload))
+
+    def use_staging(self, end_user, server):
+        if self.staging is not None:
+            self.staging.use(end_user, server)
+
     def trigger_pre_migration(self, source_mig_server_name, service_json):
         end_user = service_json[Constants.END_USER]
         m_state = self.migration_state.get(end_user, None)
@@ -417,6 +723,8 @@ class CentralizedController(MqttClient):
                 format(service_json))
             return
         self.migration_state[end_user] |= PRE_MIGRATE_STATE
+        self.add_link_bw(source_mig_server_name, service_json)
+        self.use_staging(end_user, service_json[Constants.SERVER_NAME])
         payload = json.dumps(service_json)
         topic = '{}/{}'.format(Constants.PRE_MIGRATE, source_mig_server_name)
         self.publish(topic, payload)
@@ -458,44 +766,76 @@ class CentralizedController(MqttClient):
         msg = message.payload
         logging.debug("process topic {}, payload: {}".format(topic, msg))
         try:
-            user_info = yaml.safe_load(msg)
-            current_rssi = self.update_user_monitor_info(user_info)
-            end_user = user_info[Constants.END_USER]
-            m_state = self.migration_state.get(end_user, None)
-            if m_state is None:
-                logging.error("Wrong enduser {} trigger optimization".
-                    format(end_user))
-                return
-            if not (m_state & PRE_MIGRATE_STATE or m_state & PRE_MIGRATED_STATE or\
-                m_state & MIGRATE_STATE):
-                if self.planner_type == Constants.OPTIMIZED_PLAN:
-                    (T_pre_mig_avg, time_to_avg_pre_mig) = \
-                        self.planner.lifetime_to_average_pre_mig(end_user)
-                    logging.debug("time_to_pre_mig [{}]={}, T_pre_mig_avg[{}]={}".
-                        format(end_user, time_to_avg_pre_mig, end_user, T_pre_mig_avg))
-                    if time_to_avg_pre_mig is not None:
-                       if time_to_avg_pre_mig < 60:
-                            #service_state = self.db.get_service_state(end_user)
-                            # No trigger pre migration for user doing pre-migrate
-                            #if service_state != Constants.PRE_MIGRATE:
-                            self.run_optimization_planner(T_pre_mig_avg)
-                else: # random or rssi_closest planer trigger by threshold
-                    if current_rssi <= Constants.RSSI_THRESHOLD:
-                        logging.debug("RSSI={} is bellow threshold, trigger pre-mig".
-                        format(current_rssi))
-                        self.trigger_other_planners()
+            user_info = self.decode_payload(message)
+            if is_batch(user_info):
+                validate(user_info, BATCH_SCHEMA)
+                reports = get_batch_reports(user_info)
+                for _, report in reports:
+                    validate(report, MONITOR_EU_SCHEMA)
             else:
-                logging.warn("Service is being migrated. No need to trigger planner.")
+                validate(user_info, MONITOR_EU_SCHEMA)
+                reports = [(get_time(), user_info)]
         except yaml.YAMLError:
             logging.error("Error parsing YAML msg {}".format(msg))
+            return
+        end_user = user_info[Constants.END_USER]
+        if self.mailbox is not None:
+            self.mailbox.put(end_user, reports)
+        else:
+            self.serialized(self.handle_monitor_eu)(end_user, reports)
+
+    def handle_monitor_eu(self, end_user, reports):
+        """Stores the RSSI reports of a user and triggers the planner.
+
+        Args:
+            reports (list): (timestamp in us, monitor/eu report), oldest
+                first. Several reports are stored in one batch.
+        """
+        if len(reports) == 1:
+            current_rssi = self.update_user_monitor_info(reports[0][1])
+        else:
+            current_rssi = self.update_user_monitor_batch(end_user, reports)
+        m_state = self.migration_state.get(end_user, None)
+        if m_state is None:
+            logging.error("Wrong enduser {} trigger optimization".
+                format(end_user))
+            return
+        if not (m_state & PRE_MIGRATE_STATE or m_state & PRE_MIGRATED_STATE or\
+            m_state & MIGRATE_STATE):
+            if self.staging is not None and self.staging.is_due(end_user):
+                self.stage_snapshots(end_user)
+            if self.planner_type == Constants.OPTIMIZED_PLAN:
+                (T_pre_mig_avg, time_to_avg_pre_mig) = \
+                    self.planner.lifetime_to_average_pre_mig(end_user)
+                logging.debug("time_to_pre_mig [{}]={}, T_pre_mig_avg[{}]={}".
+                    format(end_user, time_to_avg_pre_mig, end_user, T_pre_mig_avg))
+                if time_to_avg_pre_mig is not None:
+                   if time_to_avg_pre_mig < 60:
+                        #service_state = self.db.get_service_state(end_user)
+                        # No trigger pre migration for user doing pre-migrate
+                        #if service_state != Constants.PRE_MIGRATE:
+                        self.run_optimization_planner(T_pre_mig_avg)
+            else: # random or rssi_closest planer trigger by threshold
+                if current_rssi <= Constants.RSSI_THRESHOLD:
+                    logging.debug("RSSI={} is bellow threshold, trigger pre-mig".
+                    format(current_rssi))
+                    self.trigger_other_planners()
+        else:
+            logging.warn("Service is being migrated. No need to trigger planner.")
 
     def process_monitor_service(self, client, userdata, message):
         topic = message.topic
         msg = message.payload
         logging.debug("process topic {}, payload: {}".format(topic, msg))
         try:
-            service_info = yaml.safe_load(msg)
-            violate_sla = self.db.update_eu_service_monitor(service_info)
+            service_info = self.decode_payload(message)
+            if is_batch(service_info):
+                validate(service_info, BATCH_SCHEMA)
+                violate_sla = self.db.update_eu_service_monitor_batch(
+                    get_batch_reports(service_info))
+            else:
+                validate(service_info, MONITOR_SERVICE_SCHEMA)
+                violate_sla = self.db.update_eu_service_monitor(service_info)
             if self.planner_type == Constants.OPTIMIZED_PLAN and violate_sla:
                 end_user = service_info[Constants.END_USER]
                 m_state = self.migration_state.get(end_user, None)
@@ -523,7 +863,7 @@ class CentralizedController(MqttClient):
         msg = message.payload
         logging.debug("process topic {}, payload: {}".format(topic, msg))
         try:
-            server_info = yaml.safe_load(msg)
+            server_info = self.decode_payload(message)
             server_name = topic.split('/')[2]
             self.db.update_server_monitor(server_name,
                                           server_info.get('cpu_max', None),
@@ -552,7 +892,7 @@ class CentralizedController(MqttClient):
         msg = message.payload
         logging.info("process topic {}, payload: {}".format(topic, msg))
         try:
-            edge_service_json = yaml.safe_load(msg)
+            edge_service_json = self.decode_payload(message, USER_SCHEMA)
             if edge_service_json is not None:
                 end_user = edge_service_json[Constants.END_USER]
                 # Verify a user only have 1 service
@@ -575,7 +915,7 @@ class CentralizedController(MqttClient):
         msg = message.payload
         logging.info("process topic {}, payload: {}".format(topic, msg))
         try:
-            service_json = yaml.safe_load(msg)
+            service_json = self.decode_payload(message, PRE_MIGRATED_SCHEMA)
             if service_json is not None:
                 end_user = service_json[Constants.END_USER]
                 dest_server = service_json[Constants.SERVER_NAME]
@@ -617,6 +957,7 @@ class CentralizedController(MqttClient):
                         # Keep running in the same old server
                         service.state = 'running'
                         self.migration_state[end_user] = RUNNING_STATE
+                        self.scheduler.cancel_user(end_user)
                         # remove handover plan
                         if self.handover_plan.get(end_user, None) is not None:
                             del(self.handover_plan[end_user])
@@ -634,12 +975,16 @@ class CentralizedController(MqttClient):
                                 handover_json[Constants.ELAPSED_TIME] =\
                                     lifetime_to_mig * 1000 # convert to ms
                                 # offset 0.1s to handover after the service is down.
-                                Timer(lifetime_to_mig + 0.1, self.trigger_handover,
-                                    (end_user, handover_json,)).start()
+                                self.scheduler.schedule((end_user, 'handover'),
+                                    lifetime_to_mig + 0.1,
+                                    self.serialized(self.trigger_handover),
+                                    (end_user, handover_json,))
                             else:
                                 handover_json[Constants.ELAPSED_TIME] = 0
-                                Timer(0.1, self.trigger_handover,
-                                    (end_user, handover_json,)).start()
+                                self.scheduler.schedule((end_user, 'handover'),
+                                    0.1,
+                                    self.serialized(self.trigger_handover),
+                                    (end_user, handover_json,))
                         else:
                             logging.debug("No handover plan")
                     if not (m_state & MIGRATE_STATE):
@@ -652,8 +997,10 @@ class CentralizedController(MqttClient):
                             if plan.next_server == dest_server and\
                                 plan.next_bts == dest_bts:
                                 source_server = service.server_name
-                                Timer(lifetime_to_mig, self.trigger_migration,
-                                    (plan, source_server, stored_json,)).start()
+                                self.scheduler.schedule((end_user, 'migrate'),
+                                    lifetime_to_mig,
+                                    self.serialized(self.trigger_migration),
+                                    (plan, source_server, stored_json,))
                         else:
                             logging.debug("No migration plan")
         except yaml.YAMLError:
@@ -664,7 +1011,7 @@ class CentralizedController(MqttClient):
         msg = message.payload
         logging.info("process topic {}, payload: {}".format(topic, msg))
         try:
-            migrated_service_json= yaml.safe_load(msg)
+            migrated_service_json= self.decode_payload(message)
             #migrated_service_json = yaml.safe_load(m_service_str)
             logging.info("migrated service {}".format(migrated_service_json))
             if migrated_service_json is not None:
@@ -686,7 +1033,7 @@ class CentralizedController(MqttClient):
         logging.info("process topic {}, payload: {}".format(topic, msg))
         end_user = topic.split('/')[1]
         try:
-            handovered_json= yaml.safe_load(msg)
+            handovered_json= self.decode_payload(message, HANDOVERED_SCHEMA)
             if handovered_json is not None:
                 ssid = handovered_json[Constants.ASSOCIATED_SSID]
                 bssid = handovered_json[Constants.ASSOCIATED_BSSID]
@@ -712,6 +1059,7 @@ class CentralizedController(MqttClient):
         self.publish(topic, payload)
         logging.info("publish topic {}, payload: {}".format(topic, payload))
         end_user = service.user.name
+        self.scheduler.cancel_user(end_user)
         self.db.delete_obj(service.user)
         self.db.delete_obj(service)
         self.db.session.commit()
@@ -757,7 +1105,7 @@ class CentralizedController(MqttClient):
         report_type = topic.split('/')[1]
         server_name = topic.split('/')[2]
         try:
-            msg_json = yaml.safe_load(msg)
+            msg_json = self.decode_payload(message, MIGRATE_REPORT_SCHEMA)
             source = msg_json['source']
             dest = msg_json['dest']
             if report_type == 'source':
@@ -785,7 +1133,7 @@ class CentralizedController(MqttClient):
         msg = message.payload
         logging.info("Process topic {}, payload: {}".format(topic, msg))
         try:
-            msg_json = yaml.safe_load(msg)
+            msg_json = self.decode_payload(message)
             obj = self.db.update_container_monitor(plan=self.planner_type, **msg_json)
             if obj is None:
                 logging.warn("Cannot find the container")
@@ -832,7 +1180,8 @@ if __name__ == '__main__':
     parser.add_argument(
         '--migrate_method',
         type=str,
-        help="Migrate method, either non_live_migration, or pre_copy.",
+        help="Migrate method, either non_live_migration, pre_copy or "
+            "pipelined_pre_copy.",
         default=Constants.PRE_COPY)
     parser.add_argument(
         '--planner',
@@ -841,6 +1190,47 @@ if __name__ == '__main__':
             format(Constants.OPTIMIZED_PLAN, Constants.NEAREST_PLAN,
                 Constants.RANDOM_PLAN),
         default=Constants.NEAREST_PLAN)
+    parser.add_argument(
+        '--sql_profile',
+        type=str,
+        help="Enable SQL profiling, the profile is written to this JSON "
+            "file on SIGUSR1 and at exit.",
+        default=None)
+    parser.add_argument(
+        '--state_file',
+        type=str,
+        help="Periodically save the controller state to this file.",
+        default=None)
+    parser.add_argument(
+        '--state_interval',
+        type=float,
+        help="Seconds between two saves of the controller state.",
+        default=5.0)
+    parser.add_argument(
+        '--warm_start',
+        help="Keep the database and reload the state of --state_file.",
+        action='store_true')
+    parser.add_argument(
+        '--monitor_policy',
+        type=str,
+        choices=['merge', 'drop', 'none'],
+        help="none (default) processes every RSSI report in order. With "
+            "merge or drop, the reports of a user received while its "
+            "previous ones are processed are merged into one batch, or "
+            "dropped.",
+        default='none')
+    parser.add_argument(
+        '--stage_top_k',
+        type=int,
+        help="Likely destinations where the snapshot of a service is staged "
+            "before its pipelined pre-copy, 0 disables staging. Default: 2",
+        default=2)
+    parser.add_argument(
+        '--stage_budget',
+        type=float,
+        help="Average rate of the snapshots staged by an edge in Mbps. "
+            "Default: 20",
+        default=20)
     args = parser.parse_args()
 
     edge_nodes = DiscoveryYaml(args.profile_file)
@@ -865,22 +1255,79 @@ if __name__ == '__main__':
     version = check_output(cmd)
     broker_ip = edge_nodes.get_centre_ip()
     logging.info("Start centralized_controller version {}".format(version))
-    check_swap_file(args.database_file, "-l")
-    database = db.DBCentral(database=args.database_file)
+    warm_start = args.warm_start and args.state_file is not None
+    if not warm_start:
+        check_swap_file(args.database_file, "-l")
+    database = db.DBCentral(database=args.database_file,
+                            profile_sql=args.sql_profile is not None)
     server = CentralizedController(broker_ip, Constants.BROKER_PORT, database, \
-        planner=args.planner, migrate_method=args.migrate_method)
+        planner=args.planner, migrate_method=args.migrate_method,
+        monitor_policy=None if args.monitor_policy == 'none'
+            else args.monitor_policy,
+        stage_top_k=args.stage_top_k, stage_budget=args.stage_budget)
+    snapshotter = None
+    if args.state_file is not None:
+        if warm_start:
+            server.warm_start(args.state_file)
+        snapshotter = controller_state.StateSnapshotter(
+            server.serialized(server.get_state), args.state_file,
+            args.state_interval)
+        snapshotter.start()
     sys.excepthook = my_exception_handler
-    def quit_gracefully(*args):
+    # The profiler lock may be held by the interrupted thread, so the
+    # signal handlers only request a dump from this thread
+    dump_request = threading.Event()
+    dump_done = threading.Event()
+    def run_profile_dumper():
+        while True:
+            dump_request.wait()
+            dump_request.clear()
+            try:
+                database.profiler.dump(args.sql_profile)
+            except Exception:
+                logging.error("Cannot dump the SQL profile: {}".format(
+                    traceback.format_exc()))
+            dump_done.set()
+
+    if database.profiler is not None:
+        dumper = threading.Thread(target=run_profile_dumper,
+                                  name='sql_profile_dumper')
+        dumper.daemon = True
+        dumper.start()
+
+    def request_sql_profile(*unused):
+        dump_request.set()
+
+    def dump_sql_profile(timeout=10):
+        if database.profiler is not None:
+            dump_done.clear()
+            dump_request.set()
+            dump_done.wait(timeout)
+
+    def save_state():
+        if snapshotter is not None:
+            snapshotter.stop()
+            snapshotter.save()
+
+    def quit_gracefully(*unused):
         logging.info("Receive SIGTERM signal")
         server.loop_stop(force=True)
+        server.scheduler.stop()
+        if server.mailbox is not None:
+            server.mailbox.stop()
+        save_state()
         server.db.close()
+        dump_sql_profile()
         sys.exit(0)
 
     signal.signal(signal.SIGTERM, quit_gracefully)
+    signal.signal(signal.SIGUSR1, request_sql_profile)
 
     try:
         server.loop_forever(retry_first_connection=True)
     except KeyboardInterrupt:
         server.loop_stop(force=True)
         print("Saving database")
+        save_state()
         server.db.close()
+        dump_sql_profile()
@@ -0,0 +1,383 @@
+"""Content-addressed store of memory pages on an edge.
+
+The destination of a migration often holds pages identical to the ones the
+source is about to send: zero pages, pages of the same container image, or
+pages of an earlier visit of the same service. Pages are stored once,
+appended to segment files, and evicted in LRU order when the store exceeds
+its disk budget.
+
+An append-only log holds one record per stored, used or evicted chunk, so
+that the chunks and their LRU order are reloaded without reading the
+segments. The log is rewritten once it holds many stale records. A segment
+is removed once all its chunks are evicted, and compacted, its live chunks
+copied to the current segment, when the segments hold too many evicted
+chunks.
+
+Example::
+
+    store = ChunkStore('/tmp/chunk_store', budget=2 << 30)
+    digests = chunk_digests(data)
+    store.put(digests[0], data[:PAGE_SIZE])
+    store.get(digests[0])
+"""
+import os
+import time
+import shutil
+import struct
+import hashlib
+import logging
+import threading
+import collections
+
+from page_diff import PAGE_SIZE, map_file, is_pages_file
+
+DIGEST_SIZE = 20
+
+# digest, segment, offset, length. A length of 0 marks an evicted chunk
+RECORD = struct.Struct('!20sIQI')
+LOG_NAME = 'index.log'
+SEGMENT_SUFFIX = '.seg'
+
+def chunk_digests(data, chunk_size=PAGE_SIZE):
+    """Returns the SHA-1 of each chunk of `data`, the last one may be
+    shorter."""
+    return [hashlib.sha1(data[i:i + chunk_size]).digest()
+            for i in range(0, len(data), chunk_size)]
+
+def file_digests(path, chunk_size=PAGE_SIZE):
+    return chunk_digests(map_file(path), chunk_size)
+
+class ChunkStore(object):
+    """Chunks on disk, keyed by digest, with a LRU disk budget in byte.
+
+    The chunks used are logged by batches of `touch_batch` chunks, and by
+    flush(), which keeps their LRU order across restarts.
+
+    The lock guards the index. The write lock serializes the appends to the
+    current segment and to the log, and the compactions; it is taken before
+    the lock. The chunks are read outside of both.
+    """
+    def __init__(self, folder, budget=2 << 30, touch_batch=256,
+                 segment_size=64 << 20):
+        self.folder = folder
+        self.budget = budget
+        self.touch_batch = touch_batch
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        # digest -> (segment, offset, length), least recently used first
+        self.index = collections.OrderedDict()
+        # segment -> bytes of its file, and of its chunks still indexed
+        self.segments = {}
+        self.live = collections.Counter()
+        # digests used since they were logged
+        self.touched = set()
+        self.size = 0
+        self.disk = 0
+        self.evicted = 0
+        self.compacted = 0
+        self.segment = 0
+        self.segment_file = None
+        self.log_file = None
+        self.log_records = 0
+        self.load()
+
+    def get_path(self, segment):
+        return os.path.join(self.folder,
+                            '{:08d}{}'.format(segment, SEGMENT_SUFFIX))
+
+    def load(self):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.endswith(SEGMENT_SUFFIX):
+                self.segments[int(name[:-len(SEGMENT_SUFFIX)])] = \
+                    os.path.getsize(path)
+            elif os.path.isdir(path):
+                # one file per chunk of the former layout
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.endswith('.tmp'):
+                os.remove(path)
+        log_path = os.path.join(self.folder, LOG_NAME)
+        if os.path.isfile(log_path):
+            with open(log_path, 'rb') as f:
+                log = f.read()
+            # a record cut by a crash is ignored
+            self.log_records = len(log) // RECORD.size
+            for i in range(0, len(log) - RECORD.size + 1, RECORD.size):
+                digest, segment, offset, length = RECORD.unpack_from(log, i)
+                self.index.pop(digest, None)
+                if length > 0 and offset + length <= \
+                        self.segments.get(segment, 0):
+                    self.index[digest] = (segment, offset, length)
+        for segment, _, length in self.index.values():
+            self.live[segment] += length
+            self.size += length
+        self.disk = sum(self.segments.values())
+        if self.segments:
+            self.segment = max(self.segments)
+        with self.write_lock:
+            for segment in list(self.segments):
+                if self.live[segment] == 0 and segment != self.segment:
+                    self.remove_segment(segment)
+            if self.log_records > 2*len(self.index) + 4096:
+                self.rewrite_log()
+            with self.lock:
+                evicted = self.evict()
+            self.drop(evicted)
+        logging.info("Chunk store {}: {} chunks, {} bytes in {} "
+                     "segments".format(self.folder, len(self.index),
+                                       self.size, len(self.segments)))
+
+    def __contains__(self, digest):
+        with self.lock:
+            return digest in self.index
+
+    def __len__(self):
+        with self.lock:
+            return len(self.index)
+
+    def touch(self, digest):
+        """Marks `digest` as the most recently used, under the lock.
+
+        Returns:
+            list: digests to log as used now.
+        """
+        self.index[digest] = self.index.pop(digest)
+        self.touched.add(digest)
+        if len(self.touched) < self.touch_batch:
+            return []
+        return self.take_touched()
+
+    def take_touched(self):
+        # in LRU order, so that the log keeps it
+        touched = [d for d in self.index if d in self.touched]
+        self.touched.clear()
+        return touched
+
+    def log_used(self, digests):
+        if not digests:
+            return
+        with self.write_lock:
+            with self.lock:
+                records = [(d,) + self.index[d] for d in digests
+                           if d in self.index]
+            self.append_log(records)
+
+    def flush(self):
+        """Logs the chunks used."""
+        with self.lock:
+            touched = self.take_touched()
+        self.log_used(touched)
+
+    def read(self, entry):
+        segment, offset, length = entry
+        try:
+            with open(self.get_path(segment), 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+        except (IOError, OSError):
+            return None
+        return data if len(data) == length else None
+
+    def get(self, digest):
+        """Returns the chunk `digest`, None if it is not stored."""
+        with self.lock:
+            entry = self.index.get(digest, None)
+            if entry is None:
+                return None
+            touched = self.touch(digest)
+        self.log_used(touched)
+        while True:
+            data = self.read(entry)
+            if data is not None:
+                return data
+            with self.lock:
+                current = self.index.get(digest, None)
+                if current == entry:
+                    # lost
+                    self.unindex(digest)
+                    return None
+            if current is None:
+                return None
+            # moved by a compaction meanwhile
+            entry = current
+
+    def unindex(self, digest):
+        """Drops `digest` from the index, under the lock."""
+        segment, _, length = self.index.pop(digest)
+        self.size -= length
+        self.live[segment] -= length
+        self.touched.discard(digest)
+
+    def put(self, digest, data):
+        with self.lock:
+            stored = digest in self.index
+            if stored:
+                touched = self.touch(digest)
+        if stored:
+            self.log_used(touched)
+            return
+        with self.write_lock:
+            with self.lock:
+                if digest in self.index:
+                    # stored by another thread
+                    return
+            entry = self.append(data)
+            self.append_log([(digest,) + entry])
+            with self.lock:
+                self.index[digest] = entry
+                self.size += len(data)
+                self.live[entry[0]] += len(data)
+                evicted = self.evict()
+            self.drop(evicted)
+
+    def append(self, data):
+        """Appends `data` to the current segment, under the write lock.
+
+        Returns:
+            tuple: segment, offset, length.
+        """
+        end = self.segments.get(self.segment, 0)
+        if end > 0 and end + len(data) > self.segment_size:
+            if self.segment_file is not None:
+                self.segment_file.close()
+                self.segment_file = None
+            self.segment += 1
+            end = 0
+        if self.segment_file is None:
+            self.segment_file = open(self.get_path(self.segment), 'ab')
+        self.segment_file.write(data)
+        # the chunks are read through other files
+        self.segment_file.flush()
+        self.segments[self.segment] = end + len(data)
+        self.disk += len(data)
+        return self.segment, end, len(data)
+
+    def append_log(self, records):
+        """Logs (digest, segment, offset, length) records, under the write
+        lock."""
+        if self.log_file is None:
+            self.log_file = open(os.path.join(self.folder, LOG_NAME), 'ab')
+        self.log_file.write(b''.join(RECORD.pack(*r) for r in records))
+        self.log_file.flush()
+        self.log_records += len(records)
+        if self.log_records > 2*len(self.index) + 4096:
+            self.rewrite_log()
+
+    def rewrite_log(self):
+        """Rewrites the log with the indexed chunks in LRU order, under the
+        write lock."""
+        with self.lock:
+            records = [(d,) + entry for d, entry in self.index.items()]
+        path = os.path.join(self.folder, LOG_NAME)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(b''.join(RECORD.pack(*r) for r in records))
+        os.rename(path + '.tmp', path)
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        self.log_records = len(records)
+
+    def evict(self):
+        """Drops the least recently used chunks over the budget from the
+        index, under the lock.
+
+        Returns:
+            list: digests of the evicted chunks.
+        """
+        evicted = []
+        while self.size > self.budget and self.index:
+            digest = next(iter(self.index))
+            self.unindex(digest)
+            self.evicted += 1
+            evicted.append(digest)
+        return evicted
+
+    def drop(self, evicted):
+        """Logs the evicted chunks, removes the segments left empty and
+        compacts the others while the evicted chunks take more than a
+        segment over the budget, under the write lock."""
+        if not evicted:
+            return
+        self.append_log([(d, 0, 0, 0) for d in evicted])
+        with self.lock:
+            empty = [s for s in self.segments
+                     if self.live[s] == 0 and s != self.segment]
+        for segment in empty:
+            self.remove_segment(segment)
+        while self.disk > self.budget + self.segment_size:
+            with self.lock:
+                candidates = [(self.live[s] / float(size), s)
+                              for s, size in self.segments.items()
+                              if s != self.segment and size > 0]
+            if not candidates:
+                break
+            self.compact(min(candidates)[1])
+
+    def compact(self, segment):
+        """Copies the live chunks of `segment` to the current segment and
+        removes it, under the write lock."""
+        with self.lock:
+            chunks = [(d, entry) for d, entry in self.index.items()
+                      if entry[0] == segment]
+        for digest, entry in chunks:
+            data = self.read(entry)
+            if data is None:
+                continue
+            moved = self.append(data)
+            with self.lock:
+                if self.index.get(digest, None) == entry:
+                    # keeps its place in the LRU order
+                    self.index[digest] = moved
+                    self.live[segment] -= entry[2]
+                    self.live[moved[0]] += entry[2]
+        self.remove_segment(segment)
+        self.compacted += 1
+        # the records of the moved chunks keep their LRU order
+        self.rewrite_log()
+
+    def remove_segment(self, segment):
+        """Removes a segment file, under the write lock."""
+        try:
+            os.remove(self.get_path(segment))
+        except OSError:
+            pass
+        with self.lock:
+            self.disk -= self.segments.pop(segment, 0)
+            for digest in [d for d, entry in self.index.items()
+                           if entry[0] == segment]:
+                self.unindex(digest)
+            self.live.pop(segment, None)
+
+    def add_file(self, path, chunk_size=PAGE_SIZE):
+        """Stores the chunks of `path`, returns the number of new chunks."""
+        data = map_file(path)
+        added = 0
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i:i + chunk_size].tobytes()
+            digest = hashlib.sha1(chunk).digest()
+            if digest not in self:
+                added += 1
+            self.put(digest, chunk)
+        return added
+
+    def add_folder(self, folder):
+        """Stores the chunks of the pages-*.img files of `folder`."""
+        start_ = time.time()
+        added = 0
+        for name in os.listdir(folder):
+            if is_pages_file(name):
+                added += self.add_file(os.path.join(folder, name))
+        self.flush()
+        logging.info("Chunk store: {} new chunks from {} in {}s".format(
+            added, folder, time.time() - start_))
+        return added
+
+    def get_stats(self):
+        with self.lock:
+            return {'chunks': len(self.index), 'size': self.size,
+                    'budget': self.budget, 'evicted': self.evicted,
+                    'segments': len(self.segments), 'disk': self.disk,
+                    'compacted': self.compacted}
@@ -0,0 +1,236 @@
+"""Compact binary encoding of the monitor/eu and monitor/service reports.
+
+Every end user reports its RSSI scan every few seconds and every request it
+sends to its service. As JSON, each report repeats keys such as nearbyAP,
+SSID, BSSID or processTime[ms]. The compact encoding packs the same reports
+with ``struct``, without keys:
+
+* the centralized controller interns BTS names and publishes the table, the
+  codebook, retained on codec/monitor;
+* an end user that received a codebook sends the BTS ids and the BSSIDs as
+  6 bytes; a BTS missing from the codebook is sent inline;
+* the controller decodes a compact payload to the same dict as the JSON one.
+
+A compact payload starts with the byte 0xC1, which never starts a UTF-8
+JSON or YAML payload. Reports with values that cannot be packed fall back to
+JSON.
+
+Layout, in network byte order::
+
+    header:  magic (B), kind (B), codebook generation (H),
+             end_user, service_name (B length + UTF-8)
+    RSSI:    count (B), count x [bts id (H), BSSID (6s), level (f)]
+    service: startTime[ns] (d), endTime[ns] (d), processTime[ms] (d),
+             sentSize[B] (I), bts id (H), BSSID (6s)
+
+An unknown bts id is 0xFFFF followed by the name (B length + UTF-8).
+"""
+import os
+import json
+import random
+import struct
+import threading
+import binascii
+
+import Constants
+
+MAGIC = 0xC1
+RSSI_REPORT = 1
+SERVICE_REPORT = 2
+INLINE_ID = 0xFFFF
+
+HEADER = struct.Struct('!BBH')
+LENGTH = struct.Struct('!B')
+BTS_ID = struct.Struct('!H')
+AP = struct.Struct('!6sf')
+SERVICE = struct.Struct('!dddI')
+BSSID = struct.Struct('!6s')
+
+START_TIME = 'startTime[ns]'
+END_TIME = 'endTime[ns]'
+PROCESS_TIME = 'processTime[ms]'
+SENT_SIZE = 'sentSize[B]'
+
+class CodecError(ValueError):
+    pass
+
+def is_compact(payload):
+    return len(payload) > 0 and bytearray(payload[:1])[0] == MAGIC
+
+def pack_bssid(bssid):
+    raw = binascii.unhexlify(bssid.replace(':', ''))
+    if len(raw) != 6:
+        raise CodecError("Invalid BSSID {}".format(bssid))
+    return raw
+
+def unpack_bssid(raw):
+    return ':'.join('{:02x}'.format(b) for b in bytearray(raw))
+
+def pack_str(value):
+    raw = value.encode('utf-8') if not isinstance(value, bytes) else value
+    if len(raw) > 255:
+        raise CodecError("String too long {}".format(value))
+    return LENGTH.pack(len(raw)) + raw
+
+def unpack_str(payload, offset):
+    length = LENGTH.unpack_from(payload, offset)[0]
+    offset += LENGTH.size
+    value = payload[offset:offset + length]
+    if len(value) != length:
+        raise CodecError("Truncated payload")
+    value = value.decode('utf-8')
+    try:
+        value = str(value)
+    except UnicodeEncodeError:
+        pass
+    return value, offset + length
+
+def next_generation(path):
+    """Returns the generation following the one stored in `path`, and
+    stores it.
+
+    Successive restarts get distinct generations, up to 0xFFFF restarts. A
+    random generation is picked when `path` holds none.
+    """
+    try:
+        with open(path) as f:
+            generation = (int(f.read()) + 1) % INLINE_ID
+    except (IOError, ValueError):
+        generation = random.randint(0, INLINE_ID - 1)
+    with open(path + '.tmp', 'w') as f:
+        f.write(str(generation))
+    os.rename(path + '.tmp', path)
+    return generation
+
+class Codebook(object):
+    """Interned BTS names, shared by the controller and the end users.
+
+    Ids are only appended, so a codebook received before new BTS were
+    registered stays valid. A restarted controller picks a new generation,
+    see next_generation, and payloads encoded with another generation are
+    rejected.
+    """
+    def __init__(self, names=(), generation=None):
+        if generation is None:
+            generation = random.randint(0, 0xFFFE)
+        self.generation = generation
+        self.lock = threading.Lock()
+        self.names = []
+        self.ids = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        """Interns `name` and returns its id."""
+        with self.lock:
+            bts_id = self.ids.get(name, None)
+            if bts_id is None:
+                bts_id = len(self.names)
+                self.names.append(name)
+                self.ids[name] = bts_id
+            return bts_id
+
+    def get_json(self):
+        with self.lock:
+            return {'generation': self.generation, 'bts': list(self.names)}
+
+    @staticmethod
+    def from_json(obj):
+        return Codebook(obj['bts'], obj['generation'])
+
+    def pack_bts(self, name):
+        bts_id = self.ids.get(name, None)
+        if bts_id is None:
+            return BTS_ID.pack(INLINE_ID) + pack_str(name)
+        return BTS_ID.pack(bts_id)
+
+    def unpack_bts(self, payload, offset):
+        bts_id = BTS_ID.unpack_from(payload, offset)[0]
+        offset += BTS_ID.size
+        if bts_id == INLINE_ID:
+            return unpack_str(payload, offset)
+        if bts_id >= len(self.names):
+            raise CodecError("Unknown BTS id {}".format(bts_id))
+        return self.names[bts_id], offset
+
+    def pack_header(self, kind, report):
+        return HEADER.pack(MAGIC, kind, self.generation) + \
+            pack_str(report[Constants.END_USER]) + \
+            pack_str(report[Constants.SERVICE_NAME])
+
+    def encode_rssi(self, report):
+        """Encodes a monitor/eu report, see MobileEUTestApp.report_rssi."""
+        aps = report[Constants.NEARBY_AP]
+        parts = [self.pack_header(RSSI_REPORT, report), LENGTH.pack(len(aps))]
+        for ap in aps:
+            parts.append(self.pack_bts(ap[Constants.SSID]))
+            parts.append(AP.pack(pack_bssid(ap[Constants.BSSID]),
+                                 ap[Constants.RSSI]))
+        return b''.join(parts)
+
+    def encode_service(self, report):
+        """Encodes a monitor/service report, see
+        MobileEUTestApp.report_service."""
+        return self.pack_header(SERVICE_REPORT, report) + \
+            SERVICE.pack(report[START_TIME], report[END_TIME],
+                         report[PROCESS_TIME], report[SENT_SIZE]) + \
+            self.pack_bts(report[Constants.ASSOCIATED_SSID]) + \
+            pack_bssid(report[Constants.ASSOCIATED_BSSID])
+
+    def encode(self, report):
+        """Encodes a report, or returns its JSON if it cannot be packed."""
+        try:
+            if Constants.NEARBY_AP in report:
+                return self.encode_rssi(report)
+            return self.encode_service(report)
+        except (CodecError, KeyError, TypeError, ValueError,
+                struct.error, binascii.Error):
+            return json.dumps(report)
+
+    def decode(self, payload):
+        """Decodes a compact payload to the dict of its JSON encoding.
+
+        Raises:
+            CodecError: unknown generation or invalid payload.
+        """
+        try:
+            return self.unpack(payload)
+        except (struct.error, UnicodeDecodeError, IndexError) as e:
+            raise CodecError("Invalid compact payload: {}".format(e))
+
+    def unpack(self, payload):
+        magic, kind, generation = HEADER.unpack_from(payload, 0)
+        if magic != MAGIC:
+            raise CodecError("Not a compact payload")
+        if generation != self.generation:
+            raise CodecError("Unknown codebook generation {}".format(
+                generation))
+        end_user, offset = unpack_str(payload, HEADER.size)
+        service_name, offset = unpack_str(payload, offset)
+        report = {Constants.END_USER: end_user,
+                  Constants.SERVICE_NAME: service_name}
+        if kind == RSSI_REPORT:
+            count = LENGTH.unpack_from(payload, offset)[0]
+            offset += LENGTH.size
+            aps = []
+            for _ in range(count):
+                ssid, offset = self.unpack_bts(payload, offset)
+                bssid, level = AP.unpack_from(payload, offset)
+                offset += AP.size
+                aps.append({Constants.SSID: ssid,
+                            Constants.BSSID: unpack_bssid(bssid),
+                            Constants.RSSI: level})
+            report[Constants.NEARBY_AP] = aps
+        elif kind == SERVICE_REPORT:
+            values = SERVICE.unpack_from(payload, offset)
+            offset += SERVICE.size
+            for key, value in zip((START_TIME, END_TIME, PROCESS_TIME,
+                                   SENT_SIZE), values):
+                report[key] = value
+            ssid, offset = self.unpack_bts(payload, offset)
+            report[Constants.ASSOCIATED_SSID] = ssid
+            report[Constants.ASSOCIATED_BSSID] = unpack_bssid(
+                BSSID.unpack_from(payload, offset)[0])
+        else:
+            raise CodecError("Unknown report kind {}".format(kind))
+        return report
@@ -0,0 +1,142 @@
+"""Snapshots of the centralized controller state for warm restarts.
+
+The controller keeps the migration state machine of each user, the pending
+handover and migration plans, the estimated migration times and the latest
+RSSI samples in memory. This module writes them periodically to a local file,
+atomically, so that a restarted controller resumes planning right away
+instead of relearning them.
+
+Example::
+
+    snapshotter = StateSnapshotter(server.get_state, 'centre_state.pkl')
+    snapshotter.start()
+    ...
+    server.warm_start('centre_state.pkl')
+"""
+import os
+import time
+import pickle
+import logging
+import threading
+
+from planner import PlanResult
+
+#: Bumped whenever the layout of the state changes
+STATE_VERSION = 1
+
+def capture_state(database, migration_state, migrating_plan, handover_plan):
+    """Copies the controller state into plain types.
+
+    The dicts are copied first, so that handlers and timers updating them
+    meanwhile do not break the snapshot.
+    """
+    plans = {}
+    for user, stored_obj in dict(migrating_plan).items():
+        plans[user] = {'plan': tuple(stored_obj['plan']),
+                       'service': dict(stored_obj['service'])}
+    handovers = {user: dict(handover_json) for user, handover_json in
+                 dict(handover_plan).items()}
+    return {'version': STATE_VERSION,
+            'migration_state': dict(migration_state),
+            'migrating_plan': plans,
+            'handover_plan': handovers,
+            'database': database.get_warm_state()}
+
+def restore_state(database, state):
+    """Restores a state returned by capture_state.
+
+    Returns:
+        tuple: (migration_state, migrating_plan, handover_plan) or None if
+        the state has another version.
+    """
+    if state.get('version', None) != STATE_VERSION:
+        logging.error("Unsupported state version {}".format(
+            state.get('version', None)))
+        return None
+    database.restore_warm_state(state['database'])
+    migrating_plan = {}
+    for user, stored_obj in state['migrating_plan'].items():
+        migrating_plan[user] = {'plan': PlanResult(*stored_obj['plan']),
+                                'service': stored_obj['service']}
+    return (state['migration_state'], migrating_plan,
+            state['handover_plan'])
+
+def save_state(path, data):
+    """Writes pickled state `data` to `path` atomically.
+
+    The data is written to a temporary file in the same directory, which
+    then replaces `path`, so a crash never leaves a truncated state file.
+    """
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+def load_state(path):
+    """Reads a state written by save_state, None if there is none."""
+    if not os.path.isfile(path):
+        logging.info("No state file {}".format(path))
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        # a corrupted pickle can raise almost any exception
+        logging.error("Cannot load state file {}: {}".format(path, e))
+        return None
+
+class StateSnapshotter(threading.Thread):
+    """Saves the state returned by `get_state` every `interval` seconds.
+
+    A snapshot identical to the previous one is not written again.
+    """
+    def __init__(self, get_state, path, interval=5.0):
+        super(StateSnapshotter, self).__init__(name='state_snapshotter')
+        self.daemon = True
+        self.get_state = get_state
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.last_data = None
+        self.written = 0
+        self.skipped = 0
+        self.last_duration = 0.0 # in second
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.save()
+            except Exception as e:
+                logging.error("Cannot save state to {}: {}".format(self.path,
+                                                                  e))
+
+    def save(self):
+        """Saves the state now.
+
+        Returns:
+            bool: True if the state was written, False if unchanged.
+        """
+        with self.lock:
+            start = time.time()
+            data = pickle.dumps(self.get_state(), pickle.HIGHEST_PROTOCOL)
+            if data == self.last_data:
+                self.skipped += 1
+                return False
+            save_state(self.path, data)
+            self.last_data = data
+            self.written += 1
+            self.last_duration = time.time() - start
+            logging.debug("Save state to {} in {}s".format(
+                self.path, self.last_duration))
+            return True
+
+    def stop(self):
+        self.stopped.set()
+
+    def get_stats(self):
+        return {'written': self.written,
+                'skipped': self.skipped,
+                'last_duration': self.last_duration}
@@ -6,6 +6,8 @@ import os
 import logging
 import argparse
 
+import page_diff
+
 def bsdiff_(old, new, patch, filename, verbose):
     out = call(['bsdiff', old + filename, new + filename,\
             patch + filename])
@@ -44,6 +46,31 @@ def xdelta_patch(old, new, patch, filename, verbose):
     logging.debug("xdelta patch {} {} {}. Output: {}".format(patchfile,\
                 oldfile, newfile, ret))
 
+def page_delta(old, new, patch, filename, verbose):
+    count = page_diff.diff_file(old + filename, new + filename,
+                                patch + filename, index=page_diff.INDEX)
+    logging.debug("page delta {} {} {}. Changed pages: {}".format(
+        old + filename, new + filename, patch + filename, count))
+
+def page_patch(old, new, patch, filename, verbose):
+    page_diff.patch_file(old + filename, new + filename, patch + filename)
+    logging.debug("page patch {} {} {}".format(patch + filename,
+                  old + filename, new + filename))
+
+def delta_file(old, new, patch, filename, verbose):
+    """Diffs the memory pages in process, the other images with xdelta."""
+    if page_diff.is_pages_file(filename):
+        page_delta(old, new, patch, filename, verbose)
+    else:
+        xdelta_delta(old, new, patch, filename, verbose)
+
+def patch_file(old, new, patch, filename, verbose):
+    """Applies a patch of delta_file or of xdelta_delta."""
+    if page_diff.is_page_patch(patch + filename):
+        page_patch(old, new, patch, filename, verbose)
+    else:
+        xdelta_patch(old, new, patch, filename, verbose)
+
 def create_bsdiff(old, new, patch, verbose):
     num_cores = cpu_count()
     Parallel(n_jobs=num_cores)(delayed(bsdiff_)(old, new, patch, i, verbose)\
@@ -54,15 +81,22 @@ def create_bspatch(old, new, patch, verbose):
     Parallel(n_jobs=num_cores)(delayed(bspatch_)(old, new, patch, i, verbose)\
                 for i in os.listdir(old))
 
-def create_xdelta_diff(old, new, patch, verbose, is_parallel=False):
+def create_xdelta_diff(old, new, patch, verbose, is_parallel=False,
+                       pages=False):
+    """Diffs the files of new against old with xdelta, the pages-*.img
+    files with the page differ if `pages` is True.
+
+    The page differ is opt-in until benchmark_diff.py has been run against
+    xdelta and its numbers are committed."""
     if is_parallel:
         num_cores = cpu_count()
     else:
         num_cores = 1
+    delta = delta_file if pages else xdelta_delta
     with parallel_backend('threading', n_jobs=num_cores):
         Parallel()(
     #Parallel(n_jobs=num_cores)(
-        delayed(xdelta_delta)(old, new, patch, i, verbose)\
+        delayed(delta)(old, new, patch, i, verbose)\
                 for i in os.listdir(new)
                     if (os.path.isfile(os.path.join(new, i)) and\
                         'tar.gz.img' not in i)
@@ -73,7 +107,7 @@ def create_xdelta_patch(old, new, patch, verbose):
     with parallel_backend('threading', n_jobs=num_cores):
         Parallel()(
     #Parallel(n_jobs=num_cores)(
-        delayed(xdelta_patch)(old, new, patch, i, verbose)\
+        delayed(patch_file)(old, new, patch, i, verbose)\
                 for i in os.listdir(patch) if os.path.isfile(os.path.join(patch, i)))
 
 if __name__ == '__main__':
@@ -102,9 +136,14 @@ if __name__ == '__main__':
         type=str,
         help='Command: [create_xdelta_diff, create_xdelta_patch]',
         required=True)
+    parser.add_argument(
+        '--pages',
+        help='Diff the memory images with the page differ',
+        action='store_true')
     args = parser.parse_args()
     if args.cmd == 'create_xdelta_diff':
-        create_xdelta_diff(args.old, args.new, args.patch, args.verbose)
+        create_xdelta_diff(args.old, args.new, args.patch, args.verbose,
+                           pages=args.pages)
     elif args.cmd == 'create_xdelta_patch':
         create_xdelta_patch(args.old, args.new, args.patch, args.verbose)
 
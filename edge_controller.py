@@ -13,7 +13,7 @@ import yaml
 import docker
 
 import Constants
-from mqtt_protocol import MqttClient
+from mqtt_protocol import MqttClient, STRING
 from migrate_node import MigrateNode, MigrateRecord
 from migrate_source import MigrateSource, MigrateSourceCallback
 from migrate_dest import MigrateDest, MigrateDestCallback
@@ -34,6 +34,10 @@ from discovery_edge import DiscoveryYaml
 
 ready = False
 
+# Required keys of the payloads, see mqtt_protocol.validate
+MIGRATE_SCHEMA = {Constants.END_USER: STRING, Constants.SERVER_NAME: STRING}
+DEPLOY_SCHEMA = {Constants.END_USER: STRING}
+
 
 def wait_ready():
     while not ready:
@@ -120,6 +124,8 @@ class ControllerServer(MqttClient, MigrateSourceCallback, MigrateDestCallback):
                                              self.server_info['server_name'])
         self.my_migrate = '{}/{}'.format(Constants.MIGRATE,
                                          self.server_info['server_name'])
+        self.my_pre_stage = '{}/{}'.format(Constants.PRE_STAGE,
+                                           self.server_info['server_name'])
         self.my_destroy = '{}/{}'.format(Constants.DESTROY,
                                          self.server_info['server_name'])
         self.neighbor_edges = '{}/+'.format(Constants.LWT_EDGE)
@@ -129,6 +135,7 @@ class ControllerServer(MqttClient, MigrateSourceCallback, MigrateDestCallback):
         self.message_callback_add(self.my_pre_migrate,
                                   self.process_pre_migrate)
         self.message_callback_add(self.my_migrate, self.process_migrate)
+        self.message_callback_add(self.my_pre_stage, self.process_pre_stage)
         self.message_callback_add(self.my_destroy, self.process_destroy)
         self.message_callback_add(self.neighbor_edges,
                                   self.process_neighbor_off)
@@ -151,7 +158,7 @@ class ControllerServer(MqttClient, MigrateSourceCallback, MigrateDestCallback):
         client.subscribe([(self.my_deploy, 1), (self.my_migrate, 1),
                           (self.neighbor_edges, 1), (self.my_destroy, 1),
                           (Constants.UPDATED_SERVERS, 1),
-                          (self.my_pre_migrate, 1)])
+                          (self.my_pre_migrate, 1), (self.my_pre_stage, 1)])
 
     def register_to_centre(self):
         msg = '{}'.format(self.server_info)
@@ -166,6 +173,9 @@ class ControllerServer(MqttClient, MigrateSourceCallback, MigrateDestCallback):
         if service_json[Constants.MIGRATE_METHOD] == \
            Constants.NON_LIVE_MIGRATION:
             method = 'rsync'
+        elif service_json[Constants.MIGRATE_METHOD] == \
+           Constants.PIPELINED_PRE_COPY:
+            method = 'stream'
         docker_client = docker.from_env()
         container_img, container_port = get_container_for_service(service_name)
         container_name = service_name + end_user
@@ -280,7 +290,7 @@ class ControllerServer(MqttClient, MigrateSourceCallback, MigrateDestCallback):
         logging.info("process topic {}, payload: {}".format(topic, msg))
         payload = {}
         try:
-            service_json = yaml.safe_load(msg)
+            service_json = self.decode_payload(message, MIGRATE_SCHEMA)
             logging.info("service {}".format(service_json))
             pre_mig_service = MigrateNode(**service_json)
             if service_json[Constants.SERVER_NAME] != \
@@ -317,13 +327,34 @@ class ControllerServer(MqttClient, MigrateSourceCallback, MigrateDestCallback):
         except yaml.YAMLError:
             logging.error("Error parsing YAML msg {}".format(msg))
 
+    def process_pre_stage(self, client, userdata, message):
+        """Stages the snapshot of a local service at a likely destination
+        of its user."""
+        topic = message.topic
+        msg = message.payload
+        logging.info("process topic {}, payload: {}".format(topic, msg))
+        try:
+            service_json = self.decode_payload(message, MIGRATE_SCHEMA)
+            stage_service = MigrateNode(**service_json)
+            local_service = self.edge_services.get_service(
+                stage_service.end_user, stage_service.service_name)
+            if local_service is None:
+                logging.warn("Cannot stage {}, service not found".
+                             format(stage_service.get_container_name()))
+                return
+            stage_service.method = local_service.method
+            self.source_queue.put(('stage',
+                                   stage_service.get_migrate_service()))
+        except yaml.YAMLError:
+            logging.error("Error parsing YAML msg {}".format(msg))
+
     def process_migrate(self, client, userdata, message):
         topic = message.topic
         msg = message.payload
         logging.info("process topic {}, payload: {}".format(topic, msg))
         # payload = {}
         try:
-            migrating_service_json = yaml.safe_load(msg)
+            migrating_service_json = self.decode_payload(message, MIGRATE_SCHEMA)
             logging.info("service {}".format(migrating_service_json))
             migrating_service = MigrateNode(**migrating_service_json)
             if migrating_service_json[Constants.SERVER_NAME] != \
@@ -363,7 +394,7 @@ class ControllerServer(MqttClient, MigrateSourceCallback, MigrateDestCallback):
         msg = message.payload
         logging.info("process topic {}, payload: {}".format(topic, msg))
         try:
-            service_json = yaml.safe_load(msg)
+            service_json = self.decode_payload(message, DEPLOY_SCHEMA)
             logging.info("request discovery a service {}".format(service_json))
             edge_service = self.start_edge_service(service_json)
             payload_json = get_json_from_object(edge_service)
@@ -381,7 +412,7 @@ class ControllerServer(MqttClient, MigrateSourceCallback, MigrateDestCallback):
         msg = message.payload
         logging.info("process topic {}, payload: {}".format(topic, msg))
         try:
-            service_json = yaml.safe_load(msg)
+            service_json = self.decode_payload(message)
             logging.info("request destroy a service {}".format(service_json))
             removing_service = MigrateNode(**service_json)
             if self.edge_services.find_index_service(removing_service) is None:
@@ -423,7 +454,7 @@ class ControllerServer(MqttClient, MigrateSourceCallback, MigrateDestCallback):
         msg = message.payload
         logging.info("process topic {}, payload: {}".format(topic, msg))
         try:
-            all_servers = yaml.safe_load(msg)
+            all_servers = self.decode_payload(message)
             is_registered = self.my_neighbors.update_my_neighbors(
                 self.server_info, all_servers)
             if not is_registered:
@@ -526,6 +557,13 @@ class ControllerServer(MqttClient, MigrateSourceCallback, MigrateDestCallback):
             obj['size_final_rsync'] = report.size_final_rsync
             obj['size_pre_rsync'] = report.size_pre_rsync
             obj['size_rsync'] = report.size_rsync
+            obj['rounds'] = report.rounds
+            obj['predicted_downtime'] = report.predicted_downtime
+            obj['downtime'] = report.downtime
+            obj['codec'] = report.codec
+            obj['size_sent'] = report.size_sent
+            obj['dedup_hit_ratio'] = report.dedup_hit_ratio
+            obj['queue_wait'] = report.queue_wait
         payload = json.dumps(obj)
         logging.info("Publish to topic {}: {}".format(topic, payload))
         self.publish(topic, payload)
@@ -554,6 +592,7 @@ class ControllerServer(MqttClient, MigrateSourceCallback, MigrateDestCallback):
         }
         if method != Constants.NON_LIVE_MIGRATION:
             obj['xdelta_dest'] = report.xdelta_dest
+        obj['queue_wait'] = report.queue_wait
         payload = json.dumps(obj)
         logging.info("Publish to topic {}: {}".format(topic, payload))
         self.publish(topic, payload)
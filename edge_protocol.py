@@ -115,6 +115,24 @@ def prepare_msg(msg_type, msg):
     msg = '{} {}'.format(msg_type, msg)
     return struct.pack('!i', len(msg)) + msg.encode()
 
+def recv_msg(sock):
+    """Reads a message of prepare_msg, None if the connection is closed."""
+    buf = ''
+    while len(buf) < 4:
+        data = sock.recv(4 - len(buf))
+        if not data:
+            return None
+        buf += data
+    length = struct.unpack('!i', buf)[0]
+    chunks = []
+    while length > 0:
+        data = sock.recv(min(length, 1 << 16))
+        if not data:
+            return None
+        chunks.append(data)
+        length -= len(data)
+    return ''.join(chunks)
+
 # Prepare message from JSON object
 def prepare_msg_json(msg_type, obj):
     return prepare_msg(msg_type, json.dumps(obj, separators=(',',':')))
@@ -1,5 +1,7 @@
 from __future__ import division
 
+import os
+import sys
 import argparse
 import collections
 
@@ -8,7 +10,10 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
 import simulated_mobile_eu_db as db
+from export_columnar import load_table
 
 RequestRecord = collections.namedtuple('RequestRecord',
                                        ['start', 'process_time', 'e2e_delay'])
@@ -40,15 +45,15 @@ def plot_delay(df, name='delay'):
 
 
 def main(args):
-    database = db.DBeu(database=args.file)
-    df = pd.read_sql_table(db.UserRequest.__tablename__, database.engine)
+    df = load_table(args.file, db.UserRequest.__tablename__,
+                    columns=['timestamp'])
     plot_request_per_interval(df)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '--file',
-        help="File name",
+        help="Database file name or its export directory",
         type=str,
         required=True)
     parser.add_argument(
@@ -22,7 +22,8 @@ import discovery_edge
 
 import placement
 from migrate_node import MigrateNode
-from mqtt_protocol import MqttClient
+from mqtt_protocol import MqttClient, STRING
+from compact_codec import Codebook
 from utilities import check_swap_file, get_default_interface
 from communication_models import log_rssi_model_real as log_rssi_model
 from communication_models import handover_constant
@@ -35,6 +36,9 @@ import datarate
 from mobility_models import SimpleRoundTripMoving, CircleTripMoving
 
 timeout = 40
+# Required keys of the handover payload, see mqtt_protocol.validate
+HANDOVER_SCHEMA = {Constants.NEXT_SSID: STRING, Constants.NEXT_BSSID: STRING}
+CODEC_SCHEMA = {'generation': int, 'bts': list}
 
 def try_connect_with_timeout(sock, addr, timeout, debug=logging):
     start = time.time()
@@ -233,6 +237,51 @@ class MobileDevice(object):
         self.moving.start_moving()
         self.app.run()
 
+class ReportBatcher(object):
+    """Accumulates the reports of one topic and publishes them together.
+
+    A batch is flushed once it has `max_size` reports, or `max_delay`
+    seconds after its oldest report, which bounds the ingest latency.
+
+    Args:
+        flush_cb (callable): called with the list of reports of a batch.
+    """
+    def __init__(self, flush_cb, max_size=5, max_delay=10.0):
+        self.flush_cb = flush_cb
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.reports = []
+        self.timer = None
+        self.batches = 0
+        self.count = 0
+
+    def add(self, report):
+        report = {k: v for k, v in report.items()
+                  if k not in (Constants.END_USER, Constants.SERVICE_NAME)}
+        report[Constants.BATCH_TIME] = time.time()
+        with self.lock:
+            self.reports.append(report)
+            if self.timer is None:
+                self.timer = threading.Timer(self.max_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+            full = len(self.reports) >= self.max_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            reports, self.reports = self.reports, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if len(reports) == 0:
+                return
+            self.batches += 1
+            self.count += len(reports)
+        self.flush_cb(reports)
+
 EU_STATE = type('Enum', (), {'INIT': 1, 'NORMAL': 2, 'MIGRATION': 3,
                              'HANDOVER': 4, 'TERMINATED':5})
 
@@ -248,6 +297,21 @@ class MobileEUTestApp(MqttClient):
         self.log = kwargs.get('log', logging.getLogger(self.end_user))
         self.device = kwargs.get('device', None)
         self.max_fail = kwargs.get('max_fail', 20)
+        # Encode monitor reports compactly once the codebook is received
+        self.compact = kwargs.get('compact', False)
+        self.codebook = None
+        # Publish monitor reports in batches of batch_size, at most
+        # batch_delay seconds after the oldest report
+        self.batchers = {}
+        batch_size = kwargs.get('batch_size', 1)
+        if batch_size > 1:
+            batch_delay = kwargs.get('batch_delay', 10.0)
+            for prefix in [Constants.MONITOR_EU, Constants.MONITOR_SERVICE]:
+                topic = '{}/{}'.format(prefix, self.end_user)
+                self.batchers[topic] = ReportBatcher(
+                    lambda reports, topic=topic: self.publish_batch(topic,
+                                                                    reports),
+                    batch_size, batch_delay)
         self.database_name = kwargs.get('database',
                                     'eu_{}_{}.db'.format(self.end_user,
                                                     self.service_name))
@@ -264,6 +328,8 @@ class MobileEUTestApp(MqttClient):
         self.message_callback_add(self.allocated_topic, self.process_allocated)
         self.message_callback_add(self.migrated_topic, self.process_migrated)
         self.message_callback_add(self.handover_topic, self.process_handover)
+        self.message_callback_add(Constants.MONITOR_CODEC,
+                                  self.process_codec)
         current_bts = self.device.get_current_bts()
         self.log.info(
             "\n***start simulate service:{}, name:{}, AP:{}@{}, broker:{}***\n".\
@@ -275,9 +341,35 @@ class MobileEUTestApp(MqttClient):
 
     def on_connect(self, client, userdata, flag, rc):
         self.log.info("Connected to broker with result code {}".format(rc))
-        self.subscribe([(self.allocated_topic, 1),
-                        (self.migrated_topic, 1),
-                        (self.handover_topic, 1)])
+        topics = [(self.allocated_topic, 1),
+                  (self.migrated_topic, 1),
+                  (self.handover_topic, 1)]
+        if self.compact:
+            topics.append((Constants.MONITOR_CODEC, 1))
+        self.subscribe(topics)
+
+    def encode_report(self, report):
+        if self.codebook is None:
+            return json.dumps(report)
+        return self.codebook.encode(report)
+
+    def send_report(self, topic, report):
+        batcher = self.batchers.get(topic, None)
+        if batcher is not None:
+            batcher.add(report)
+            return
+        payload = self.encode_report(report)
+        self.log.debug("Publish topic {}, report {}".format(topic, report))
+        self.publish(topic, payload)
+
+    def publish_batch(self, topic, reports):
+        batch = {Constants.END_USER: self.end_user,
+                 Constants.SERVICE_NAME: self.service_name,
+                 Constants.BATCH_SENT: time.time(),
+                 Constants.BATCH: reports}
+        self.log.debug("Publish topic {}, {} reports".format(topic,
+                                                             len(reports)))
+        self.publish(topic, json.dumps(batch))
 
     def try_connect_to_service(self, timeout):
         if self.service is None:
@@ -400,9 +492,7 @@ class MobileEUTestApp(MqttClient):
         report[Constants.ASSOCIATED_SSID] = current_bts[0]
         report[Constants.ASSOCIATED_BSSID] = current_bts[1]
         topic = '{}/{}'.format(Constants.MONITOR_SERVICE, self.end_user)
-        payload = json.dumps(report)
-        self.log.debug("Publish topic {}, payload {}".format(topic, payload))
-        self.publish(topic, payload)
+        self.send_report(topic, report)
 
     def report_rssi(self, nearby_aps):
         """
@@ -423,9 +513,7 @@ class MobileEUTestApp(MqttClient):
                   Constants.SERVICE_NAME: self.service_name}
         report[Constants.NEARBY_AP] = nearby_aps
         topic = '{}/{}'.format(Constants.MONITOR_EU, self.end_user)
-        payload = json.dumps(report)
-        self.log.debug("Publish topic {}, payload {}".format(topic, payload))
-        self.publish(topic, payload)
+        self.send_report(topic, report)
 
     def discovery_service(self):
         self.log.info("begin discover service {} for user {} to broker {}".
@@ -528,6 +616,8 @@ class MobileEUTestApp(MqttClient):
 
     def stop(self):
         self.state = EU_STATE.TERMINATED
+        for batcher in self.batchers.values():
+            batcher.flush()
         self.report_leaving()
         self.rssi_thread.join()
         self.stream_thread.join()
@@ -556,12 +646,23 @@ class MobileEUTestApp(MqttClient):
         self.publish(topic, payload)
 
     # MQTT Handlers ----------------------------------------------------------
+    def process_codec(self, client, userdata, message):
+        msg = message.payload
+        self.log.info("process topic {}, payload: {}".format(message.topic,
+                                                             msg))
+        try:
+            msg_json = self.decode_payload(message, CODEC_SCHEMA)
+            if msg_json is not None:
+                self.codebook = Codebook.from_json(msg_json)
+        except yaml.YAMLError:
+            logging.error("Error parsing YAML msg {}".format(msg))
+
     def process_handover(self, client, userdata, message):
         topic = message.topic
         msg = message.payload
         self.log.info("process topic {}, payload: {}".format(topic, msg))
         try:
-            msg_json = yaml.safe_load(msg)
+            msg_json = self.decode_payload(message, HANDOVER_SCHEMA)
             ssid = msg_json[Constants.NEXT_SSID]
             bssid = msg_json[Constants.NEXT_BSSID]
             self.database.add_event(self.end_user, 'handover', msg)
@@ -580,7 +681,7 @@ class MobileEUTestApp(MqttClient):
         msg = message.payload
         self.log.debug("process topic {}, payload: {}".format(topic, msg))
         try:
-            msg_json = yaml.safe_load(msg)
+            msg_json = self.decode_payload(message)
             self.service = MigrateNode(**msg_json)
             self.database.add_event(self.end_user, 'allocated', msg)
             self.device.change_service_cb(self.service.ip, self.service.port)
@@ -599,7 +700,7 @@ class MobileEUTestApp(MqttClient):
         msg = message.payload
         self.log.debug("process topic {}, payload: {}".format(topic, msg))
         try:
-            service_json = yaml.safe_load(msg)
+            service_json = self.decode_payload(message)
             self.service = MigrateNode(**service_json)
             if self.state != EU_STATE.TERMINATED:
                 self.state = EU_STATE.NORMAL
@@ -619,7 +720,8 @@ class MobileEUTestApp(MqttClient):
 def run_simulation(conf_file, conf_eu_file, interface, log_file,
                    log_level=logging.INFO,
                    log_level_file=logging.DEBUG, sim_time=100,
-                   manual=False):
+                   manual=False, compact=False, batch_size=1,
+                   batch_delay=10.0):
     env = Environment(interface)
     if os.path.isfile(log_file):
         check_output(['savelog', '-ntl', log_file])
@@ -717,7 +819,10 @@ def run_simulation(conf_file, conf_eu_file, interface, log_file,
         mobile_app = MobileEUTestApp(device=device, end_user=end_user,
                                      service_name=service_name,
                                      broker_ip=broker_ip,
-                                     broker_port=9999)
+                                     broker_port=9999,
+                                     compact=compact,
+                                     batch_size=batch_size,
+                                     batch_delay=batch_delay)
         mobile_app.manual = manual
         device.app = mobile_app
         env.place_eu(device)
@@ -780,6 +885,22 @@ if __name__ == '__main__':
         '--interface',
         help='Network interface',
         default='')
+    parser.add_argument(
+        '--compact',
+        help='Send monitor reports with the compact encoding of the '
+            'centralized controller.',
+        action='store_true')
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        help='Publish monitor reports in batches of this size, 1 (default) '
+            'disables batching.',
+        default=1)
+    parser.add_argument(
+        '--batch_delay',
+        type=float,
+        help='Maximum delay in second of a batched monitor report.',
+        default=10.0)
     args = parser.parse_args()
     if args.interface == '':
         args.interface = get_default_interface()
@@ -790,4 +911,7 @@ if __name__ == '__main__':
                    log_level=getattr(logging, args.level),
                    log_level_file=getattr(logging, args.level_file),
                    sim_time=args.time,
-                   manual=args.manual)
+                   manual=args.manual,
+                   compact=args.compact,
+                   batch_size=args.batch_size,
+                   batch_delay=args.batch_delay)
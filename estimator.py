@@ -1,7 +1,6 @@
 from __future__ import division
 
 import numpy as np
-import sympy
 import logging
 
 from utilities import approx
@@ -12,24 +11,24 @@ def euclidean_distance(a, b):
     return np.sqrt((x_a - x_b)**2 + (y_a - y_b)**2)
 
 def find_hand_over_coeffs():
-    x_src, y_src = sympy.symbols('x_src y_src')
-    x_dst, y_dst = sympy.symbols('x_dst y_dst')
-    x, y = sympy.symbols('x y')
-    a, b = sympy.symbols('a b')
-    omega = sympy.symbols('omega')
-
-    d2_src = (x-x_src)**2 + (y-y_src)**2
-    d2_dst = (x-x_dst)**2 + (y-y_dst)**2
-    eq = d2_src - omega*d2_dst
-    # Replacing y = a*x + b
-    subs_expr = eq.subs(y, a*x + b)
-    # Expanding the expression
-    expand_expr = sympy.expand(subs_expr)
-    # Convert to polynomial form
-    poly = expand_expr.as_poly(x)
-    return [ sympy.lambdify((a,b,x_src,y_src,x_dst, y_dst, omega), coeff)
-             for coeff in  poly.all_coeffs() ]
-    
+    """Gets the coefficients of the handover equation.
+
+    The user moves on y = a*x + b, and the handover happens where
+    d2_src - omega*d2_dst = 0 (d2 is the squared distance to a BS). This is
+    a quadratic equation c2*x^2 + c1*x + c0 = 0 in x.
+
+    Returns:
+        [c2, c1, c0] as functions of (a, b, x_src, y_src, x_dst, y_dst,
+        omega).
+    """
+    c2 = lambda a, b, x_src, y_src, x_dst, y_dst, omega: \
+        (1 + a**2)*(1 - omega)
+    c1 = lambda a, b, x_src, y_src, x_dst, y_dst, omega: \
+        2*((a*(b - y_src) - x_src) - omega*(a*(b - y_dst) - x_dst))
+    c0 = lambda a, b, x_src, y_src, x_dst, y_dst, omega: \
+        x_src**2 + (b - y_src)**2 - omega*(x_dst**2 + (b - y_dst)**2)
+    return [c2, c1, c0]
+
 handover_coeffs = find_hand_over_coeffs()
 
 def find_handover_points(a, b, src, dst, hys=7.0, n=3, A=-30):
@@ -47,7 +46,7 @@ def find_handover_points(a, b, src, dst, hys=7.0, n=3, A=-30):
     coeffs = [ coeff(a, b, x_src, y_src, x_dst, y_dst, omega)
                for coeff in handover_coeffs ]
     roots = np.roots(coeffs)
-    logging.debug("The equation {} has roots:{}".format(coeff,
+    logging.debug("The equation {} has roots:{}".format(coeffs,
                                                         roots))
     if not all(np.isreal(roots)):
         logging.debug("Cannot found any real solution")
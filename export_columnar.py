@@ -0,0 +1,313 @@
+"""Exports measurement tables to columnar files for offline analysis.
+
+The history tables of the central database (``*central.db``) and of the
+simulated end users (``DBeu``) grow with every report, and loading them with
+``pandas.read_sql_table`` materializes every column of every row. This
+script copies them, chunk by chunk, to Parquet or Arrow IPC files, so that
+the analysis scripts read back only the columns they use. The rows of a
+table are split by time range, one file per hour of timestamp by default,
+so that a script reading a time range only opens the files of that range.
+
+Example::
+
+    python export_columnar.py --format parquet --out_dir results/run1 \\
+        docker1central.db simulated_eu.db
+    df = load_table('results/run1/docker1central', 'user_service',
+                    columns=['service_id', 'proc_delay'],
+                    start=t0, end=t0 + 3600*10**6)
+
+pyarrow is only needed to write or read the columnar files.
+"""
+import os
+import logging
+import argparse
+
+import sqlalchemy
+
+#: migrate_history, user_service, rssi_monitor and network_monitor of
+#: central_database, and user_event of simulated_mobile_eu_db. user_service
+#: of the end users shares its name with the central one.
+DEFAULT_TABLES = ['migrate_history', 'user_service', 'rssi_monitor',
+                  'network_monitor', 'user_event']
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+#: Timestamps per second, they are in microseconds as utilities.get_time
+TIMESTAMP_UNIT = 10**6
+#: Default time range of a file, in seconds
+PARTITION = 3600
+
+def get_arrow_type(column):
+    import pyarrow as pa
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        python_type = str
+    if python_type is bool:
+        return pa.bool_()
+    elif python_type is int:
+        return pa.int64()
+    elif python_type is float:
+        return pa.float64()
+    return pa.string()
+
+def iter_chunks(engine, table, columns=None, chunk_size=50000,
+                order_by=None):
+    """Reads a table in chunks of at most `chunk_size` rows, in the order
+    of the column `order_by` if given.
+
+    Yields:
+        dict: column name -> list of values of the chunk.
+    """
+    if columns is None:
+        columns = [c.name for c in table.columns]
+    query = sqlalchemy.select([table.c[name] for name in columns])
+    if order_by is not None:
+        query = query.order_by(table.c[order_by])
+    result = engine.execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            yield {name: [r[i] for r in rows]
+                   for i, name in enumerate(columns)}
+    finally:
+        result.close()
+
+class TableWriter(object):
+    """Writes record batches to one Parquet or Arrow IPC file."""
+    def __init__(self, path, schema, fmt='parquet'):
+        import pyarrow as pa
+        self.schema = schema
+        self.sink = None
+        if fmt == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, schema)
+        else:
+            self.sink = pa.OSFile(path, 'wb')
+            self.writer = pa.RecordBatchFileWriter(self.sink, schema)
+
+    def write(self, batch):
+        import pyarrow as pa
+        if self.sink is None:
+            self.writer.write_table(pa.Table.from_batches([batch],
+                                                          schema=self.schema))
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+def get_partition_path(folder, start, fmt):
+    return os.path.join(folder, '{:020d}{}'.format(start, FORMATS[fmt]))
+
+def get_partition_start(path):
+    """Returns the first timestamp of a file of get_partition_path."""
+    return int(os.path.splitext(os.path.basename(path))[0])
+
+def export_table(engine, table, path, fmt='parquet', chunk_size=50000,
+                 partition=PARTITION):
+    """Writes one table to Parquet or Arrow IPC files.
+
+    A table with a timestamp column is written to the directory `path`,
+    one file per `partition` seconds of timestamp, named after the first
+    timestamp of its range. Otherwise, or if `partition` is 0, it is written
+    to the file `path` plus the extension of `fmt`.
+
+    Only one chunk of rows is held in memory at a time.
+
+    Returns:
+        int: number of exported rows.
+    """
+    import pyarrow as pa
+    names = [c.name for c in table.columns]
+    schema = pa.schema([pa.field(c.name, get_arrow_type(c))
+                        for c in table.columns])
+    span = int(partition*TIMESTAMP_UNIT)
+    if span <= 0 or 'timestamp' not in names:
+        span = None
+        writer = TableWriter(path + FORMATS[fmt], schema, fmt)
+    else:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        writer = None
+    rows = 0
+    files = 0
+    start = None
+    try:
+        for chunk in iter_chunks(engine, table, names, chunk_size,
+                                 None if span is None else 'timestamp'):
+            if span is None:
+                parts = [(None, 0, len(chunk[names[0]]))]
+            else:
+                # the rows are in timestamp order, each range is contiguous
+                keys = [t // span * span for t in chunk['timestamp']]
+                bounds = [0] + [i for i in range(1, len(keys))
+                                if keys[i] != keys[i - 1]] + [len(keys)]
+                parts = [(keys[a], a, b) for a, b in zip(bounds, bounds[1:])]
+            for key, a, b in parts:
+                if span is not None and key != start:
+                    if writer is not None:
+                        writer.close()
+                    start = key
+                    writer = TableWriter(get_partition_path(path, start, fmt),
+                                         schema, fmt)
+                    files += 1
+                arrays = [pa.array(chunk[f.name][a:b], type=f.type)
+                          for f in schema]
+                writer.write(pa.RecordBatch.from_arrays(arrays, names))
+                rows += b - a
+    finally:
+        if writer is not None:
+            writer.close()
+    logging.info("Export {} rows of {} to {} ({} files)".format(rows,
+        table.name, path, max(files, 1)))
+    return rows
+
+def export_database(database, out_dir, tables=None, fmt='parquet',
+                    chunk_size=50000, partition=PARTITION):
+    """Exports tables of a SQLite database file to `out_dir`.
+
+    Args:
+        database (str): SQLite file, central or end-user database.
+        out_dir (str): output directory, one directory of files per table,
+            see export_table.
+        tables (list): table names, DEFAULT_TABLES if None. Tables missing
+            in the database are skipped.
+        fmt (str): 'parquet' or 'arrow'.
+        partition (int): seconds of timestamp per file, 0 for one file.
+
+    Returns:
+        dict: table name -> exported path, without extension.
+    """
+    engine = sqlalchemy.create_engine('sqlite:///{}'.format(database))
+    metadata = sqlalchemy.MetaData()
+    metadata.reflect(bind=engine)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    exported = {}
+    for name in tables or DEFAULT_TABLES:
+        table = metadata.tables.get(name, None)
+        if table is None:
+            continue
+        path = os.path.join(out_dir, name)
+        export_table(engine, table, path, fmt, chunk_size, partition)
+        exported[name] = path
+    engine.dispose()
+    return exported
+
+def read_file(path, columns=None):
+    """Reads some columns of one exported file as a pyarrow Table."""
+    import pyarrow as pa
+    if path.endswith(FORMATS['parquet']):
+        import pyarrow.parquet as pq
+        return pq.read_table(path, columns=columns)
+    # The file is memory mapped, unused columns are never read
+    data = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    if columns is not None:
+        data = pa.Table.from_arrays([data.column(c) for c in columns],
+                                    names=columns)
+    return data
+
+def load_table(source, table, columns=None, start=None, end=None):
+    """Loads some columns of a table as a pandas DataFrame.
+
+    Args:
+        source (str): a directory written by export_database, or a SQLite
+            database file.
+        table (str): table name.
+        columns (list): column names, all columns if None.
+        start (int): first timestamp of the rows, None for no bound.
+        end (int): timestamp after the rows, None for no bound. Only the
+            files of the exported time ranges overlapping [start, end) are
+            read.
+    """
+    import pandas as pd
+    bounded = start is not None or end is not None
+    if not os.path.isdir(source):
+        engine = sqlalchemy.create_engine('sqlite:///{}'.format(source))
+        sql_table = sqlalchemy.Table(table, sqlalchemy.MetaData(),
+                                     autoload=True, autoload_with=engine)
+        query = sqlalchemy.select([sql_table.c[c] for c in columns]
+                                  if columns is not None else [sql_table])
+        if start is not None:
+            query = query.where(sql_table.c.timestamp >= start)
+        if end is not None:
+            query = query.where(sql_table.c.timestamp < end)
+        df = pd.read_sql(query, engine)
+        engine.dispose()
+        return df
+    read_columns = columns
+    if bounded and columns is not None and 'timestamp' not in columns:
+        read_columns = columns + ['timestamp']
+    folder = os.path.join(source, table)
+    if os.path.isdir(folder):
+        paths = sorted(os.path.join(folder, name)
+                       for name in os.listdir(folder))
+        starts = [get_partition_start(path) for path in paths]
+        # a file ends where the next one starts
+        selected = [path for i, path in enumerate(paths)
+                    if (end is None or starts[i] < end) and
+                    (start is None or i + 1 == len(paths) or
+                     starts[i + 1] > start)]
+    else:
+        selected = [folder + ext for ext in sorted(FORMATS.values())
+                    if os.path.exists(folder + ext)]
+    frames = [read_file(path, read_columns).to_pandas()
+              for path in selected]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(frames, ignore_index=True)
+    if bounded:
+        mask = pd.Series(True, index=df.index)
+        if start is not None:
+            mask &= df['timestamp'] >= start
+        if end is not None:
+            mask &= df['timestamp'] < end
+        df = df[mask].reset_index(drop=True)
+    if read_columns is not columns:
+        df = df[columns]
+    return df
+
+def get_out_dir(root, database):
+    return os.path.join(root, os.path.splitext(os.path.basename(database))[0])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'databases',
+        help="SQLite database files (*central.db, simulated_eu.db)",
+        nargs='+')
+    parser.add_argument(
+        '--out_dir',
+        type=str,
+        help="Output directory, one sub directory per database.",
+        default='.')
+    parser.add_argument(
+        '--format',
+        type=str,
+        help="Output format: parquet (default), arrow.",
+        choices=sorted(FORMATS.keys()),
+        default='parquet')
+    parser.add_argument(
+        '--tables',
+        help="Table names, default: {}".format(', '.join(DEFAULT_TABLES)),
+        nargs='*',
+        default=None)
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        help="Rows per chunk.",
+        default=50000)
+    parser.add_argument(
+        '--partition',
+        type=int,
+        help="Seconds of timestamp per file, 0 for one file per table.",
+        default=PARTITION)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for database in args.databases:
+        export_database(database, get_out_dir(args.out_dir, database),
+                        args.tables, args.format, args.chunk_size,
+                        args.partition)
@@ -0,0 +1,541 @@
+"""Persistent TCP data channel between the source and destination edges.
+
+Every stage of a migration used to copy its folder with one ``rsync -az``
+over ssh: a process spawn, a ssh channel, a file list negotiation and zlib
+on one core per call. The DataChannel keeps a few TCP connections open to
+the DataChannelServer of the destination for the whole migration, and
+sends the files of a folder over them in parallel, largest first, with
+sendfile, or compressed in blocks when the CompressionPolicy finds the link
+slower than the compression.
+
+Frames reuse the header of migrate_stream, in network byte order::
+
+    kind (B), name length (H), payload length (Q), name, payload
+
+* HELLO: the name is the id of the session, acknowledged by a HELLO;
+* DIR: creates the directory `name`;
+* DATA: offset (Q), size of the file (Q), then the bytes of the file from
+  the offset. A DATA frame reaching the end of the file is acknowledged by
+  an OFFSET frame. With the COMPRESSED bit, the bytes are a block of the
+  file compressed by migrate_codec, and a file is sent in several blocks;
+* QUERY: asks the bytes of `name` the destination holds, replied by an
+  OFFSET frame with this number (Q).
+
+The destination remembers the bytes received per file and session, so a
+stream reconnecting after a failure resumes the file it was sending.
+
+Example::
+
+    channel = DataChannel('192.168.0.105', streams=4)
+    channel.connect()
+    channel.copy('/tmp/ct/snapshot_pre2/', '/tmp/ct')
+    channel.close()
+"""
+from __future__ import division
+
+import os
+import time
+import uuid
+import Queue
+import ctypes
+import ctypes.util
+import fnmatch
+import socket
+import struct
+import logging
+import threading
+import traceback
+
+import Constants
+from migrate_codec import NONE, CompressTimer, decode
+from migrate_stream import FRAME, COMPRESSED, StreamError, send_frame, \
+    recv_exactly, recv_frame
+
+HELLO = 8
+DIR = 9
+DATA = 10
+QUERY = 11
+OFFSET = 12
+
+# offset, size of the file
+DATA_HEADER = struct.Struct('!QQ')
+OFFSET_PAYLOAD = struct.Struct('!Q')
+# Bytes of the file in a compressed block
+BLOCK_SIZE = 4 << 20
+
+def _libc_sendfile():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int,
+                     ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+    def sendfile(out_fd, in_fd, offset, count):
+        off = ctypes.c_int64(offset)
+        ret = func(out_fd, in_fd, ctypes.byref(off), count)
+        if ret < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ret
+    return sendfile
+
+# sendfile(out_fd, in_fd, offset, count), None to copy through user space
+sendfile = getattr(os, 'sendfile', None) or _libc_sendfile()
+
+def send_file(sock, f, offset, size):
+    """Sends the bytes of the open file `f` from offset to size."""
+    while offset < size:
+        count = min(size - offset, 1 << 30)
+        if sendfile is not None:
+            sent = sendfile(sock.fileno(), f.fileno(), offset, count)
+        else:
+            f.seek(offset)
+            data = f.read(min(count, 1 << 20))
+            sock.sendall(data)
+            sent = len(data)
+        if sent == 0:
+            raise StreamError("File shrank while it was sent")
+        offset += sent
+
+def set_timeout(sock, timeout):
+    """Sets the timeouts of a blocking socket, sendfile fails on the
+    non-blocking sockets of socket.settimeout."""
+    sock.settimeout(None)
+    timeval = struct.pack('ll', int(timeout), int(timeout % 1 * 1e6))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeval)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeval)
+
+def is_excluded(name, include='', exclude=''):
+    """The --include/--exclude filter of the rsync calls."""
+    if include != '' and fnmatch.fnmatch(name, include):
+        return False
+    return exclude != '' and fnmatch.fnmatch(name, exclude)
+
+def list_folder(source, dest_folder, include='', exclude=''):
+    """Lists what copy() sends, like ``rsync -a source dest_folder/``.
+
+    Returns:
+        tuple: destination directories, and (source path, destination path,
+        size) of the files, largest first.
+    """
+    source = source.rstrip('/')
+    dest = os.path.join(dest_folder, os.path.basename(source))
+    dirs = []
+    files = []
+    for root, _, names in os.walk(source):
+        rel = os.path.relpath(root, source)
+        dest_root = os.path.normpath(os.path.join(dest, rel))
+        dirs.append(dest_root)
+        for name in names:
+            path = os.path.join(root, name)
+            if is_excluded(name, include, exclude) or \
+                    not os.path.isfile(path):
+                continue
+            files.append((path, os.path.join(dest_root, name),
+                          os.path.getsize(path)))
+    files.sort(key=lambda f: f[2], reverse=True)
+    return dirs, files
+
+class DataChannel(object):
+    """Connections of one session to the DataChannelServer of an edge.
+
+    Args:
+        streams (int): number of TCP connections, files are sent in
+            parallel over them.
+        retries (int): reconnections of a stream before a copy fails.
+        bw (float): BW of the link in Mbps, None if unknown.
+    """
+    def __init__(self, ip, port=Constants.MIGRATE_CHANNEL_PORT, streams=4,
+                 timeout=30, retries=3, bw=None):
+        self.ip = ip
+        self.bw = bw
+        self.rtt = None # in second
+        self.port = port
+        self.streams = streams
+        self.timeout = timeout
+        self.retries = retries
+        self.session = uuid.uuid4().hex
+        self.pool = Queue.Queue()
+        self.lock = threading.Lock()
+        self.resumed = 0
+
+    def open_stream(self):
+        sock = socket.create_connection((self.ip, self.port), self.timeout)
+        set_timeout(sock, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        start_ = time.time()
+        send_frame(sock, HELLO, self.session, b'')
+        kind, _, _ = recv_frame(sock)
+        if kind != HELLO:
+            sock.close()
+            raise StreamError("Unexpected frame {}".format(kind))
+        rtt = time.time() - start_
+        with self.lock:
+            self.rtt = rtt if self.rtt is None else min(self.rtt, rtt)
+        return sock
+
+    def connect(self):
+        for _ in range(self.streams):
+            self.pool.put(self.open_stream())
+
+    def close(self):
+        while True:
+            try:
+                sock = self.pool.get_nowait()
+            except Queue.Empty:
+                return
+            if sock is not None:
+                sock.close()
+
+    def query(self, sock, name):
+        send_frame(sock, QUERY, name, b'')
+        kind, _, payload = recv_frame(sock)
+        if kind != OFFSET:
+            raise StreamError("Unexpected frame {}".format(kind))
+        return OFFSET_PAYLOAD.unpack(payload)[0]
+
+    def send(self, sock, path, name, offset, timer=None):
+        """Sends `path` from `offset` as the destination file `name`.
+
+        Args:
+            timer (CompressTimer): compresses the blocks of the file.
+
+        Returns:
+            tuple: bytes of the file sent, bytes on the wire.
+        """
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if timer is None or timer.codec.id == NONE:
+                encoded = name.encode('utf-8')
+                sock.sendall(FRAME.pack(DATA, len(encoded),
+                                        DATA_HEADER.size + size - offset) +
+                             encoded + DATA_HEADER.pack(offset, size))
+                send_file(sock, f, offset, size)
+                wire = size - offset
+            else:
+                wire = self.send_blocks(sock, f, name, offset, size, timer)
+        kind, _, payload = recv_frame(sock)
+        if kind != OFFSET or OFFSET_PAYLOAD.unpack(payload)[0] != size:
+            raise StreamError("{} not acknowledged".format(name))
+        return size - offset, wire
+
+    def send_blocks(self, sock, f, name, offset, size, timer):
+        """Sends the file `f` from `offset` in compressed blocks."""
+        wire = 0
+        f.seek(offset)
+        while True:
+            data = f.read(min(size - offset, BLOCK_SIZE))
+            if not data and offset < size:
+                raise StreamError("File shrank while it was sent")
+            payload = DATA_HEADER.pack(offset, size) + timer.compress(data)
+            wire += send_frame(sock, DATA | COMPRESSED, name, payload)
+            offset += len(data)
+            if offset >= size:
+                return wire
+
+    def send_retry(self, path, name, timer=None):
+        """Sends `path` on a stream of the pool, resuming it on a new
+        connection when the stream fails.
+
+        Returns:
+            tuple: bytes of the file sent, bytes on the wire.
+        """
+        sock = self.pool.get()
+        offset = 0
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    if sock is None:
+                        sock = self.open_stream()
+                        offset = self.query(sock, name)
+                        if offset > 0:
+                            with self.lock:
+                                self.resumed += 1
+                    return self.send(sock, path, name, offset, timer)
+                except (socket.error, StreamError, OSError):
+                    if attempt == self.retries:
+                        raise
+                    logging.warn("Stream of {} failed, resume: {}".format(
+                        name, traceback.format_exc()))
+                    if sock is not None:
+                        sock.close()
+                    sock = None
+                    time.sleep(0.1 * 2**attempt)
+        finally:
+            self.pool.put(sock)
+
+    def copy(self, source, dest_folder, include='', exclude='', policy=None):
+        """Copies `source` into `dest_folder` of the destination, like
+        ``rsync -a source dest_folder/``.
+
+        Args:
+            policy (CompressionPolicy): chooses the codec of the copy, the
+                files are sent as they are without it.
+
+        Returns:
+            dict: number of files, bytes of the files sent, bytes on the
+            wire, codec and elapsed time in second.
+        """
+        start_ = time.time()
+        dirs, files = list_folder(source, dest_folder, include, exclude)
+        timer = None
+        if policy is not None:
+            timer = CompressTimer(policy.choose(sum(f[2] for f in files),
+                                                self.bw, self.rtt, self.ip))
+        sock = self.pool.get()
+        try:
+            if sock is None:
+                sock = self.open_stream()
+            for folder in dirs:
+                send_frame(sock, DIR, folder, b'')
+                kind, _, _ = recv_frame(sock)
+                if kind != OFFSET:
+                    raise StreamError("Unexpected frame {}".format(kind))
+        except (socket.error, StreamError):
+            if sock is not None:
+                sock.close()
+            sock = None
+            raise
+        finally:
+            self.pool.put(sock)
+        todo = Queue.Queue()
+        for item in files:
+            todo.put(item)
+        sent = [0, 0]
+        errors = []
+        def worker():
+            while not errors:
+                try:
+                    path, name, _ = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    size, wire = self.send_retry(path, name, timer)
+                except Exception as e:
+                    errors.append(e)
+                    return
+                with self.lock:
+                    sent[0] += size
+                    sent[1] += wire
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self.streams, max(len(files), 1)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        if timer is not None:
+            timer.report(policy)
+        return {'files': len(files), 'bytes': sent[0], 'size_sent': sent[1],
+                'codec': timer.codec.spec if timer is not None else 'none',
+                'elapsed': time.time() - start_}
+
+class ChannelCopy(threading.Thread):
+    """Runs a copy in background, with the wait() and communicate() of the
+    Popen of rsync. `fallback` is called if the copy fails."""
+    def __init__(self, copy, fallback=None):
+        super(ChannelCopy, self).__init__(name='channel_copy')
+        self.daemon = True
+        self.copy = copy
+        self.fallback = fallback
+        self.stats = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.stats = self.copy()
+        except Exception:
+            self.error = traceback.format_exc()
+            logging.error("Channel copy failed: {}".format(self.error))
+            if self.fallback is not None and self.fallback() == 0:
+                self.error = None
+
+    def wait(self):
+        self.join()
+        return 0 if self.error is None else 1
+
+    def communicate(self):
+        return self.stats, self.error
+
+class DataChannelServer(threading.Thread):
+    """Writes the files of the DataChannel sessions under `root`.
+
+    Connections stay open between the stages of a migration, so they have
+    no timeout by default and dead peers are detected by TCP keepalive.
+
+    Args:
+        root (str): files outside this folder are refused.
+        session_ttl (int): seconds a session is kept without connection.
+    """
+    def __init__(self, port=Constants.MIGRATE_CHANNEL_PORT, root='/',
+                 timeout=None, session_ttl=3600):
+        super(DataChannelServer, self).__init__(name='data_channel')
+        self.daemon = True
+        self.root = os.path.realpath(root)
+        self.timeout = timeout
+        self.session_ttl = session_ttl
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', port))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.cond = threading.Condition()
+        # session -> [last use, {path: bytes received}]
+        self.sessions = {}
+        # paths being written
+        self.active = set()
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=self.handle_connection,
+                                 args=(conn, addr))
+            t.daemon = True
+            t.start()
+
+    def handle_connection(self, conn, addr):
+        try:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.timeout is not None:
+                set_timeout(conn, self.timeout)
+            self.receive(conn)
+        except Exception:
+            logging.error("Data channel from {} failed: {}".format(addr,
+                traceback.format_exc()))
+        finally:
+            conn.close()
+
+    def get_session(self, session):
+        now = time.time()
+        with self.cond:
+            for key in [k for k, v in self.sessions.items()
+                        if now - v[0] > self.session_ttl]:
+                del self.sessions[key]
+            entry = self.sessions.setdefault(session, [now, {}])
+            entry[0] = now
+            return entry[1]
+
+    def get_path(self, name):
+        path = os.path.realpath(name)
+        if path != self.root and \
+                not path.startswith(self.root.rstrip('/') + '/'):
+            raise StreamError("{} is outside {}".format(name, self.root))
+        return path
+
+    def receive(self, conn):
+        kind, session, _ = recv_frame(conn)
+        if kind != HELLO:
+            raise StreamError("Unexpected frame {}".format(kind))
+        received = self.get_session(session)
+        send_frame(conn, HELLO, '', b'')
+        while True:
+            try:
+                header = conn.recv(FRAME.size, socket.MSG_WAITALL)
+            except socket.error:
+                return
+            if len(header) < FRAME.size:
+                return
+            kind, name_len, payload_len = FRAME.unpack(header)
+            name = recv_exactly(conn, name_len).decode('utf-8')
+            path = self.get_path(name)
+            if kind == DIR:
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                send_frame(conn, OFFSET, name, OFFSET_PAYLOAD.pack(0))
+            elif kind == QUERY:
+                # the broken stream may still be writing the file
+                deadline = time.time() + 10
+                with self.cond:
+                    while path in self.active and time.time() < deadline:
+                        self.cond.wait(deadline - time.time())
+                    offset = received.get(path, 0)
+                if os.path.isfile(path):
+                    offset = min(offset, os.path.getsize(path))
+                else:
+                    offset = 0
+                send_frame(conn, OFFSET, name, OFFSET_PAYLOAD.pack(offset))
+            elif kind == DATA:
+                offset = self.receive_data(conn, path, received,
+                                           payload_len)
+                send_frame(conn, OFFSET, name, OFFSET_PAYLOAD.pack(offset))
+            elif kind == DATA | COMPRESSED:
+                offset, size = self.receive_block(conn, path, received,
+                                                  payload_len)
+                if offset >= size:
+                    send_frame(conn, OFFSET, name,
+                               OFFSET_PAYLOAD.pack(offset))
+            else:
+                raise StreamError("Unexpected frame {}".format(kind))
+
+    def receive_data(self, conn, path, received, payload_len):
+        """Writes a DATA payload, returns the bytes of the file held."""
+        offset, size = DATA_HEADER.unpack(recv_exactly(conn,
+                                                       DATA_HEADER.size))
+        remaining = payload_len - DATA_HEADER.size
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        done = offset
+        with self.cond:
+            self.active.add(path)
+        try:
+            with open(path, 'r+b' if offset > 0 and os.path.isfile(path)
+                      else 'wb') as f:
+                f.seek(offset)
+                while remaining > 0:
+                    chunk = conn.recv(min(remaining, 1 << 20))
+                    if not chunk:
+                        raise StreamError("Connection closed")
+                    f.write(chunk)
+                    remaining -= len(chunk)
+                    done += len(chunk)
+                f.truncate(size)
+        finally:
+            with self.cond:
+                received[path] = done
+                self.active.discard(path)
+                self.cond.notify_all()
+        return done
+
+    def receive_block(self, conn, path, received, payload_len):
+        """Writes a compressed block.
+
+        Returns:
+            tuple: bytes of the file held, size of the file.
+        """
+        payload = recv_exactly(conn, payload_len)
+        offset, size = DATA_HEADER.unpack_from(payload)
+        data = decode(payload[DATA_HEADER.size:])
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with self.cond:
+            self.active.add(path)
+        try:
+            with open(path, 'r+b' if offset > 0 and os.path.isfile(path)
+                      else 'wb') as f:
+                f.seek(offset)
+                f.write(data)
+                if offset + len(data) >= size:
+                    f.truncate(size)
+        finally:
+            with self.cond:
+                received[path] = offset + len(data)
+                self.active.discard(path)
+                self.cond.notify_all()
+        return offset + len(data), size
+
+    def stop(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
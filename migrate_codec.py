@@ -0,0 +1,244 @@
+"""Compression of the migration transfers.
+
+A codec is named by a spec, ``none``, ``lz4``, ``zstd-<level>`` or
+``zlib-<level>``. lz4 and zstd are optional; without their module a spec
+falls back to the zlib level of similar speed.
+
+Compressed payloads start with the id of their codec, so the receiver does
+not need to know the choice of the sender::
+
+    codec id (B), compressed data
+
+The CompressionPolicy picks the codec of a transfer that minimizes its
+predicted time. Compression and sending overlap, so a transfer takes the
+longest of the compression, spread over the idle cores, and of the sending
+of the compressed bytes over the link. The ratio and the speed of each codec,
+and the throughput of each link, are learned from the transfers.
+
+Example::
+
+    policy = CompressionPolicy()
+    codec = policy.choose(size, bw=100, rtt=0.002)
+    payload = codec.compress(data)
+    data = decode(payload)
+"""
+from __future__ import division
+
+import os
+import time
+import zlib
+import struct
+import logging
+import threading
+import multiprocessing
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+NONE = 0
+ZLIB = 1
+LZ4 = 2
+ZSTD = 3
+
+CODEC_ID = struct.Struct('!B')
+
+# Specs tried by the policy, the unavailable ones are skipped
+CODECS = ['none', 'lz4', 'zstd-1', 'zstd-3', 'zstd-9', 'zlib-1', 'zlib-6']
+
+# Ratio and speed in byte per second and core of each codec before the
+# first transfer, measured on CRIU memory images
+PRIORS = {'none': (1.0, float('inf')),
+          'lz4': (0.55, 400e6),
+          'zstd-1': (0.45, 250e6),
+          'zstd-3': (0.42, 150e6),
+          'zstd-9': (0.38, 40e6),
+          'zlib-1': (0.5, 60e6),
+          'zlib-6': (0.46, 20e6)}
+
+# zlib level used when lz4 or zstd are missing
+FALLBACK = {'lz4': 'zlib-1', 'zstd-1': 'zlib-1', 'zstd-3': 'zlib-1',
+            'zstd-9': 'zlib-6'}
+
+# Window of the TCP connections, bounds the throughput of the long links
+TCP_WINDOW = 4 << 20
+
+def is_available(spec):
+    name = spec.split('-')[0]
+    if name == 'lz4':
+        return lz4 is not None
+    if name == 'zstd':
+        return zstandard is not None
+    return name in ('none', 'zlib')
+
+class Codec(object):
+    def __init__(self, spec):
+        if not is_available(spec):
+            fallback = FALLBACK.get(spec, None)
+            if fallback is None:
+                fallback = 'zlib-{}'.format(min(int(spec.split('-')[-1]), 9))
+            logging.debug("Codec {} is not installed, use {}".format(
+                spec, fallback))
+            spec = fallback
+        self.spec = spec
+        parts = spec.split('-')
+        self.name = parts[0]
+        self.level = int(parts[1]) if len(parts) > 1 else 0
+        self.id = {'none': NONE, 'zlib': ZLIB, 'lz4': LZ4,
+                   'zstd': ZSTD}[self.name]
+        if self.name == 'zstd':
+            self.compressor = zstandard.ZstdCompressor(level=self.level)
+
+    def __repr__(self):
+        return self.spec
+
+    def compress(self, data):
+        """Returns the payload of `data`, with the codec id."""
+        if self.id == ZLIB:
+            data = zlib.compress(data, self.level)
+        elif self.id == LZ4:
+            data = lz4.frame.compress(data)
+        elif self.id == ZSTD:
+            data = self.compressor.compress(data)
+        return CODEC_ID.pack(self.id) + data
+
+def get_codec(spec):
+    return Codec(spec)
+
+def decode(payload):
+    """Returns the data of a payload of Codec.compress."""
+    codec_id = CODEC_ID.unpack_from(payload)[0]
+    data = payload[CODEC_ID.size:]
+    if codec_id == NONE:
+        return data
+    if codec_id == ZLIB:
+        return zlib.decompress(data)
+    if codec_id == LZ4 and lz4 is not None:
+        return lz4.frame.decompress(data)
+    if codec_id == ZSTD and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown codec {}".format(codec_id))
+
+def get_headroom():
+    """Returns the number of idle cores of this node."""
+    cores = multiprocessing.cpu_count()
+    try:
+        load = os.getloadavg()[0]
+    except OSError:
+        load = 0
+    return max(cores - load, 0.5)
+
+class CompressionPolicy(object):
+    """Chooses the codec of each transfer.
+
+    Args:
+        codecs (list): specs of the candidate codecs.
+        alpha (float): weight of a new sample in the moving averages.
+        workers (int): compression threads of a transfer.
+    """
+    def __init__(self, codecs=None, alpha=0.3, workers=None):
+        self.alpha = alpha
+        self.workers = workers or multiprocessing.cpu_count()
+        self.lock = threading.Lock()
+        specs = [s for s in (codecs or CODECS) if is_available(s)]
+        # spec -> [ratio, speed in byte per second and core]
+        self.stats = dict((s, list(PRIORS.get(s, PRIORS['zlib-6'])))
+                          for s in specs)
+        # destination -> throughput in byte per second
+        self.links = {}
+
+    def get_bw(self, bw=None, rtt=None, dest=None):
+        """Returns the throughput of the link in byte per second, None if
+        it is unknown.
+
+        Args:
+            bw (float): BW of the link in Mbps.
+            rtt (float): in second.
+        """
+        rate = None
+        if bw:
+            rate = bw * 1e6 / 8
+        else:
+            with self.lock:
+                rate = self.links.get(dest, None)
+        if rate is not None and rtt:
+            rate = min(rate, TCP_WINDOW / rtt)
+        return rate
+
+    def predict(self, spec, size, rate, headroom):
+        """Returns the predicted time in second of a transfer of `size`
+        bytes compressed with `spec`."""
+        with self.lock:
+            ratio, speed = self.stats[spec]
+        cores = min(headroom, self.workers)
+        return max(size / (speed * cores), size * ratio / rate)
+
+    def choose(self, size, bw=None, rtt=None, dest=None):
+        """Returns the Codec of a transfer of `size` bytes, zlib-1 if the
+        link is unknown."""
+        rate = self.get_bw(bw, rtt, dest)
+        if rate is None or not self.stats:
+            return get_codec('zlib-1')
+        headroom = get_headroom()
+        spec = min(sorted(self.stats), key=lambda s: self.predict(s,
+            max(size, 1), rate, headroom))
+        logging.debug("Codec {} for {} bytes at {} B/s, {} idle cores".format(
+            spec, size, rate, headroom))
+        return get_codec(spec)
+
+    def update(self, spec, size_in, size_out, seconds):
+        """Learns the ratio and the speed of one core of `spec`."""
+        if spec not in self.stats or size_in <= 0:
+            return
+        with self.lock:
+            stats = self.stats[spec]
+            stats[0] += self.alpha * (size_out / size_in - stats[0])
+            if seconds > 0:
+                stats[1] += self.alpha * (size_in / seconds - stats[1])
+
+    def learn(self, record):
+        """Learns the throughput of the link to the destination of a
+        MigrateRecord from its final transfer. The transfers of rsync are
+        not learned, their size is measured before its delta transfer."""
+        if record.codec == 'rsync' or record.size_sent <= 0 or \
+                record.final_rsync <= 0:
+            return
+        rate = record.size_sent / record.final_rsync
+        with self.lock:
+            old = self.links.get(record.dest_ip, None)
+            self.links[record.dest_ip] = rate if old is None else \
+                old + self.alpha * (rate - old)
+
+    def get_stats(self):
+        with self.lock:
+            return {'codecs': dict((k, list(v))
+                                   for k, v in self.stats.items()),
+                    'links': dict(self.links)}
+
+class CompressTimer(object):
+    """Sums the input, output and time of the compressions of a transfer."""
+    def __init__(self, codec):
+        self.codec = codec
+        self.lock = threading.Lock()
+        self.size_in = 0
+        self.size_out = 0
+        self.seconds = 0.0
+
+    def compress(self, data):
+        start_ = time.time()
+        payload = self.codec.compress(data)
+        with self.lock:
+            self.seconds += time.time() - start_
+            self.size_in += len(data)
+            self.size_out += len(payload)
+        return payload
+
+    def report(self, policy):
+        if policy is not None:
+            policy.update(self.codec.spec, self.size_in, self.size_out,
+                          self.seconds)
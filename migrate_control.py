@@ -0,0 +1,253 @@
+"""Control channel between the migrating edges.
+
+The prepare and migrate commands of a migration used to be UDP datagrams,
+lost or truncated without notice. Here the source keeps one TCP connection
+to each destination and frames the commands with edge_protocol.prepare_msg::
+
+    length (i), type, ' ', correlation id, ' ', payload
+
+The destination answers each request with a ``reply`` message, or an
+``error`` message if its handler failed, of the same correlation id.
+Requests are pipelined: a client sends them without waiting for the
+previous replies, and its reader thread hands each reply to its request,
+so several migrations share the connection.
+
+Example::
+
+    server = ControlServer(handler) # handler(msg_type, payload, addr)
+    server.start()
+    client = ControlClient('10.0.0.2')
+    reply = client.request('prepare', service_json)
+"""
+import socket
+import logging
+import threading
+import traceback
+import itertools
+
+import Constants
+from edge_protocol import prepare_msg, recv_msg
+
+REPLY = 'reply'
+ERROR = 'error'
+
+class ControlError(Exception):
+    """The destination failed to handle a request."""
+    pass
+
+def parse_msg(msg):
+    """Returns the type, the correlation id and the payload of a message.
+
+    Raises:
+        ValueError: the message has no correlation id.
+    """
+    parts = msg.split(' ', 2)
+    if len(parts) < 2:
+        raise ValueError("Malformed control message {!r}".format(msg[:64]))
+    return parts[0], int(parts[1]), parts[2] if len(parts) > 2 else ''
+
+class PendingReply(object):
+    """Reply of a request, set by the reader of the client."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.payload = None
+        self.error = None
+
+    def set(self, payload=None, error=None):
+        self.payload = payload
+        self.error = error
+        self.event.set()
+
+    def wait(self, timeout=None):
+        """Returns the payload of the reply.
+
+        Raises:
+            socket.timeout: no reply within `timeout` second.
+            socket.error: the connection closed before the reply.
+            ControlError: the destination failed to handle the request.
+        """
+        if not self.event.wait(timeout):
+            raise socket.timeout("No reply in {}s".format(timeout))
+        if isinstance(self.error, socket.error):
+            raise self.error
+        if self.error is not None:
+            raise ControlError(self.error)
+        return self.payload
+
+class ControlClient(object):
+    """Sends requests to the ControlServer of a destination.
+
+    The connection is opened on the first request and opened again after
+    it breaks.
+
+    Args:
+        timeout (float): in second, of the connection and of each reply.
+    """
+    def __init__(self, ip, port=Constants.BETWEEN_EDGES_PORT, timeout=10):
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        # correlation id -> (socket, PendingReply)
+        self.pending = {}
+        self.ids = itertools.count(1)
+
+    def open(self):
+        sock = socket.create_connection((self.ip, self.port), self.timeout)
+        sock.settimeout(None)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = threading.Thread(target=self.read, args=(sock,),
+                                  name='control_reader')
+        reader.daemon = True
+        reader.start()
+        return sock
+
+    def connect(self):
+        with self.lock:
+            if self.sock is None:
+                self.sock = self.open()
+
+    def send(self, msg_type, payload):
+        """Sends a request without waiting for its reply.
+
+        Returns:
+            PendingReply: of the request.
+        """
+        pending = PendingReply()
+        with self.lock:
+            if self.sock is None:
+                self.sock = self.open()
+            sock = self.sock
+            cid = next(self.ids)
+            self.pending[cid] = (sock, pending)
+            try:
+                sock.sendall(prepare_msg(msg_type,
+                                         '{} {}'.format(cid, payload)))
+            except socket.error:
+                del self.pending[cid]
+                self.sock = None
+                sock.close()
+                raise
+        return pending
+
+    def request(self, msg_type, payload):
+        """Sends a request and returns the payload of its reply. A request
+        that cannot be sent on a broken connection is sent again on a new
+        one."""
+        try:
+            pending = self.send(msg_type, payload)
+        except socket.error:
+            logging.warn("Control channel to {} broke, reconnect".format(
+                self.ip))
+            pending = self.send(msg_type, payload)
+        return pending.wait(self.timeout)
+
+    def read(self, sock):
+        while True:
+            try:
+                msg = recv_msg(sock)
+            except socket.error:
+                msg = None
+            if msg is None:
+                break
+            try:
+                msg_type, cid, payload = parse_msg(msg)
+            except ValueError as e:
+                logging.error(str(e))
+                continue
+            with self.lock:
+                entry = self.pending.pop(cid, None)
+            if entry is None:
+                logging.warn("Reply {} without request".format(cid))
+            elif msg_type == ERROR:
+                entry[1].set(error=payload)
+            else:
+                entry[1].set(payload)
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+            lost = [cid for cid, entry in self.pending.items()
+                    if entry[0] is sock]
+            lost = [self.pending.pop(cid)[1] for cid in lost]
+        for pending in lost:
+            pending.set(error=socket.error("Connection to {} closed".format(
+                self.ip)))
+        sock.close()
+
+    def close(self):
+        with self.lock:
+            sock = self.sock
+            self.sock = None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+class ControlServer(threading.Thread):
+    """Answers the requests of the ControlClients.
+
+    The handler runs on the thread of the connection and its return value
+    is the payload of the reply, so it should only queue long work.
+
+    Args:
+        handler (callable): handler(msg_type, payload, addr) where addr is
+            the address of the client.
+    """
+    def __init__(self, handler, port=Constants.BETWEEN_EDGES_PORT, bind=''):
+        super(ControlServer, self).__init__(name='control_server')
+        self.daemon = True
+        self.handler = handler
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((bind, port))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=self.serve, args=(conn, addr),
+                                 name='control_{}'.format(addr[0]))
+            t.daemon = True
+            t.start()
+
+    def serve(self, conn, addr):
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                msg = recv_msg(conn)
+                if msg is None:
+                    return
+                try:
+                    msg_type, cid, payload = parse_msg(msg)
+                except ValueError as e:
+                    logging.error(str(e))
+                    continue
+                try:
+                    reply = self.handler(msg_type, payload, addr)
+                    out = prepare_msg(REPLY, '{} {}'.format(
+                        cid, reply if reply is not None else ''))
+                except Exception as e:
+                    logging.error("Control {} from {} failed: {}".format(
+                        msg_type, addr, traceback.format_exc()))
+                    out = prepare_msg(ERROR, '{} {}'.format(cid, e))
+                conn.sendall(out)
+        except socket.error as e:
+            logging.warn("Control connection from {} closed: {}".format(
+                addr, e))
+        finally:
+            conn.close()
+
+    def stop(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
@@ -1,16 +1,36 @@
 import os
+import socket
 import logging
+import threading
 import subprocess
 
 import shutil
 import docker
 
+import page_diff
 from diff_patch import create_xdelta_diff, create_xdelta_patch
+from migrate_channel import DataChannel, ChannelCopy
 
 class MigrateController(object):
-    def __init__(self):
+    """
+    The SSH sessions and the data channels are shared by the migrations to
+    the same destination, and closed when its last migration closes them.
+
+    Args:
+        data_streams (int): connections of the data channel to the
+            destination, 0 copies the folders with rsync.
+        policy (CompressionPolicy): chooses the codec of the copies of the
+            data channel, the files are sent as they are without it.
+    """
+    def __init__(self, data_streams=4, policy=None):
         self.client = docker.from_env()
-        self.ssh_handle = None
+        self.data_streams = data_streams
+        self.policy = policy
+        self.lock = threading.Lock()
+        # dest IP -> [ssh Popen, number of migrations]
+        self.ssh_handles = {}
+        # dest IP -> [DataChannel, number of migrations]
+        self.channels = {}
 
     def handle_cmd(self, process, cmd_str, wait):
         if not wait:
@@ -97,26 +117,113 @@ class MigrateController(object):
             cmd.append('--exclude')
             cmd.append(exclude)
         cmd.append(folder)
-        return subprocess.check_output(cmd).split()[0]
+        return int(subprocess.check_output(cmd).split()[0])
 
     def open_ssh_session(self, dest_user, dest_ip):
-        cmd = ['ssh', '{}@{}'.format(dest_user, dest_ip), '-N']
-        out = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-        logging.info("Start ssh master connection")
-        self.ssh_handle = out
-
-    def close_ssh_session(self):
-        if self.ssh_handle is not None:
-            ret = self.ssh_handle.poll()
-            if ret is not None:
-                logging.warn("SSH connection is interrupted")
-                logging.error("SSH return: {}".format(self.ssh_handle.communicate()))
+        with self.lock:
+            entry = self.ssh_handles.get(dest_ip, None)
+            if entry is not None and entry[0].poll() is None:
+                entry[1] += 1
+                return
+            cmd = ['ssh', '{}@{}'.format(dest_user, dest_ip), '-N']
+            out = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+            logging.info("Start ssh master connection")
+            self.ssh_handles[dest_ip] = [out, 1]
+
+    def close_ssh_session(self, dest_ip=None):
+        """Closes the SSH session to `dest_ip`, all of them if None."""
+        with self.lock:
+            if dest_ip is None:
+                ips = list(self.ssh_handles)
+            elif dest_ip in self.ssh_handles:
+                ips = [dest_ip]
             else:
-                self.ssh_handle.terminate()
-                self.ssh_handle = None
-        else:
-            logging.error("Cannot find SSH connection")
+                logging.error("Cannot find SSH connection")
+                return
+            for ip in ips:
+                entry = self.ssh_handles[ip]
+                entry[1] -= 1
+                if dest_ip is not None and entry[1] > 0:
+                    continue
+                del self.ssh_handles[ip]
+                ret = entry[0].poll()
+                if ret is not None:
+                    logging.warn("SSH connection is interrupted")
+                    logging.error("SSH return: {}".format(
+                        entry[0].communicate()))
+                else:
+                    entry[0].terminate()
+
+    def open_channel(self, dest_ip, bw=None):
+        if self.data_streams <= 0:
+            return
+        with self.lock:
+            entry = self.channels.get(dest_ip, None)
+            if entry is not None:
+                entry[1] += 1
+                return
+        channel = DataChannel(dest_ip, streams=self.data_streams, bw=bw)
+        try:
+            channel.connect()
+        except (socket.error, IOError):
+            logging.warn("Cannot open the data channel to {}, use rsync".\
+                         format(dest_ip))
+            channel.close()
+            return
+        logging.info("Open data channel to {} with {} streams".format(
+            dest_ip, self.data_streams))
+        with self.lock:
+            entry = self.channels.setdefault(dest_ip, [channel, 0])
+            entry[1] += 1
+        if entry[0] is not channel:
+            # opened meanwhile by another migration
+            channel.close()
+
+    def get_channel(self, dest_ip):
+        with self.lock:
+            entry = self.channels.get(dest_ip, None)
+            return entry[0] if entry is not None else None
+
+    def close_channel(self, dest_ip=None):
+        """Closes the data channel to `dest_ip`, all of them if None."""
+        with self.lock:
+            if dest_ip is None:
+                ips = list(self.channels)
+            else:
+                ips = [ip for ip in [dest_ip] if ip in self.channels]
+            closed = []
+            for ip in ips:
+                entry = self.channels[ip]
+                entry[1] -= 1
+                if dest_ip is None or entry[1] <= 0:
+                    closed.append(self.channels.pop(ip)[0])
+        for channel in closed:
+            channel.close()
+
+    def transfer(self, source, dest_user, dest_ip, dest_folder, include='',
+                 exclude='', wait=True):
+        """Copies like rsync, through the data channel when it is open to
+        `dest_ip`. A failed copy is retried with rsync."""
+        channel = self.get_channel(dest_ip)
+        if channel is None:
+            return self.rsync(source, dest_user, dest_ip, dest_folder,
+                              include, exclude, wait)
+        def copy():
+            stats = channel.copy(source, dest_folder, include, exclude,
+                                 self.policy)
+            logging.info("Copy {} to {}:{}: {}".format(source, dest_ip,
+                dest_folder, stats))
+            return stats
+        def fallback():
+            return self.rsync(source, dest_user, dest_ip, dest_folder,
+                              include, exclude)[1]
+        handle = ChannelCopy(copy, fallback)
+        handle.start()
+        if not wait:
+            return handle
+        ret_code = handle.wait()
+        return handle.communicate()[0], ret_code
 
     def rsync(self, source, dest_user, dest_ip, dest_folder, include='',
               exclude='', wait=True):
@@ -144,7 +251,11 @@ class MigrateController(object):
             logging.error("Cannot found new folder {}".format(new))
             return 1
         else:
+            read = page_diff.INDEX.get_stats()['read']
             create_xdelta_diff(old, new, patch, True, is_parallel)
+            stats = page_diff.INDEX.get_stats()
+            logging.info("Diff {} read {} bytes of memory images, page "
+                "index {}".format(new, stats['read'] - read, stats))
             return 0
 
     def restore_diff(self, old, new, patch):
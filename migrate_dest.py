@@ -2,6 +2,8 @@ import sys
 import time
 import socket
 import logging
+import threading
+import traceback
 import datetime
 import argparse
 from subprocess import check_output
@@ -15,6 +17,11 @@ import Constants
 from migrate_node import MigrateNode, MigrateRecord
 from migrate_controller import MigrateController
 from diff_patch import create_xdelta_patch
+from migrate_stream import StreamReceiver
+from migrate_channel import DataChannelServer
+from migrate_engine import MigrationEngine
+from migrate_control import ControlServer
+from chunk_store import ChunkStore
 
 """ This file is the migration service running in the destination node.
 Whenever the destination receives an instruction from the source node,
@@ -54,6 +61,11 @@ def backup_folder(folder):
         logging.debug("backup folder: {}-->{}".format(folder, bak))
         shutil.copytree(folder, bak)
 
+def get_migration_key(data):
+    """Returns the container name and the source IP of a command."""
+    addr, kwargs = data
+    return MigrateNode(**kwargs).get_container_name(), addr[0]
+
 class MigrateDestCallback(object):
     def dest_migrate_cb(self, **kwargs):
         pass
@@ -71,57 +83,105 @@ class MigrateDest(MigrateNode):
         self.source_addr = None
         self.controller = MigrateController()
         self.dest_cb = MigrateDestCallback()
-        self.records = {}
-        self.sockets = {}
+        # Inbound migrations run on their own worker, the restore of one
+        # service does not hold back the prepare of the others
+        self.engine = MigrationEngine(
+            {'prepare': lambda data: self.handle_cmd_prepare(data[0],
+                                                             **data[1]),
+             'migrate': lambda data: self.handle_cmd_migrate(data[0],
+                                                             **data[1])},
+            get_migration_key, kwargs.get('max_per_link', 4),
+            kwargs.get('max_migrations', 4))
+        self.port_lock = threading.Lock()
+        self.control_server = None
+        self.receiver = None
+        self.channel_server = None
+        self.store = None
+        self.store_folder = kwargs.get('chunk_store',
+            os.path.join(self.dump_dir, 'chunk_store'))
+        self.store_budget = kwargs.get('chunk_budget', 2 << 30)
 
     def handle_cmd_prepare(self, addr, **kwargs):
         # Restore xdelta
         service = MigrateNode(**kwargs)
+        migration = self.engine.get_migration(service.get_container_name(),
+                                              addr[0])
+        migration.state = 'prepare'
         record = MigrateRecord(service=service.get_container_name(),
                                     source_ip=addr[0])
-        self.records[service.get_container_name()] = record
+        migration.record = record
         start_premigration = time.time()
         logging.debug("pull for service {}".format(service.get_container_name()))
         handle_pull = self.controller.docker_pull_image(service.container_img,
                                                         wait=False)
-        start_xdela_2_3 = time.time()
-        logging.info("Restore {} folder".format(service.get_snapshot_pre(3)))
-        self.controller.restore_diff(service.get_snapshot_pre(2),
-                                     service.get_snapshot_pre(3),
-                                     service.get_snapshot_delta(2,3))
-        delta = time.time() - start_xdela_2_3
-        service.log_time('xdelta_dest_2_3', delta)
+        # Each pre-copy round shipped the delta against the previous one
+        for number in range(3, service.pre_dumps + 1):
+            start_xdelta = time.time()
+            logging.info("Restore {} folder".format(
+                service.get_snapshot_pre(number)))
+            self.controller.restore_diff(service.get_snapshot_pre(number - 1),
+                service.get_snapshot_pre(number),
+                service.get_snapshot_delta(number - 1, number))
+            delta = time.time() - start_xdelta
+            service.log_time('xdelta_dest_{}_{}'.format(number - 1, number),
+                             delta)
         handle_pull.wait()
         delta = time.time() - start_premigration
         service.log_time('premigration', delta)
         record.premigration = delta
         # logging.info("Destination status: ".format(
         #     check_output(['ls', service.get_checkpoint_folder()])))
-        new_port = find_open_port(9900, 9999)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(('0.0.0.0', new_port))
-        self.sockets[service.get_container_name()] = sock
+        # The port is reserved until the restore
+        with self.port_lock:
+            new_port = find_open_port(9900, 9999)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(('0.0.0.0', new_port))
+        migration.sock = sock
         self.controller.docker_create_container(service.container_img,
                                                 service.get_container_name(),
                                                 service.container_port,
                                                 new_port)
+        with self.engine.cond:
+            migration.state = 'prepared'
+            self.engine.cond.notify_all()
 
     def handle_cmd_migrate(self, addr, **kwargs):
         service = MigrateNode(**kwargs)
-        record = self.records[service.get_container_name()]
+        migration = self.engine.get_migration(service.get_container_name(),
+                                              addr[0])
+        if migration.record is None or migration.sock is None:
+            # the prepare failed, or was superseded or expired
+            raise RuntimeError("{} is not prepared".format(
+                service.get_container_name()))
+        migration.state = 'migrate'
+        record = migration.record
+        record.queue_wait = migration.queue_wait
         start_migrate = time.time()
-        sock = self.sockets[service.get_container_name()]
+        sock = migration.sock
+        migration.sock = None
         service.port = sock.getsockname()[1]
         sock.close()
-        if service.method == 'delta':
+        stream = None
+        if service.method == 'stream' and self.receiver is not None:
+            # The source sends migrate once every file is patched
+            stream = self.receiver.wait(service.get_container_name(), 1)
+            if stream is None:
+                logging.warn("No stream for {}, patch the rsync delta".\
+                             format(service.get_container_name()))
+            else:
+                record.xdelta_dest = stream.get('patch', 0)
+                service.log_time('xdelta_dest', record.xdelta_dest)
+        if service.method == 'delta' or \
+                (service.method == 'stream' and stream is None):
             start_migrate = time.time()
             # NOTE: Clear any conflict container before create
-            self.controller.restore_diff(service.get_snapshot_pre(3),
-                                         service.get_snapshot_folder(),
-                                         service.get_snapshot_delta())
+            self.controller.restore_diff(
+                service.get_snapshot_pre(service.pre_dumps),
+                service.get_snapshot_folder(), service.get_snapshot_delta())
             delta = time.time() - start_migrate
             service.log_time('xdelta_dest', delta)
             record.xdelta_dest = delta
+        migration.state = 'restore'
         start_restore = time.time()
         _, restore_ret_code = self.controller.docker_restore(
             service.get_container_name(),
@@ -145,6 +205,9 @@ class MigrateDest(MigrateNode):
             logging.error("Error while restoring service")
             logging.info("Starting a new container")
             self.controller.docker_start(service.get_container_name())
+        elif self.store is not None:
+            # Pages of this visit are reused when the service comes back
+            self.store_snapshot(service.get_snapshot_folder())
         self.dest_cb.dest_migrate_cb(**service.get_migrate_service())
         self.dest_cb.dest_report_cb(record)
         self.controller.docker_checkpoint(service.get_container_name(),
@@ -153,6 +216,18 @@ class MigrateDest(MigrateNode):
         backup_folder(service.get_checkpoint_folder())
 
 
+    def store_snapshot(self, folder):
+        def add_folder():
+            try:
+                self.store.add_folder(folder)
+                logging.info("Chunk store: {}".format(self.store.get_stats()))
+            except Exception:
+                logging.error("Cannot store {}: {}".format(folder,
+                    traceback.format_exc()))
+        t = threading.Thread(target=add_folder)
+        t.daemon = True
+        t.start()
+
     def restore(self):
         if self.method == 'delta':
             start_ = time.time()
@@ -212,6 +287,65 @@ class MigrateDest(MigrateNode):
         self.record.method = self.method
         self.sock.sendto("dest_port {}".format(self.port), self.source_addr)
 
+    def dispatch(self, msg_type, payload, addr):
+        """Queues a command on the worker of its service, handler of the
+        ControlServer.
+
+        Raises:
+            ValueError: unknown command.
+            yaml.YAMLError: the service cannot be parsed.
+        """
+        if msg_type not in ('prepare', 'migrate'):
+            raise ValueError("Unknown command {}".format(msg_type))
+        data = (addr, yaml.safe_load(payload))
+        if msg_type == 'migrate' and not self.is_prepared(data):
+            raise ValueError("Migrate {} without prepare".format(
+                get_migration_key(data)[0]))
+        self.engine.submit(msg_type, data)
+        return 'queued'
+
+    def is_prepared(self, data):
+        """Returns True if the migration of a command holds its slot, from
+        its prepare, or has a prepare waiting."""
+        name, link = get_migration_key(data)
+        with self.engine.cond:
+            migration = self.engine.migrations.get(name, None)
+            if migration is None or migration.link != link:
+                return False
+            return migration.has_slot or migration.state == 'queued' or \
+                any(cmd[0] == 'prepare' for cmd in migration.commands)
+
+    def wait_prepared(self, name, link, timeout=60):
+        """Returns True once the prepare of the migration of `name` from
+        `link` rebuilt its pre-dumps, False if it failed, was superseded or
+        did not end within `timeout` seconds."""
+        deadline = time.time() + timeout
+        with self.engine.cond:
+            while True:
+                migration = self.engine.migrations.get(name, None)
+                if migration is not None and migration.link == link:
+                    if migration.state in ('prepared', 'migrate', 'restore'):
+                        return True
+                    # no prepare running nor queued
+                    if migration.worker is None and migration.state in (
+                            'done', 'superseded', 'cancelled', 'expired'):
+                        return False
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logging.warn("{} is not prepared in time".format(name))
+                    return False
+                self.engine.cond.wait(min(remaining, 1))
+
+    def dispatch_line(self, line, addr):
+        """Queues the command of a datagram line."""
+        message = line.split(' ', 1)
+        if message[0] not in ('prepare', 'migrate') or len(message) < 2:
+            return
+        try:
+            self.dispatch(message[0], message[1], addr)
+        except yaml.YAMLError:
+            logging.error("Error parsing YAML msg {}".format(message[1]))
+
     def process_line(self, line, addr):
         message = line.split(' ', 1)
         msg_type = message[0]
@@ -236,13 +370,23 @@ class MigrateDest(MigrateNode):
                 folder = os.path.join('/tmp/', d)
                 logging.debug("Remove folder {}".format(folder))
                 shutil.rmtree(folder, ignore_errors=True)
+        self.store = ChunkStore(self.store_folder, self.store_budget)
+        self.receiver = StreamReceiver(verbose=self.debug, store=self.store,
+                                       root=self.dump_dir,
+                                       ready=self.wait_prepared)
+        self.receiver.start()
+        self.channel_server = DataChannelServer(root=self.dump_dir)
+        self.channel_server.start()
+        self.control_server = ControlServer(self.dispatch)
+        self.control_server.start()
+        # Datagrams of the sources without control channel
         while True:
-            data, addr = self.sock.recvfrom(1024)
+            data, addr = self.sock.recvfrom(65535)
             # NOTE: This approach seem not good enough
             logging.info("Receive command from {} with {}".format(addr, data))
             lines = data.split("\n")
             for line in lines[:-1]:
-                self.process_line(line, addr)
+                self.dispatch_line(line, addr)
 
 if __name__ == '__main__':
     out = check_output(['whoami'])
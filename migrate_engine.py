@@ -0,0 +1,288 @@
+"""Runs the migrations of an edge concurrently.
+
+The commands of a service run in order on a worker thread of the service,
+so the migrations of several services overlap. A migration holds a slot of
+its link, the destination IP, from its ``prepare`` command to the end of its
+``migrate`` command. At most `max_per_link` migrations share a link and
+`max_migrations` run on the edge, the others wait for a slot in the order of
+their commands.
+
+A slot is also released when a new ``prepare`` of the service supersedes
+its migration, when the migration is cancelled, and when it stays idle for
+`idle_timeout` seconds, so a pre-migration never followed by its
+``migrate`` does not hold its link.
+
+get_bw returns the share of the link bandwidth of one migration, the
+bandwidth split evenly between the migrations of the link. The share is
+advisory: the pre-copy and compression policies plan with it, but the
+transfers are not rate limited. The migrations of a link send on the
+streams of the same DataChannel and share its bandwidth as TCP does, and
+`max_per_link` bounds how many of them do.
+
+The queue wait of a migration is the time its commands waited for their
+worker and for a slot. The makespan of a busy period of the engine, from
+its first command to the end of its last command, is reported with the
+queue wait and the downtime of each migration of the period.
+
+Example::
+
+    engine = MigrationEngine({'prepare': prepare, 'migrate': migrate},
+                             key=lambda data: (data['name'], data['ip']))
+    engine.submit('prepare', data)
+"""
+from __future__ import division
+
+import time
+import logging
+import traceback
+import threading
+import collections
+
+START = 'prepare'
+END = 'migrate'
+
+class Migration(object):
+    """State of the migration of one service.
+
+    Args:
+        name (str): container name of the service.
+        link (str): IP of the destination.
+    """
+    def __init__(self, name, link):
+        self.name = name
+        self.link = link
+        self.state = 'idle'
+        # socket of the migration, the UDP socket of the commands to the
+        # destination at the source, the reserved port at the destination
+        self.sock = None
+        self.record = None
+        self.commands = collections.deque()
+        self.worker = None
+        self.has_slot = False
+        self.cancelled = False
+        # end of the last command
+        self.last_active = time.time()
+        self.queue_wait = 0
+        self.started = None
+        self.finished = None
+
+    def get_stats(self):
+        downtime = self.record.downtime if self.record is not None else 0
+        elapsed = 0
+        if self.started is not None and self.finished is not None:
+            elapsed = self.finished - self.started
+        return {'service': self.name, 'link': self.link,
+                'queue_wait': self.queue_wait, 'downtime': downtime,
+                'elapsed': elapsed}
+
+class MigrationEngine(object):
+    """Dispatches the commands of the migrations to the service workers.
+
+    Args:
+        handlers (dict): command -> handler(data).
+        key (callable): key(data) returns the name and the link of the
+            migration of a command.
+        max_per_link (int): migrations sharing a link.
+        max_migrations (int): migrations running on this edge.
+        report (callable): report(stats) is called at the end of each busy
+            period.
+        idle_timeout (float): in second, the slot of a migration without
+            command for this long is released, None never releases it.
+    """
+    def __init__(self, handlers, key, max_per_link=2, max_migrations=4,
+                 report=None, idle_timeout=300):
+        self.handlers = handlers
+        self.idle_timeout = idle_timeout
+        self.key = key
+        self.max_per_link = max_per_link
+        self.max_migrations = max_migrations
+        self.report = report
+        self.cond = threading.Condition(threading.RLock())
+        # name -> Migration
+        self.migrations = {}
+        # link -> number of migrations holding a slot
+        self.active = collections.defaultdict(int)
+        self.running = 0
+        self.waiting = []
+        self.workers = 0
+        self.busy_since = None
+        self.done = []
+
+    def get_migration(self, name, link=''):
+        with self.cond:
+            migration = self.migrations.get(name, None)
+            if migration is None or link and migration.link != link and \
+                    migration.worker is None:
+                if migration is not None and migration.has_slot:
+                    # re-planned to another destination
+                    self.release(migration, 'superseded')
+                migration = Migration(name, link)
+                self.migrations[name] = migration
+            return migration
+
+    def submit(self, cmd, data):
+        """Queues the command `cmd` of the service of `data`."""
+        name, link = self.key(data)
+        with self.cond:
+            migration = self.get_migration(name, link)
+            migration.cancelled = False
+            migration.commands.append((cmd, data, time.time()))
+            if self.busy_since is None:
+                self.busy_since = time.time()
+            if migration.worker is None:
+                migration.worker = threading.Thread(
+                    target=self.run_worker, args=(migration,),
+                    name='migrate_{}'.format(name))
+                migration.worker.daemon = True
+                self.workers += 1
+                migration.worker.start()
+
+    def run_worker(self, migration):
+        while True:
+            with self.cond:
+                if not migration.commands:
+                    migration.worker = None
+                    self.workers -= 1
+                    stats = self.end_period()
+                    break
+                cmd, data, queued = migration.commands.popleft()
+            if cmd == START:
+                migration.queue_wait = 0
+                if migration.has_slot:
+                    # the previous prepare was never followed by a migrate
+                    self.release(migration, 'superseded')
+                if not self.acquire(migration):
+                    continue
+            migration.queue_wait += time.time() - queued
+            failed = False
+            try:
+                self.handlers[cmd](data)
+            except Exception:
+                failed = True
+                logging.error("Command {} of {} failed: {}".format(
+                    cmd, migration.name, traceback.format_exc()))
+            with self.cond:
+                migration.last_active = time.time()
+                if migration.has_slot and (cmd == END or failed or
+                                           migration.cancelled):
+                    self.release(migration)
+        if stats is not None and self.report is not None:
+            self.report(stats)
+
+    def has_room(self, migration):
+        return self.running < self.max_migrations and \
+            self.active[migration.link] < self.max_per_link
+
+    def can_start(self, migration):
+        """A migration starts if it has room and no earlier migration with
+        room is waiting."""
+        for waiting in self.waiting:
+            if waiting is migration:
+                return self.has_room(migration)
+            if self.has_room(waiting):
+                return False
+        return False
+
+    def acquire(self, migration):
+        """Waits for a slot of the link of `migration`.
+
+        Returns:
+            bool: False if the migration was cancelled meanwhile.
+        """
+        with self.cond:
+            migration.state = 'queued'
+            self.waiting.append(migration)
+            while True:
+                self.expire_idle()
+                if migration.cancelled or self.can_start(migration):
+                    break
+                self.cond.wait(None if self.idle_timeout is None else
+                               max(self.idle_timeout / 10, 0.01))
+            self.waiting.remove(migration)
+            if migration.cancelled:
+                migration.state = 'cancelled'
+                self.cond.notify_all()
+                return False
+            self.active[migration.link] += 1
+            self.running += 1
+            migration.has_slot = True
+            migration.state = 'running'
+            migration.started = time.time()
+            self.cond.notify_all()
+        logging.info("Start migration of {} on link {}".format(
+            migration.name, migration.link))
+        return True
+
+    def release(self, migration, state='done'):
+        with self.cond:
+            self.active[migration.link] -= 1
+            self.running -= 1
+            migration.has_slot = False
+            migration.finished = time.time()
+            migration.state = state
+            self.done.append(migration)
+            self.cond.notify_all()
+        if state != 'done':
+            logging.warn("Release the slot of {} on link {}: {}".format(
+                migration.name, migration.link, state))
+
+    def cancel(self, name):
+        """Drops the queued commands of the migration of `name` and
+        releases its slot, at the end of its running command if any.
+
+        Returns:
+            bool: False if there is no such migration.
+        """
+        with self.cond:
+            migration = self.migrations.get(name, None)
+            if migration is None:
+                return False
+            migration.commands.clear()
+            migration.cancelled = True
+            if migration.has_slot and migration.worker is None:
+                self.release(migration, 'cancelled')
+            self.cond.notify_all()
+            return True
+
+    def expire_idle(self):
+        """Releases the slots of the migrations without command for
+        `idle_timeout` seconds."""
+        if self.idle_timeout is None:
+            return
+        now = time.time()
+        with self.cond:
+            for migration in self.migrations.values():
+                if migration.has_slot and migration.worker is None and \
+                        now - migration.last_active > self.idle_timeout:
+                    self.release(migration, 'expired')
+
+    def end_period(self):
+        """Returns the stats of the busy period if it ended, else None."""
+        if self.workers > 0 or self.running > 0 or self.busy_since is None:
+            return None
+        stats = {'makespan': time.time() - self.busy_since,
+                 'migrations': [m.get_stats() for m in self.done]}
+        self.busy_since = None
+        self.done = []
+        self.migrations = dict((k, m) for k, m in self.migrations.items()
+                               if m.worker is not None or m.has_slot)
+        logging.info("Migrations done: {}".format(stats))
+        return stats
+
+    def get_bw(self, link, bw):
+        """Returns the share of `bw` of a migration on `link`.
+
+        The share is only advisory, for the policies of the migration, it is
+        not enforced on the data channel.
+        """
+        if not bw:
+            return bw
+        with self.cond:
+            return bw / max(self.active[link], 1)
+
+    def get_stats(self):
+        with self.cond:
+            self.expire_idle()
+            return {'running': self.running, 'waiting': len(self.waiting),
+                    'links': dict((k, v) for k, v in self.active.items()
+                                  if v > 0)}
@@ -22,7 +22,14 @@ class MigrateRecord(object):
                 ("restore", 0),
                 ("size_pre_rsync", 0),
                 ("size_rsync", 0),
-                ("size_final_rsync", 0)]
+                ("size_final_rsync", 0),
+                ("dedup_hit_ratio", 0),
+                ("rounds", 0),
+                ("predicted_downtime", 0),
+                ("downtime", 0),
+                ("codec", ""),
+                ("size_sent", 0),
+                ("queue_wait", 0)]
         for key in keys:
             init_with_dict(self, kwargs, key[0], key[1])
 
@@ -48,6 +55,10 @@ class MigrateNode(object):
         self.time_xdelta = kwargs.get("time_xdelta", 0)
         self.delta_memory = kwargs.get("delta_memory", None)
         self.pre_checkpoint = kwargs.get("pre_checkpoint", None)
+        # Number of the last pre-dump, the final delta is against it
+        self.pre_dumps = kwargs.get("pre_dumps", 3)
+        # BW of the link to the destination in Mbps, None if unknown
+        self.bw = kwargs.get("bw", None)
         self.collect_report_cb = None
 
     def log_time(self, type_time, delay):
@@ -72,6 +83,13 @@ class MigrateNode(object):
         return '{}/{}_pre{}/'.format(self.get_checkpoint_folder(),
                                      self.snapshot, number)
 
+    def get_snapshot_name_stage(self):
+        return '{}_stage'.format(self.snapshot)
+
+    def get_snapshot_stage(self):
+        return '{}/{}/'.format(self.get_checkpoint_folder(),
+                               self.get_snapshot_name_stage())
+
     def get_snapshot_delta(self, old=None, new=None):
         if (old is not None) and (new is not None):
             return '{}/{}_delta_{}_{}/'.format(self.get_checkpoint_folder(),
@@ -115,6 +133,8 @@ class MigrateNode(object):
                 'time_checkpoint':self.time_checkpoint,
                 'time_xdelta':self.time_xdelta,
                 'delta_memory':self.delta_memory,
-                'pre_checkpoint':self.pre_checkpoint}
+                'pre_checkpoint':self.pre_checkpoint,
+                'pre_dumps':self.pre_dumps,
+                'bw':self.bw}
 
 
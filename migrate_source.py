@@ -33,6 +33,8 @@ import socket
 import datetime
 import argparse
 import logging
+import traceback
+import threading
 
 import shutil
 import docker
@@ -41,6 +43,10 @@ import Constants
 from diff_patch import create_xdelta_diff
 from migrate_node import MigrateNode, MigrateRecord
 from migrate_controller import MigrateController
+from migrate_codec import CompressionPolicy
+from migrate_engine import MigrationEngine
+from migrate_control import ControlClient
+from migrate_stream import StreamSender, PRE_DUMP, STAGE
 
 def backup_folder_source(folder):
     folder = folder.rstrip('/')
@@ -69,6 +75,85 @@ class MigrateSourceCallback(object):
     def source_report_cb(self, report):
         pass
 
+    def source_makespan_cb(self, stats):
+        pass
+
+def get_migration_key(data):
+    """Returns the container name and the destination IP of a command."""
+    service = MigrateNode(**data)
+    return service.get_container_name(), service.ip
+
+class PreDumpStream(threading.Thread):
+    """Runs a stream of a pre-dump in place of an asynchronous rsync.
+    `fallback` is called if the stream fails."""
+    def __init__(self, send, fallback=None):
+        super(PreDumpStream, self).__init__(name='pre_dump_stream')
+        self.daemon = True
+        self.send = send
+        self.fallback = fallback
+        self.stats = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.stats = self.send()
+        except Exception:
+            self.error = traceback.format_exc()
+            logging.error("Stream pre-dump failed: {}".format(self.error))
+            if self.fallback is not None and self.fallback() == 0:
+                self.error = None
+
+    def wait(self):
+        self.join()
+        return 0 if self.error is None else 1
+
+    def communicate(self):
+        return self.stats, self.error
+
+class PreCopyPolicy(object):
+    """Decides the pre-copy rounds from the deltas of the previous ones.
+
+    The final delta is expected to be as large as the delta of the last
+    round. Its downtime is the checkpoint and the diff of the last round,
+    plus the transfer of the delta over the link.
+
+    Args:
+        downtime_target (float): in second.
+        max_pre_dumps (int): number of the last pre-dump allowed.
+        shrink (float): another round is taken only if the delta of the last
+            one is below shrink times the delta of the previous one.
+    """
+    def __init__(self, downtime_target=1.0, max_pre_dumps=8, shrink=0.9):
+        self.downtime_target = downtime_target
+        self.max_pre_dumps = max_pre_dumps
+        self.shrink = shrink
+
+    def predict(self, stats, bw=None):
+        """Returns the predicted downtime in second.
+
+        Args:
+            stats (dict): of the last round, see MigrateSource.pre_copy_round.
+            bw (float): BW of the link in Mbps, the throughput of the last
+                transfer is used if None.
+        """
+        fixed = stats['checkpoint'] + stats['diff']
+        if bw:
+            return fixed + stats['size'] * 8 / (bw * 1e6)
+        if stats['transfer'] > 0:
+            return fixed + stats['transfer']
+        return fixed
+
+    def next_round(self, number, stats, previous=None, bw=None):
+        """Returns True if the pre-dump number+1 should be taken."""
+        if number >= self.max_pre_dumps:
+            return False
+        if self.predict(stats, bw) <= self.downtime_target:
+            return False
+        if previous is not None and \
+                stats['size'] > self.shrink * previous['size']:
+            return False
+        return True
+
 class MigrateSource(MigrateNode):
     """
     .. note::
@@ -91,10 +176,26 @@ class MigrateSource(MigrateNode):
                              'migrate': self.handle_cmd_migrate,
                              'pre_measure': self.handle_cmd_pre_measure,
                              'measure': self.handle_cmd_measure_dirty,
+                             'stage': self.handle_cmd_stage,
                              '': dummy}
-        self.controller = MigrateController()
+        # Learns the codecs and the links of all the migrations
+        self.compression = CompressionPolicy()
+        self.controller = MigrateController(kwargs.get('data_streams', 4),
+                                            self.compression)
+        self.sender = StreamSender(verbose=self.debug, dedup=True,
+                                   policy=self.compression)
         self.source_cb = MigrateSourceCallback()
-        self.records = {}
+        self.engine = MigrationEngine(self.cmd_handlers, get_migration_key,
+                                      kwargs.get('max_per_link', 2),
+                                      kwargs.get('max_migrations', 4),
+                                      report=self.report_makespan)
+        # dest IP -> ControlClient, shared by the migrations to the dest
+        self.controls = {}
+        self.controls_lock = threading.Lock()
+        self.policy = PreCopyPolicy(kwargs.get('downtime_target', 1.0),
+                                    kwargs.get('max_pre_dumps', 8))
+        # container name -> number of the last pre-dump
+        self.pre_dumps = {}
 
     def connect(self):
         self.sock.connect((self.ip, Constants.BETWEEN_EDGES_PORT))
@@ -245,21 +346,55 @@ class MigrateSource(MigrateNode):
         remote_port = data.split(" ", 1)[1]
         return remote_port
 
+    def get_migration(self, service):
+        return self.engine.get_migration(service.get_container_name(),
+                                         service.ip)
+
+    def report_makespan(self, stats):
+        self.source_cb.source_makespan_cb(stats)
+
+    def get_control(self, dest_ip):
+        with self.controls_lock:
+            control = self.controls.get(dest_ip, None)
+            if control is None:
+                control = ControlClient(dest_ip)
+                self.controls[dest_ip] = control
+            return control
+
+    def send_command(self, migration, service, msg_type):
+        """Sends a command to the destination over the control channel, in
+        a datagram if the destination does not accept the connection."""
+        payload = str(service.get_migrate_service())
+        control = self.get_control(service.ip)
+        try:
+            control.connect()
+        except socket.error as e:
+            logging.warn("No control channel to {} ({}), send a datagram".\
+                         format(service.ip, e))
+            migration.sock.sendto("{} {}\n".format(msg_type, payload),
+                (service.ip, Constants.BETWEEN_EDGES_PORT))
+            return
+        start_ = time.time()
+        reply = control.request(msg_type, payload)
+        logging.debug("{} {} to {}: {} in {}s".format(msg_type,
+            service.get_container_name(), service.ip, reply,
+            time.time() - start_))
+
     def handle_cmd_pre_measure(self, kwargs):
-        self.state = 'pre_measure'
         logging.info('Start pre-measure checkpoint')
         # This first checkpoint
         service = MigrateNode(**kwargs)
+        self.get_migration(service).state = 'pre_measure'
         self.controller.docker_verify(service)
         self.controller.docker_checkpoint(service.get_container_name(),
                                           service.get_snapshot_name_pre(1),
                                           service.get_checkpoint_folder())
 
     def handle_cmd_measure_dirty(self, kwargs):
-        self.state = 'measure'
         # Second checkpoint
         logging.info('Start measure dirty rate')
         service = MigrateNode(**kwargs)
+        self.get_migration(service).state = 'measure'
         start_checkpoint = time.time()
         self.controller.docker_checkpoint(service.get_container_name(),
                                           service.get_snapshot_name_pre(2),
@@ -282,88 +417,188 @@ class MigrateSource(MigrateNode):
         kwargs['pre_checkpoint'] = pre_migration
         self.source_cb.source_dirty_rate_cb(**kwargs)
 
+    def handle_cmd_stage(self, data):
+        """Streams a snapshot of the service to the chunk store of a likely
+        destination, the pre-dump of its migration then only sends the pages
+        dirtied since."""
+        service = MigrateNode(**data)
+        if service.method != 'stream':
+            logging.info("No staging of {} migrated by {}".format(
+                service.get_container_name(), service.method))
+            return
+        if self.engine.get_stats()['links'].get(service.ip, 0) > 0:
+            logging.info("Link to {} is migrating, skip staging of {}".format(
+                service.ip, service.get_container_name()))
+            return
+        start_ = time.time()
+        folder = service.get_snapshot_stage()
+        shutil.rmtree(folder, ignore_errors=True)
+        self.controller.docker_checkpoint(service.get_container_name(),
+                                          service.get_snapshot_name_stage(),
+                                          service.get_checkpoint_folder())
+        service.log_time('stage_checkpoint', time.time() - start_)
+        try:
+            stats = self.sender.send(service, None, folder, None,
+                                     target=STAGE)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        service.log_time('stage', time.time() - start_)
+        service.log_size('size_stage', stats['size_sent'])
+
     def handle_cmd_prepare(self, data):
-        self.state = 'prepare'
         logging.info('Start prepare migration')
         start_prepare = time.time()
         service = MigrateNode(**data)
+        migration = self.get_migration(service)
+        migration.state = 'prepare'
+        # Share of the link with the other migrations to the destination
+        service.bw = self.engine.get_bw(service.ip, service.bw)
         record = MigrateRecord(dest_ip=service.ip,
-                               service=service.get_container_name())
+                               service=service.get_container_name(),
+                               queue_wait=migration.queue_wait)
         self.controller.open_ssh_session(service.user, service.ip)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.records[service.get_container_name()] = record
+        self.controller.open_channel(service.ip, service.bw)
+        migration.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        migration.record = record
         if self.method != 'delta':
             return
         # Send pre2
-        handle_pre2 = self.controller.rsync(service.get_snapshot_pre(2),
-                                            service.user, service.ip,
-                                            service.get_checkpoint_folder(),
-                                            wait=False)
+        if service.method == 'stream':
+            handle_pre2 = self.stream_pre_dump(service, record)
+        else:
+            handle_pre2 = self.controller.transfer(
+                service.get_snapshot_pre(2), service.user, service.ip,
+                service.get_checkpoint_folder(), wait=False)
         size_pre_rsync = self.controller.measure_img_size(
             service.get_snapshot_pre(2))
         service.log_size('size_pre_rsync', size_pre_rsync)
         record.size_pre_rsync = size_pre_rsync
+        stats = self.pre_copy_round(service, 3)
+        service.log_time('pre_checkpoint', stats['checkpoint'])
+        record.pre_checkpoint = stats['checkpoint']
+        ret = handle_pre2.wait() # Log this time
+        logging.info("rsync pre2 command return code: {} , stdout: {}".\
+                     format(ret, handle_pre2.communicate()))
+        self.pre_copy(service, record, stats)
+        delta = time.time() - start_prepare
+        service.log_time('pre_rsync', delta)
+        service.log_time('prepare', delta)
+        record.prepare = delta
+        self.source_cb.source_prepare_cb(**data)
+        # Notify the destination
+        self.send_command(migration, service, 'prepare')
+
+    def pre_copy_round(self, service, number):
+        """Takes the pre-dump `number` and ships its delta against the
+        previous pre-dump, the service keeps running.
+
+        Returns:
+            dict: size of the delta in byte, time of the checkpoint, the diff
+            and the transfer of the delta in second.
+        """
+        old = number - 1
         # Checkpoint
         start_pre_cp = time.time()
         _, ret_code = self.controller.docker_checkpoint(
             service.get_container_name(),
-            service.get_snapshot_name_pre(3),
+            service.get_snapshot_name_pre(number),
             service.get_checkpoint_folder())
         if ret_code != 0:
             logging.error("Error occured while checkpoint container {}".\
                           format(service.get_container_name()))
-        delta = time.time() - start_pre_cp
-        service.log_time('pre_checkpoint', delta)
-        record.pre_checkpoint = delta
+        time_checkpoint = time.time() - start_pre_cp
+        service.log_time('pre_checkpoint_{}'.format(number), time_checkpoint)
         # Send checkpoint file to reduce the pre-migrate time
         # Exclude *.img to prevent transmitting heavy files
-        handle_pre3 = self.controller.rsync(service.get_snapshot_pre(3),
-                                            service.user, service.ip,
-                                            service.get_checkpoint_folder(),
-                                            include='*.tar.gz.img',
-                                            exclude='*.img',
-                                            wait=False)
+        handle_pre = self.controller.transfer(
+            service.get_snapshot_pre(number), service.user, service.ip,
+            service.get_checkpoint_folder(), include='*.tar.gz.img',
+            exclude='*.img', wait=False)
         # Compute delta
         start_xdelta = time.time()
-        self.controller.compute_diff(service.get_snapshot_pre(2),
-                                     service.get_snapshot_pre(3),
-                                     service.get_snapshot_delta(2,3))
-        delta = time.time() - start_xdelta
-        service.log_time('xdelta_source_2_3', delta)
-        size_rsync_2_3 = self.controller.measure_img_size(
-            service.get_snapshot_delta(2,3))
-        service.log_size('xdelta_source_2_3', size_rsync_2_3)
-        start_rsync_2_3 = time.time()
-        self.controller.rsync(service.get_snapshot_delta(2,3),
-                              service.user, service.ip,
-                              service.get_checkpoint_folder())
-        delta = time.time() - start_rsync_2_3
-        service.log_time('rsync_2_3', delta)
+        self.controller.compute_diff(service.get_snapshot_pre(old),
+                                     service.get_snapshot_pre(number),
+                                     service.get_snapshot_delta(old, number))
+        time_diff = time.time() - start_xdelta
+        service.log_time('xdelta_source_{}_{}'.format(old, number), time_diff)
+        size = int(self.controller.measure_img_size(
+            service.get_snapshot_delta(old, number)))
+        service.log_size('xdelta_source_{}_{}'.format(old, number), size)
+        start_rsync = time.time()
+        self.controller.transfer(service.get_snapshot_delta(old, number),
+                                 service.user, service.ip,
+                                 service.get_checkpoint_folder())
+        time_transfer = time.time() - start_rsync
+        service.log_time('rsync_{}_{}'.format(old, number), time_transfer)
         # Waiting for rsync commands
-        ret = handle_pre3.wait() # Log this time
-        logging.info("rsync pre3 command return code: {}, stdout: {}".\
-                     format(ret, handle_pre3.communicate()))
-        ret = handle_pre2.wait() # Log this time
-        logging.info("rsync pre2 command return code: {} , stdout: {}".\
-                     format(ret, handle_pre2.communicate()))
-        delta = time.time() - start_prepare
-        service.log_time('pre_rsync', delta)
-        service.log_time('prepare', delta)
-        record.prepare = delta
-        self.source_cb.source_prepare_cb(**data)
-        # Notify the destination
-        self.sock.sendto("prepare {}\n".format(service.get_migrate_service()),
-                         (service.ip, Constants.BETWEEN_EDGES_PORT))
+        ret = handle_pre.wait() # Log this time
+        logging.info("rsync pre{} command return code: {}, stdout: {}".\
+                     format(number, ret, handle_pre.communicate()))
+        return {'size': size, 'checkpoint': time_checkpoint,
+                'diff': time_diff, 'transfer': time_transfer}
+
+    def pre_copy(self, service, record, stats):
+        """Takes more pre-dumps while the predicted downtime is above the
+        target and the deltas shrink.
+
+        Args:
+            stats (dict): of the round of the third pre-dump.
+        """
+        number = 3
+        previous = None
+        while self.policy.next_round(number, stats, previous, service.bw):
+            logging.info("Pre-copy round {}: predicted downtime {}s".format(
+                number + 1, self.policy.predict(stats, service.bw)))
+            previous = stats
+            number += 1
+            stats = self.pre_copy_round(service, number)
+        service.pre_dumps = number
+        self.pre_dumps[service.get_container_name()] = number
+        # pre2 and the deltas of the next pre-dumps
+        record.rounds = number - 1
+        record.predicted_downtime = self.policy.predict(stats, service.bw)
+        service.log_time('predicted_downtime', record.predicted_downtime)
+
+    def stream_pre_dump(self, service, record):
+        """Streams the second pre-dump in background, sending only the pages
+        the destination does not hold. The whole pre-dump is copied like
+        rsync if the stream fails.
+
+        Returns:
+            PreDumpStream: with the wait() and communicate() of a Popen.
+        """
+        def send():
+            stats = self.sender.send(service, None,
+                                     service.get_snapshot_pre(2), None,
+                                     target=PRE_DUMP)
+            dedup = stats['dest'].get('dedup', None)
+            if dedup is not None:
+                record.dedup_hit_ratio = dedup['hit_ratio']
+                service.log_size('dedup_hit_ratio', dedup['hit_ratio'])
+            return stats
+        def fallback():
+            logging.warn("Copy the pre-dump of {} without stream".format(
+                service.get_container_name()))
+            return self.controller.transfer(service.get_snapshot_pre(2),
+                service.user, service.ip, service.get_checkpoint_folder())[1]
+        stream = PreDumpStream(send, fallback)
+        stream.start()
+        return stream
 
     def handle_cmd_migrate(self, data):
-        self.state = 'migrate'
         logging.info('Start migrate')
-        # if self.state != 'prepare':
+        service = MigrateNode(**data)
+        migration = self.get_migration(service)
+        # if migration.state != 'prepare':
         #     logging.warn("Invalid state: {} ignore this command".\
-        #                  format(self.state))
+        #                  format(migration.state))
         #     return
-        service = MigrateNode(**data)
-        record = self.records[service.get_container_name()]
+        migration.state = 'migrate'
+        service.bw = self.engine.get_bw(service.ip, service.bw)
+        record = migration.record
+        record.queue_wait = migration.queue_wait
+        service.pre_dumps = self.pre_dumps.pop(service.get_container_name(),
+                                               service.pre_dumps)
         start = time.time()
         logging.info("Send msg: migrate {} to {} at port {}".\
                      format(service.get_migrate_service(), service.ip,
@@ -381,46 +616,102 @@ class MigrateSource(MigrateNode):
         delta = time.time() - start_checkpoint
         service.log_time('checkpoint', delta)
         record.checkpoint = delta
-        handle_snapshot = self.controller.rsync(service.get_snapshot_folder(),
-                                                service.user, service.ip,
-                                                service.get_checkpoint_folder(),
-                                                include="*.tar.gz.img",
-                                                exclude="*.img", wait=False)
+        if service.method == 'stream' and self.stream_snapshot(service,
+                                                               record):
+            self.finish_migrate(service, record, start, data)
+            return
+        handle_snapshot = self.controller.transfer(
+            service.get_snapshot_folder(), service.user, service.ip,
+            service.get_checkpoint_folder(), include="*.tar.gz.img",
+            exclude="*.img", wait=False)
         start_xdelta = time.time()
         is_parallel = True
-        self.controller.compute_diff(service.get_snapshot_pre(3),
-                                     service.get_snapshot_folder(),
+        pre = service.get_snapshot_pre(service.pre_dumps)
+        self.controller.compute_diff(pre, service.get_snapshot_folder(),
                                      service.get_snapshot_delta(),
                                      is_parallel)
         delta = time.time() - start_xdelta
         service.log_time('xdelta_source', delta)
         record.xdelta_source = delta
         start_final_rsync = time.time()
-        self.controller.rsync(service.get_snapshot_delta(), service.user,
-                              service.ip, service.get_checkpoint_folder())
+        out, _ = self.controller.transfer(service.get_snapshot_delta(),
+                                          service.user, service.ip,
+                                          service.get_checkpoint_folder())
         delta = time.time() - start_final_rsync
         service.log_time('final_rsync', delta)
         record.final_rsync = delta
         ret = handle_snapshot.wait() # Log this time
         logging.info("rsync small files snapshot return: {} , stdout: {}".\
                      format(ret, handle_snapshot.communicate()))
-        self.sock.sendto("migrate {}\n".format(service.get_migrate_service()),
-                         (service.ip, Constants.BETWEEN_EDGES_PORT))
+        if isinstance(out, dict):
+            record.codec = out['codec']
+            record.size_sent = out['size_sent']
+        else:
+            # rsync -z
+            record.codec = 'rsync'
+        self.finish_migrate(service, record, start, data, measure=True)
+
+    def stream_snapshot(self, service, record):
+        """Diffs, sends and patches the snapshot file by file.
+
+        Returns:
+            bool: False if the stream failed, the snapshot must then be sent
+            with rsync.
+        """
+        start_stream = time.time()
+        try:
+            pre = service.get_snapshot_pre(service.pre_dumps)
+            stats = self.sender.send(service, pre,
+                                     service.get_snapshot_folder(),
+                                     service.get_snapshot_delta())
+        except Exception:
+            logging.error("Stream snapshot failed, fall back to rsync: {}".\
+                          format(traceback.format_exc()))
+            return False
+        logging.info("Stream snapshot: {}".format(stats))
+        # Stages overlap, xdelta_source is the busy time of the diff workers
+        record.xdelta_source = stats.get('diff', 0)
+        delta = time.time() - start_stream
+        service.log_time('final_rsync', delta)
+        record.final_rsync = delta
+        record.size_final_rsync = stats['size_sent']
+        record.codec = stats['codec']
+        record.size_sent = stats['size_sent']
+        return True
+
+    def finish_migrate(self, service, record, start, data, measure=False):
+        """Sends the migrate command and reports the migration.
+
+        Args:
+            measure (bool): measure the size of the delta folder, once the
+                migrate command is sent so it does not add to the downtime.
+        """
+        # The service is down from the final checkpoint, the restore at the
+        # destination is reported by it
+        record.downtime = time.time() - start
+        logging.info("Downtime {}s, predicted {}s after {} rounds".format(
+            record.downtime, record.predicted_downtime, record.rounds))
+        migration = self.get_migration(service)
+        self.send_command(migration, service, 'migrate')
+        if measure:
+            record.size_final_rsync = self.controller.measure_img_size(
+                service.get_snapshot_delta())
+            if record.codec == 'rsync':
+                record.size_sent = record.size_final_rsync
+        self.compression.learn(record)
         delta = time.time() - start
         service.log_time('migrate', delta)
         record.migrate = delta
-        self.sock.close()
-        size_final_rsync = self.controller.measure_img_size(
-            service.get_snapshot_delta())
-        service.log_size('size_final_rsync', size_final_rsync)
-        record.size_final_rsync = size_final_rsync
+        migration.sock.close()
+        service.log_size('size_final_rsync', record.size_final_rsync)
         # Waiting for rsync commands
         self.source_cb.source_migrate_cb(**data)
         self.source_cb.source_report_cb(record)
         # Remove old checkpoints
         backup_folder_source(service.get_checkpoint_folder())
         shutil.rmtree(service.get_checkpoint_folder(), ignore_errors=True)
-        self.controller.close_ssh_session()
+        self.controller.close_channel(service.ip)
+        self.controller.close_ssh_session(service.ip)
 
     def node_main(self):
         # remove all ssh-root files
@@ -432,7 +723,10 @@ class MigrateSource(MigrateNode):
                 os.remove(rf)
         while True:
             new_cmd = self.migrate_queue.get(True)
-            self.cmd_handlers.get(new_cmd[0], dummy)(new_cmd[1])
+            if new_cmd[0] in self.cmd_handlers:
+                self.engine.submit(new_cmd[0], new_cmd[1])
+            else:
+                dummy(cmd=new_cmd[0])
             self.migrate_queue.task_done()
 
 if __name__ == '__main__':
@@ -505,6 +799,28 @@ if __name__ == '__main__':
         '--rsync',
         help="using rsync option instead of xdelta as default.",
         action='store_true')
+    parser.add_argument(
+        '--data_streams',
+        type=int,
+        help="Connections of the data channel to the destination, 0 uses \
+            rsync. Default: 4",
+        default=4)
+    parser.add_argument(
+        '--downtime_target',
+        type=float,
+        help="Pre-copy rounds are taken until the predicted downtime is \
+            under this target in second. Default: 1.0",
+        default=1.0)
+    parser.add_argument(
+        '--max_per_link',
+        type=int,
+        help="Migrations sharing the link to a destination. Default: 2",
+        default=2)
+    parser.add_argument(
+        '--max_migrations',
+        type=int,
+        help="Migrations running at once on this edge. Default: 4",
+        default=4)
 
     args = parser.parse_args()
     args.ct = '{}{}'.format(args.service, args.eu)
@@ -527,6 +843,10 @@ if __name__ == '__main__':
                            container_img=args.cimg,
                            dump_dir=args.dump_dir,
                            debug=args.verbose,
+                           data_streams=args.data_streams,
+                           downtime_target=args.downtime_target,
+                           max_per_link=args.max_per_link,
+                           max_migrations=args.max_migrations,
                            method='rsync' if args.rsync else 'delta')
 
     client.node_main()
@@ -0,0 +1,603 @@
+"""Pipelined diff-and-transfer of the final checkpoint of a migration.
+
+The final step of a pre-copy migration used to run three stages in order:
+checkpoint, xdelta of the whole snapshot folder, then one rsync of the delta
+folder, followed at the destination by the xdelta patch of the whole folder.
+Here each CRIU image file is diffed, compressed and sent over one TCP
+connection as soon as it is ready, and the destination patches each file on
+arrival, so the stages of different files overlap on both sides.
+
+Frames, in network byte order::
+
+    kind (B), name length (H), payload length (Q), name, payload
+
+The first frame (BEGIN) carries the migrate service JSON of MigrateNode, the
+last one (END) the number of files. FILE frames carry the new file, DELTA
+frames a patch against the file of the same name in the pre-dump, written
+by the diff of the StreamSender. A file is sent in parts of PART_SIZE bytes, the MORE
+bit of the kind marks all but its last part, so neither side holds a whole
+file in memory. The parts of different files may be interleaved.
+The COMPRESSED bit of the kind marks a payload of migrate_codec, the codec
+of the transfer is chosen by a CompressionPolicy.
+
+With deduplication, a memory image sent whole is replaced by a MANIFEST
+frame: its size, chunk size and the SHA-1 of each chunk. The destination
+fills the chunks it holds in its ChunkStore and replies with a NEED frame,
+the numbers of the missing chunks (I each), and the source sends them in
+CHUNKS frames of PART_CHUNKS chunks at most.
+"""
+from __future__ import division
+
+import os
+import json
+import time
+import Queue
+import socket
+import struct
+import logging
+import threading
+import traceback
+import collections
+import multiprocessing
+
+import shutil
+import numpy as np
+
+import Constants
+from migrate_node import MigrateNode
+from diff_patch import patch_file, xdelta_delta
+from page_diff import map_file, is_pages_file
+from chunk_store import DIGEST_SIZE, PAGE_SIZE, chunk_digests
+from migrate_codec import NONE, CompressTimer, decode, get_codec
+
+BEGIN = 1
+FILE = 2
+DELTA = 3
+END = 4
+MANIFEST = 5
+NEED = 6
+CHUNKS = 7
+COMPRESSED = 0x80
+MORE = 0x40
+
+FRAME = struct.Struct('!BHQ')
+# of the parts of the files, and of the CHUNKS frames in chunks
+PART_SIZE = 4 << 20
+PART_CHUNKS = PART_SIZE // PAGE_SIZE
+# a larger frame is refused
+MAX_PAYLOAD = 256 << 20
+# size of the file, chunk size
+MANIFEST_HEADER = struct.Struct('!QI')
+
+# Folder of the destination receiving a stream
+TARGET = 'stream_target'
+SNAPSHOT = 'snapshot'
+PRE_DUMP = 'pre_dump'
+# Only fills the chunk store, see snapshot_staging
+STAGE = 'stage'
+
+class StreamError(IOError):
+    pass
+
+def check_name(name):
+    """Raises StreamError if the file name of a frame is not a plain file
+    name, a peer cannot write outside the folder of the stream."""
+    if not name or '/' in name or os.sep in name or '..' in name or \
+            '\x00' in name:
+        raise StreamError("Invalid file name {!r}".format(name))
+
+def is_delta_file(name):
+    """CRIU images other than the tarballs are sent as patches."""
+    return name.endswith('.img') and 'tar.gz.img' not in name
+
+def send_frame(sock, kind, name, payload):
+    name = name.encode('utf-8')
+    sock.sendall(FRAME.pack(kind, len(name), len(payload)) + name)
+    sock.sendall(payload)
+    return FRAME.size + len(name) + len(payload)
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise StreamError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def recv_frame(sock):
+    """Returns the kind, with its MORE bit, the name and the decoded
+    payload of the next frame."""
+    kind, name_len, payload_len = FRAME.unpack(recv_exactly(sock,
+                                                            FRAME.size))
+    if payload_len > MAX_PAYLOAD:
+        raise StreamError("Frame of {} bytes".format(payload_len))
+    name = recv_exactly(sock, name_len).decode('utf-8')
+    payload = recv_exactly(sock, payload_len)
+    if kind & COMPRESSED:
+        payload = decode(payload)
+    return kind & ~COMPRESSED, str(name), payload
+
+class StageTimes(object):
+    """Busy time of the stages of a pipeline, in second."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+        self.start = time.time()
+
+    def add(self, stage, delta):
+        with self.lock:
+            self.times[stage] = self.times.get(stage, 0.0) + delta
+
+    def get_json(self):
+        with self.lock:
+            ret = dict(self.times)
+        ret['elapsed'] = time.time() - self.start
+        return ret
+
+class StreamSender(object):
+    """Diffs the files of a snapshot folder and streams them.
+
+    Args:
+        diff (callable): diff(old, new, patch, filename, verbose) writes the
+            patch of new/filename against old/filename to patch/filename,
+            xdelta by default, diff_patch.delta_file for the page differ.
+        workers (int): number of files diffed in parallel.
+        level (int): zlib level without policy, 0 disables compression.
+        dedup (bool): send the memory images without pre-dump as manifests.
+        policy (CompressionPolicy): chooses the codec of each stream.
+    """
+    def __init__(self, diff=xdelta_delta, workers=None, level=1,
+                 verbose=False, dedup=False, policy=None):
+        self.diff = diff
+        self.workers = workers or multiprocessing.cpu_count()
+        self.level = level
+        self.verbose = verbose
+        self.dedup = dedup
+        self.policy = policy
+
+    def get_codec(self, size, bw=None, rtt=None, dest=None):
+        if self.policy is not None:
+            return self.policy.choose(size, bw, rtt, dest)
+        return get_codec('zlib-{}'.format(self.level) if self.level > 0
+                         else 'none')
+
+    def compress(self, kind, payload, times, timer):
+        if timer is not None and timer.codec.id != NONE:
+            start_ = time.time()
+            compressed = timer.compress(payload)
+            times.add('compress', time.time() - start_)
+            if len(compressed) < len(payload):
+                return kind | COMPRESSED, compressed
+        return kind, payload
+
+    def prepare_file(self, old, new, patch, name, times, timer, put):
+        """Passes the frames of the file `name` to put(frame), one part
+        at a time.
+
+        Returns:
+            bool: False if put refused a frame.
+        """
+        start_ = time.time()
+        if old is not None and is_delta_file(name) and \
+                os.path.isfile(os.path.join(old, name)):
+            self.diff(old, new, patch, name, self.verbose)
+            kind, path = DELTA, os.path.join(patch, name)
+        elif self.dedup and is_pages_file(name):
+            data = map_file(os.path.join(new, name))
+            payload = MANIFEST_HEADER.pack(len(data), PAGE_SIZE) + \
+                b''.join(chunk_digests(data, PAGE_SIZE))
+            times.add('hash', time.time() - start_)
+            return put((MANIFEST, name, payload, len(payload)))
+        else:
+            kind, path = FILE, os.path.join(new, name)
+        times.add('diff', time.time() - start_)
+        size = os.path.getsize(path)
+        offset = 0
+        with open(path, 'rb') as f:
+            while True:
+                start_ = time.time()
+                part = f.read(PART_SIZE)
+                times.add('read', time.time() - start_)
+                offset += len(part)
+                more = MORE if part and offset < size else 0
+                part_kind, payload = self.compress(kind | more, part, times,
+                                                   timer)
+                if not put((part_kind, name, payload, len(part))):
+                    return False
+                if not more:
+                    return True
+
+    def send_chunks(self, sock, path, name, times, timer):
+        """Sends the chunks of `path` requested by the NEED reply, by
+        PART_CHUNKS chunks.
+
+        Returns:
+            tuple: bytes sent, bytes of the chunks before compression.
+        """
+        kind, _, payload = recv_frame(sock)
+        if kind != NEED:
+            raise StreamError("Unexpected frame {}".format(kind))
+        data = map_file(path)
+        need = np.frombuffer(payload, dtype='>u4')
+        sent = 0
+        size = 0
+        for start in range(0, max(len(need), 1), PART_CHUNKS):
+            chunks = b''.join(data[i*PAGE_SIZE:(i + 1)*PAGE_SIZE].tobytes()
+                              for i in need[start:start + PART_CHUNKS])
+            more = MORE if start + PART_CHUNKS < len(need) else 0
+            kind, payload = self.compress(CHUNKS | more, chunks, times,
+                                          timer)
+            sent += send_frame(sock, kind, name, payload)
+            size += len(chunks)
+        return sent, size
+
+    def send_folder(self, sock, service, old, new, patch, codec=None):
+        """Streams new, as patches against old, through the connected `sock`.
+
+        Files are sent in the order their diff completes, while the next
+        files are being diffed.
+
+        Args:
+            codec (Codec): of the payloads, see get_codec by default.
+
+        Returns:
+            dict: busy time of each stage, elapsed time and sizes in byte.
+        """
+        if patch is not None:
+            shutil.rmtree(patch, ignore_errors=True)
+            os.mkdir(patch)
+        # Largest files first, the small ones fill the gaps of the workers
+        names = sorted((f for f in os.listdir(new)
+                        if os.path.isfile(os.path.join(new, f))),
+                       key=lambda f: os.path.getsize(os.path.join(new, f)),
+                       reverse=True)
+        times = StageTimes()
+        if codec is None:
+            codec = self.get_codec(sum(os.path.getsize(os.path.join(new, f))
+                                       for f in names))
+        timer = CompressTimer(codec)
+        todo = Queue.Queue()
+        for name in names:
+            todo.put(name)
+        # parts of the files ready to send, bounds the memory held
+        ready = Queue.Queue(maxsize=2*self.workers)
+        aborted = threading.Event()
+        def put(item):
+            while not aborted.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+        def worker():
+            while True:
+                try:
+                    name = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    if not self.prepare_file(old, new, patch, name, times,
+                                             timer, put):
+                        return
+                except Exception as e:
+                    logging.error("Cannot diff {}: {}".format(name,
+                        traceback.format_exc()))
+                    put(e)
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self.workers, max(len(names), 1)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            sent = send_frame(sock, BEGIN, '', json.dumps(service))
+            size_delta = 0
+            files = 0
+            while files < len(names):
+                item = ready.get()
+                if isinstance(item, Exception):
+                    raise item
+                kind, name, payload, raw_size = item
+                start_ = time.time()
+                sent += send_frame(sock, kind, name, payload)
+                if kind == MANIFEST:
+                    chunks_sent, raw_size = self.send_chunks(sock,
+                        os.path.join(new, name), name, times, timer)
+                    sent += chunks_sent
+                times.add('send', time.time() - start_)
+                size_delta += raw_size
+                if not kind & MORE:
+                    files += 1
+        finally:
+            aborted.set()
+        sent += send_frame(sock, END, '', json.dumps({'files': len(names)}))
+        # the destination acknowledges once every file is patched
+        kind, _, payload = recv_frame(sock)
+        if kind != END:
+            raise StreamError("Unexpected frame {}".format(kind))
+        timer.report(self.policy)
+        stats = times.get_json()
+        stats['files'] = len(names)
+        stats['codec'] = codec.spec
+        stats['size_delta'] = size_delta
+        stats['size_sent'] = sent
+        stats['dest'] = json.loads(payload)
+        return stats
+
+    def send(self, service, old, new, patch, timeout=60, target=SNAPSHOT):
+        """Connects to the destination of `service` and streams `new` to its
+        `target` folder, SNAPSHOT, PRE_DUMP or STAGE."""
+        start_ = time.time()
+        sock = socket.create_connection((service.ip,
+            Constants.MIGRATE_STREAM_PORT), timeout)
+        rtt = time.time() - start_
+        migrate_service = service.get_migrate_service()
+        migrate_service[TARGET] = target
+        size = sum(os.path.getsize(os.path.join(new, f))
+                   for f in os.listdir(new))
+        codec = self.get_codec(size, service.bw, rtt, service.ip)
+        try:
+            return self.send_folder(sock, migrate_service, old, new, patch,
+                                    codec)
+        finally:
+            sock.close()
+
+class StreamReceiver(threading.Thread):
+    """Receives the streamed snapshots and patches them on arrival.
+
+    Snapshots are rebuilt in the folders of the MigrateNode of the BEGIN
+    frame, from its last pre-dump. wait() returns the stats of the snapshot
+    of a container once its last file is patched. Streams of the PRE_DUMP
+    target are written to the second pre-dump folder. Streams of the STAGE
+    target fill the chunk store, their folder is removed once received.
+
+    Args:
+        patch (callable): patch(old, new, patch, filename, verbose), the
+            reverse of the diff of StreamSender.
+        store (ChunkStore): chunks reused by the manifests, and where the
+            received chunks are stored.
+        root (str): the folders of the streams must be in this folder, the
+            dump dir of the destination.
+        ready (callable): ready(container name, source IP) blocks until the
+            last pre-dump of the migration is rebuilt, and returns False if
+            it never will be. The deltas of a snapshot are only patched
+            against it once it returns True.
+    """
+    def __init__(self, port=Constants.MIGRATE_STREAM_PORT, patch=patch_file,
+                 workers=None, verbose=False, store=None, root='/tmp',
+                 ready=None):
+        super(StreamReceiver, self).__init__(name='stream_receiver')
+        self.daemon = True
+        self.root = os.path.realpath(root)
+        self.ready = ready
+        self.patch = patch
+        self.store = store
+        self.workers = workers or multiprocessing.cpu_count()
+        self.verbose = verbose
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', port))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.cond = threading.Condition()
+        self.results = {}
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=self.handle_connection,
+                                 args=(conn, addr))
+            t.daemon = True
+            t.start()
+
+    def handle_connection(self, conn, addr):
+        try:
+            self.receive(conn, addr)
+        except Exception:
+            logging.error("Stream from {} failed: {}".format(addr,
+                traceback.format_exc()))
+        finally:
+            conn.close()
+
+    def check_folder(self, folder):
+        """Raises StreamError if `folder` is not inside the root."""
+        path = os.path.realpath(folder)
+        if not path.startswith(self.root.rstrip('/') + '/'):
+            raise StreamError("{} is outside {}".format(folder, self.root))
+
+    def receive(self, conn, addr=('', 0)):
+        kind, _, payload = recv_frame(conn)
+        if kind != BEGIN:
+            raise StreamError("Unexpected frame {}".format(kind))
+        begin = json.loads(payload)
+        service = MigrateNode(**begin)
+        name = service.get_container_name()
+        target = begin.get(TARGET, SNAPSHOT)
+        old = service.get_snapshot_pre(service.pre_dumps)
+        new = service.get_snapshot_folder()
+        patch = service.get_snapshot_delta()
+        folders = [new, patch]
+        if target == PRE_DUMP:
+            new = folders[0] = service.get_snapshot_pre(2)
+        elif target == STAGE:
+            # the staged snapshot has no delta, and must not clear the
+            # folders of a migration of the container
+            new = service.get_snapshot_stage()
+            folders = [new]
+        for folder in folders + [old]:
+            self.check_folder(folder)
+        for folder in folders:
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder)
+        times = StageTimes()
+        todo = Queue.Queue(maxsize=4*self.workers)
+        errors = []
+        # the files arrive meanwhile, only the patches wait for the old
+        # pre-dump
+        ready_lock = threading.Lock()
+        ready = []
+        def is_ready():
+            with ready_lock:
+                if not ready:
+                    start_ = time.time()
+                    ready.append(target != SNAPSHOT or self.ready is None or
+                                 self.ready(name, addr[0]))
+                    times.add('ready', time.time() - start_)
+                return ready[0]
+        def worker():
+            while True:
+                filename = todo.get()
+                if filename is None:
+                    return
+                if not is_ready():
+                    errors.append(filename)
+                    continue
+                start_ = time.time()
+                try:
+                    self.patch(old, new, patch, filename, self.verbose)
+                except Exception:
+                    errors.append(filename)
+                    logging.error("Cannot patch {}: {}".format(filename,
+                        traceback.format_exc()))
+                times.add('patch', time.time() - start_)
+        threads = [threading.Thread(target=worker)
+                   for _ in range(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        files = 0
+        dedup = {'chunks': 0, 'hits': 0, 'sent': 0}
+        while True:
+            start_ = time.time()
+            kind, filename, payload = recv_frame(conn)
+            times.add('receive', time.time() - start_)
+            if kind == END:
+                break
+            check_name(filename)
+            if kind == MANIFEST:
+                files += 1
+                start_ = time.time()
+                for key, value in self.receive_chunks(conn, new, filename,
+                                                      payload).items():
+                    dedup[key] += value
+                times.add('chunks', time.time() - start_)
+                continue
+            more = kind & MORE
+            kind &= ~MORE
+            if kind not in (FILE, DELTA):
+                raise StreamError("Unexpected frame {}".format(kind))
+            folder = patch if kind == DELTA else new
+            # the folders are new, the parts are appended
+            with open(os.path.join(folder, filename), 'ab') as f:
+                f.write(payload)
+            if more:
+                continue
+            files += 1
+            if kind == DELTA:
+                todo.put(filename)
+        for _ in threads:
+            todo.put(None)
+        for t in threads:
+            t.join()
+        expected = json.loads(payload)['files']
+        if files != expected or errors:
+            raise StreamError("Stream of {} incomplete: {}/{} files, "
+                "failed {}".format(name, files, expected, errors))
+        stats = times.get_json()
+        stats['files'] = files
+        if dedup['chunks'] > 0:
+            dedup['hit_ratio'] = 1 - dedup['sent'] / dedup['chunks']
+            stats['dedup'] = dedup
+        send_frame(conn, END, '', json.dumps(stats))
+        if target == STAGE:
+            shutil.rmtree(new, ignore_errors=True)
+        if target != SNAPSHOT:
+            return
+        with self.cond:
+            self.results[name] = stats
+            self.cond.notify_all()
+
+    def receive_chunks(self, conn, folder, filename, manifest):
+        """Rebuilds `filename` from the chunk store and the missing chunks.
+
+        The chunks held in the store are written before replying, so they
+        cannot be evicted meanwhile. A chunk repeated in the file is only
+        requested once.
+
+        Returns:
+            dict: number of chunks, of chunks found in the store and of
+            chunks sent by the source.
+        """
+        size, chunk_size = MANIFEST_HEADER.unpack_from(manifest)
+        offset = MANIFEST_HEADER.size
+        digests = [manifest[i:i + DIGEST_SIZE]
+                   for i in range(offset, len(manifest), DIGEST_SIZE)]
+        missing = collections.OrderedDict()
+        hits = 0
+        path = os.path.join(folder, filename)
+        with open(path, 'wb') as f:
+            f.truncate(size)
+            for i, digest in enumerate(digests):
+                data = None
+                if self.store is not None and digest not in missing:
+                    data = self.store.get(digest)
+                if data is None:
+                    missing.setdefault(digest, []).append(i)
+                    continue
+                hits += 1
+                f.seek(i*chunk_size)
+                f.write(data)
+        need = [indexes[0] for indexes in missing.values()]
+        send_frame(conn, NEED, filename,
+                   np.array(need, dtype='>u4').tobytes())
+        pending = iter(missing.values())
+        more = MORE
+        with open(path, 'r+b') as f:
+            while more:
+                kind, _, chunks = recv_frame(conn)
+                more = kind & MORE
+                if kind & ~MORE != CHUNKS:
+                    raise StreamError("Unexpected frame {}".format(kind))
+                offset = 0
+                while offset < len(chunks):
+                    indexes = next(pending, None)
+                    if indexes is None:
+                        raise StreamError("Unrequested chunks of {}".format(
+                            filename))
+                    length = min(chunk_size, size - indexes[0]*chunk_size)
+                    chunk = chunks[offset:offset + length]
+                    offset += length
+                    for i in indexes:
+                        f.seek(i*chunk_size)
+                        f.write(chunk)
+                    if self.store is not None:
+                        self.store.put(digests[indexes[0]], chunk)
+        if next(pending, None) is not None:
+            raise StreamError("Missing chunks of {}".format(filename))
+        if self.store is not None:
+            self.store.flush()
+        return {'chunks': len(digests), 'hits': hits, 'sent': len(need)}
+
+    def wait(self, container_name, timeout=60):
+        """Returns the stats of the snapshot of `container_name`, None if it
+        is not received within `timeout` seconds."""
+        deadline = time.time() + timeout
+        with self.cond:
+            while container_name not in self.results:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            return self.results.pop(container_name)
+
+    def stop(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
@@ -0,0 +1,119 @@
+"""Latest-value mailboxes of the per-user monitor streams.
+
+Every end user publishes its RSSI scan on monitor/eu/<user> every few
+seconds. When the centralized controller falls behind, processing the queued
+scans of a user one by one only builds lag, since the planner needs the
+newest scan. The mailbox keeps one slot per user, served by one thread:
+
+* a report for a user with a pending slot is coalesced into the slot;
+* with the ``merge`` policy the slot keeps the older samples, and they are
+  ingested together with the newest one in one batch;
+* with the ``drop`` policy the older samples are discarded.
+
+Users are served in the order their slot was filled, so a chatty user cannot
+starve the others.
+
+Example::
+
+    mailbox = LatestValueMailbox(handle_scans, policy=MERGE)
+    mailbox.start()
+    mailbox.put('user1', [(timestamp, report)])
+"""
+from __future__ import division
+
+import time
+import logging
+import threading
+import traceback
+import collections
+
+MERGE = 'merge'
+DROP = 'drop'
+POLICIES = (MERGE, DROP)
+
+class LatestValueMailbox(threading.Thread):
+    """Serves the newest samples of each key on one thread.
+
+    Args:
+        handler (callable): called with (key, samples), samples being the
+            list of coalesced samples, oldest first.
+        policy (str): MERGE or DROP, what to do with the skipped samples.
+        max_samples (int): only the newest max_samples samples of a slot are
+            kept, the older ones are dropped.
+    """
+    def __init__(self, handler, policy=MERGE, max_samples=20):
+        super(LatestValueMailbox, self).__init__(name='monitor_mailbox')
+        if policy not in POLICIES:
+            raise ValueError("Unknown mailbox policy {}".format(policy))
+        self.daemon = True
+        self.handler = handler
+        self.policy = policy
+        self.max_samples = max_samples
+        self.cond = threading.Condition()
+        # key -> [time of the first sample, samples, samples of the newest
+        # report], in arrival order
+        self.slots = collections.OrderedDict()
+        self.stopped = False
+        self.received = 0
+        self.processed = 0
+        self.merged = 0
+        self.dropped = 0
+        self.total_lag = 0.0 # in second
+        self.max_lag = 0.0 # in second
+
+    def put(self, key, samples):
+        """Queues the samples of `key`, coalesced with the pending ones."""
+        with self.cond:
+            self.received += len(samples)
+            slot = self.slots.get(key, None)
+            if slot is None:
+                slot = [time.time(), [], 0]
+                self.slots[key] = slot
+                self.cond.notify()
+            pending = slot[1]
+            if self.policy == DROP:
+                self.dropped += len(pending)
+                del pending[:]
+            pending.extend(samples)
+            slot[2] = len(samples)
+            overflow = max(len(pending) - self.max_samples, 0)
+            del pending[:overflow]
+            self.dropped += overflow
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.slots and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                key, (queued, samples, newest) = self.slots.popitem(
+                    last=False)
+                lag = time.time() - queued
+                self.processed += 1
+                self.merged += max(len(samples) - newest, 0)
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+            try:
+                self.handler(key, samples)
+            except Exception:
+                logging.error("Mailbox {} failed: {}".format(key,
+                    traceback.format_exc()))
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def get_stats(self):
+        """Returns the sample counters and the queueing lag of the slots."""
+        with self.cond:
+            return {'policy': self.policy,
+                    'pending': len(self.slots),
+                    'received': self.received,
+                    'processed': self.processed,
+                    'merged': self.merged,
+                    'dropped': self.dropped,
+                    'mean_lag': self.total_lag / self.processed
+                        if self.processed > 0 else 0.0,
+                    'max_lag': self.max_lag}
@@ -1,6 +1,148 @@
+from __future__ import division
+
+import json
+import time
 import logging
+import threading
+
+import yaml
 import paho.mqtt.client as mqtt
 
+from compact_codec import is_compact, CodecError
+
+try:
+    STRING = (str, unicode)
+    NUMBER = (int, long, float)
+except NameError:
+    STRING = (str,)
+    NUMBER = (int, float)
+
+class PayloadError(yaml.YAMLError):
+    """A payload is neither JSON nor YAML, or does not match its schema.
+
+    It derives from YAMLError, so the handlers catching the errors of
+    yaml.safe_load also catch it.
+    """
+    pass
+
+def to_native(obj):
+    """Converts the ASCII unicode strings decoded by json to str, as
+    yaml.safe_load does in Python 2."""
+    if isinstance(obj, dict):
+        return {to_native(k): to_native(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [to_native(v) for v in obj]
+    elif isinstance(obj, STRING) and not isinstance(obj, str):
+        try:
+            return obj.encode('ascii')
+        except UnicodeEncodeError:
+            return obj
+    return obj
+
+def validate(obj, schema):
+    """Checks that the dict `obj` has the keys of `schema`.
+
+    Args:
+        schema (dict): key -> tuple of allowed types, or None for any type.
+    """
+    if not isinstance(obj, dict):
+        raise PayloadError("Expect an object, got {}".format(type(obj)))
+    for key, types in schema.items():
+        if key not in obj:
+            raise PayloadError("Missing key {}".format(key))
+        if types is not None and not isinstance(obj[key], types):
+            raise PayloadError("Invalid type of {}: {}".format(
+                key, type(obj[key])))
+
+class DecodeStats(object):
+    def __init__(self):
+        self.count = 0
+        self.json = 0
+        self.yaml = 0
+        self.compact = 0
+        self.errors = 0
+        self.total = 0.0 # in second
+
+    def get_json(self):
+        return {'count': self.count,
+                'json': self.json,
+                'yaml': self.yaml,
+                'compact': self.compact,
+                'errors': self.errors,
+                'total': self.total,
+                'mean': self.total/self.count if self.count > 0 else 0.0}
+
+class PayloadDecoder(object):
+    """Decodes MQTT payloads, JSON first and YAML for legacy producers.
+
+    Some producers publish '{}'.format(dict), which is YAML but not JSON.
+    Compact payloads are decoded with `codebook`, see compact_codec. The
+    decode time is recorded per topic.
+    """
+    def __init__(self, codebook=None):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.codebook = codebook
+
+    def decode(self, payload, topic, schema=None):
+        """Returns the decoded payload, None if it is empty.
+
+        Raises:
+            PayloadError: invalid payload, or mismatch with `schema`.
+        """
+        start = time.time()
+        decoder = 'json'
+        try:
+            if not payload:
+                obj = None
+            elif self.codebook is not None and is_compact(payload):
+                decoder = 'compact'
+                try:
+                    obj = self.codebook.decode(payload)
+                except CodecError as e:
+                    raise PayloadError(str(e))
+            else:
+                try:
+                    obj = to_native(json.loads(payload))
+                except ValueError:
+                    decoder = 'yaml'
+                    try:
+                        obj = yaml.safe_load(payload)
+                    except yaml.YAMLError as e:
+                        raise PayloadError(str(e))
+            if obj is not None and schema is not None:
+                validate(obj, schema)
+        except PayloadError as e:
+            logging.debug("Invalid payload on {}: {}".format(topic, e))
+            self.record(topic, start, None)
+            raise
+        self.record(topic, start, decoder)
+        return obj
+
+    def record(self, topic, start, decoder):
+        duration = time.time() - start
+        with self.lock:
+            stats = self.stats.get(topic, None)
+            if stats is None:
+                stats = DecodeStats()
+                self.stats[topic] = stats
+            stats.count += 1
+            stats.total += duration
+            if decoder is None:
+                stats.errors += 1
+            else:
+                setattr(stats, decoder, getattr(stats, decoder) + 1)
+
+    def get_stats(self):
+        """Returns the decode counts and times of each topic."""
+        with self.lock:
+            return {topic: stats.get_json()
+                    for topic, stats in self.stats.items()}
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
 class MqttClient(object):
     def __init__(self, **kwargs):
         self.client_id = kwargs.get('client_id', '')
@@ -12,6 +154,9 @@ class MqttClient(object):
         self.lwt_payload = kwargs.get('lwt_payload', 'Unexpected exit')
         self.lwt_qos = kwargs.get('lwt_qos', 1)
         self.lwt_retain = kwargs.get('lwt_retain', False)
+        self.decoder = PayloadDecoder()
+        # Subscription of the callback running in this thread
+        self.local = threading.local()
 
         self.client = mqtt.Client(client_id=self.client_id,
             clean_session=self.clean_session)
@@ -47,7 +192,22 @@ class MqttClient(object):
         #return self.client.on_publish(self.client, userdata, mid)
 
     def message_callback_add(self, sub, callback):
-        self.client.message_callback_add(sub, callback)
+        def sub_callback(client, userdata, message):
+            self.local.sub = sub
+            try:
+                return callback(client, userdata, message)
+            finally:
+                self.local.sub = None
+        self.client.message_callback_add(sub, sub_callback)
+
+    def decode_payload(self, message, schema=None):
+        """Decodes the payload of `message`, see PayloadDecoder.
+
+        The decode time is recorded under the subscription that matched the
+        message, or its topic if it is decoded outside a callback.
+        """
+        topic = getattr(self.local, 'sub', None) or message.topic
+        return self.decoder.decode(message.payload, topic, schema)
 
     def on_message(self, client, userdata, msg):
         logging.warn("Unhandled message {} on topic {} with QoS {}".format(
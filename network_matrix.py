@@ -0,0 +1,173 @@
+"""Edge-to-edge network matrices maintained from the network monitor.
+
+The central database keeps every BW/RTT measurement in the NetworkRecord
+table, while the planners only need the mean over the last few samples of
+each link. This module keeps those means as NumPy matrices that are updated
+in O(1) per measurement, so a planning round reads whole matrices instead of
+issuing one SQL query per link.
+"""
+from __future__ import division
+
+import logging
+import threading
+
+import numpy as np
+
+class NetworkMatrix(object):
+    """Windowed mean BW and RTT between every pair of edge nodes.
+
+    Each link keeps a ring buffer of the last ``window`` samples and their
+    running sums. The running sums are recomputed from the ring buffer each
+    time it wraps, so rounding errors do not accumulate.
+
+    Args:
+        window (int): number of most recent samples in the mean.
+        capacity (int): initial number of nodes, grown on demand.
+    """
+    def __init__(self, window=10, capacity=8):
+        self.window = window
+        self.lock = threading.Lock()
+        self.index = {}
+        self.names = []
+        self.version = 0
+        self.loaded = False
+        self.cache = None
+        self.bts_cache = None
+        self.alloc(capacity)
+
+    def alloc(self, capacity):
+        n = len(self.names)
+        bw_ring = np.zeros((capacity, capacity, self.window))
+        rtt_ring = np.zeros((capacity, capacity, self.window))
+        bw_sum = np.zeros((capacity, capacity))
+        rtt_sum = np.zeros((capacity, capacity))
+        count = np.zeros((capacity, capacity), dtype=np.int32)
+        pos = np.zeros((capacity, capacity), dtype=np.int32)
+        if n > 0:
+            bw_ring[:n, :n] = self.bw_ring[:n, :n]
+            rtt_ring[:n, :n] = self.rtt_ring[:n, :n]
+            bw_sum[:n, :n] = self.bw_sum[:n, :n]
+            rtt_sum[:n, :n] = self.rtt_sum[:n, :n]
+            count[:n, :n] = self.count[:n, :n]
+            pos[:n, :n] = self.pos[:n, :n]
+        self.bw_ring, self.rtt_ring = bw_ring, rtt_ring
+        self.bw_sum, self.rtt_sum = bw_sum, rtt_sum
+        self.count, self.pos = count, pos
+
+    def get_node_index(self, name):
+        idx = self.index.get(name, None)
+        if idx is None:
+            idx = len(self.names)
+            if idx >= self.count.shape[0]:
+                self.alloc(2 * self.count.shape[0])
+            self.index[name] = idx
+            self.names.append(name)
+        return idx
+
+    def update(self, source, dest, latency, bandwidth):
+        """Adds one measurement of the link source -> dest."""
+        if source is None or dest is None or latency is None or \
+            bandwidth is None:
+            logging.debug("Skip incomplete network sample {}-{}: {}, {}".\
+                          format(source, dest, latency, bandwidth))
+            return
+        with self.lock:
+            i = self.get_node_index(source)
+            j = self.get_node_index(dest)
+            k = self.pos[i, j]
+            if self.count[i, j] == self.window:
+                self.bw_sum[i, j] -= self.bw_ring[i, j, k]
+                self.rtt_sum[i, j] -= self.rtt_ring[i, j, k]
+            else:
+                self.count[i, j] += 1
+            self.bw_ring[i, j, k] = bandwidth
+            self.rtt_ring[i, j, k] = latency
+            self.bw_sum[i, j] += bandwidth
+            self.rtt_sum[i, j] += latency
+            k = (k + 1) % self.window
+            self.pos[i, j] = k
+            if k == 0:
+                self.bw_sum[i, j] = self.bw_ring[i, j].sum()
+                self.rtt_sum[i, j] = self.rtt_ring[i, j].sum()
+            self.version += 1
+
+    def get_matrices(self):
+        """Returns the mean BW and RTT of all links.
+
+        Returns:
+            tuple: (names, bw, rtt) where bw[i, j] and rtt[i, j] are the
+            means of the link names[i] -> names[j]. Links without samples
+            are NaN. The arrays are shared and read-only.
+        """
+        with self.lock:
+            if self.cache is not None and self.cache[0] == self.version:
+                return self.cache[1:]
+            n = len(self.names)
+            count = self.count[:n, :n]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                bw = np.where(count > 0, self.bw_sum[:n, :n] / count, np.nan)
+                rtt = np.where(count > 0, self.rtt_sum[:n, :n] / count,
+                               np.nan)
+            bw.setflags(write=False)
+            rtt.setflags(write=False)
+            self.cache = (self.version, list(self.names), bw, rtt)
+            return self.cache[1:]
+
+    def get_bts_matrices(self, bts_servers, servers):
+        """Derives BTS-to-edge matrices from the edge-to-edge matrices.
+
+        A BTS reaches a server through the server it is attached to: the
+        link is free if that is the server itself, otherwise it is the
+        edge-to-edge link.
+
+        Args:
+            bts_servers (list): (bts name, attached server name or None).
+            servers (list): server names of the columns.
+
+        Returns:
+            tuple: (bts names, servers, bw, rtt). Unknown links are NaN.
+        """
+        key = (self.version, tuple(bts_servers), tuple(servers))
+        if self.bts_cache is not None and self.bts_cache[0] == key:
+            return self.bts_cache[1:]
+        names, bw, rtt = self.get_matrices()
+        index = {name: i for i, name in enumerate(names)}
+        b_idx = np.array([index.get(s, -1) for _, s in bts_servers],
+                         dtype=int).reshape(-1, 1)
+        s_idx = np.array([index.get(s, -1) for s in servers],
+                         dtype=int).reshape(1, -1)
+        shape = (len(bts_servers), len(servers))
+        bts_bw = np.full(shape, np.nan)
+        bts_rtt = np.full(shape, np.nan)
+        known = (b_idx >= 0) & (s_idx >= 0)
+        if len(names) > 0:
+            rows = np.broadcast_to(np.maximum(b_idx, 0), shape)
+            cols = np.broadcast_to(np.maximum(s_idx, 0), shape)
+            bts_bw = np.where(known, bw[rows, cols], np.nan)
+            bts_rtt = np.where(known, rtt[rows, cols], np.nan)
+        attached = np.array([[b_server == s for s in servers]
+                             for _, b_server in bts_servers],
+                            dtype=bool).reshape(shape)
+        bts_bw = np.where(attached, 1e9, bts_bw)
+        bts_rtt = np.where(attached, 0, bts_rtt)
+        bts_bw.setflags(write=False)
+        bts_rtt.setflags(write=False)
+        self.bts_cache = (key, [b for b, _ in bts_servers], list(servers),
+                          bts_bw, bts_rtt)
+        return self.bts_cache[1:]
+
+    def copy(self):
+        """Returns an independent copy, used by database snapshots."""
+        with self.lock:
+            other = NetworkMatrix(self.window, self.count.shape[0])
+            other.index = dict(self.index)
+            other.names = list(self.names)
+            other.bw_ring = self.bw_ring.copy()
+            other.rtt_ring = self.rtt_ring.copy()
+            other.bw_sum = self.bw_sum.copy()
+            other.rtt_sum = self.rtt_sum.copy()
+            other.count = self.count.copy()
+            other.pos = self.pos.copy()
+            other.version = self.version
+            other.loaded = self.loaded
+            return other
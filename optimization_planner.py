@@ -4,8 +4,6 @@ import traceback
 import logging
 import itertools
 
-import pulp
-
 from planner import MigrationPlanner, PlanResult
 
 class OptimizationPlanner(MigrationPlanner):
@@ -64,13 +62,16 @@ class OptimizationPlanner(MigrationPlanner):
             return []
 
     def solve(self, cur_assign, delta_time):
+        # pulp is imported here since it is slow to import at start up
+        import pulp
         start_time = time.time()
         m_stats = self.stats
         prob = pulp.LpProblem('AllocationEdge', pulp.LpMaximize)
         black_list = []
         black_list_users = []
+        all_neighbors = m_stats.get_estimated_neighbors(self.users, delta_time)
         for u in self.users:
-            neighbors = m_stats.get_estimated_neighbor(u, delta_time)
+            neighbors = all_neighbors[u]
             if len(neighbors) == 0:
                 black_list_users.append(u)
                 continue
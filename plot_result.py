@@ -12,9 +12,12 @@ sys.path.append(os.path.join(os.path.dirname(__file__), './end-user/'))
 import Constants
 import central_database
 import simulated_mobile_eu_db as eu_database
+from export_columnar import load_table
 
 
 service_names = [Constants.YOLO, Constants.OPENFACE, Constants.SIMPLE_SERVICE]
+migration_columns = ['pre_checkpoint', 'pre_rsync', 'checkpoint',
+                     'xdelta_source', 'final_rsync', 'xdelta_dest', 'restore']
 
 def plot_downtime():
     pass
@@ -22,8 +25,7 @@ def plot_downtime():
 def plot_migration(df, file_name):
     fix, ax = plt.subplots()
     fix.suptitle('Migration time')
-    columns = ['service', 'pre_checkpoint', 'pre_rsync', 'checkpoint', 'xdelta_source',
-               'final_rsync', 'xdelta_dest', 'restore']
+    columns = ['service'] + migration_columns
     migration = df[columns].groupby('service').aggregate('mean')
     migration.plot.bar(stacked=True)
     plt.savefig('{}.eps'.format(file_name), format='eps', dpi=1000)
@@ -54,20 +56,28 @@ def filter_name(name):
 def process_service_id(df, field_name='service_id'):
     df[['service', 'user']] = df[field_name].apply(filter_name)
 
-def preprocess_centre_db(files):
-    db = central_database.DBCentral(database=f)
-    df_request = pd.read_sql_table('user_service', db.engine)
+def preprocess_centre_db(source):
+    """Loads the columns used by the plots.
+
+    Args:
+        source (str): a central database file, or its export directory
+            (see export_columnar.py).
+    """
+    df_request = load_table(source,
+        central_database.EndUserService.__tablename__,
+        columns=['service_id', 'proc_delay'])
     process_service_id(df_request)
-    df_migration = pd.read_sql_table('migrate_history', db.engine)
+    df_migration = load_table(source,
+        central_database.MigrateRecord.__tablename__,
+        columns=['service'] + migration_columns)
     df_migration['service_id'] = df_migration['service']
     process_service_id(df_migration)
-    db.close()
     return df_request, df_migration
 
 def main(server_files, eu_files):
-    dbs = map(preprocess_centre_db, server_files)
-    df_request = pd.concat([df[0] for db in dbs])
-    df_migration = pd.concat([df[1] for db in dbs])
+    dbs = list(map(preprocess_centre_db, server_files))
+    df_request = pd.concat([df[0] for df in dbs])
+    df_migration = pd.concat([df[1] for df in dbs])
     plot_cdf_e2e_delay(df_request, 'e2e_cdf')
     plot_migration(df_migration, 'service_migration')
 
@@ -75,7 +85,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '--server_files',
-        help="Server database files",
+        help="Server database files or their export directories",
         nargs='*')
     parser.add_argument(
         '--eu_files',
@@ -0,0 +1,195 @@
+"""Pre-staging of the snapshots of a service at its likely destinations.
+
+Before a user hands over, the centralized controller asks the source edge to
+stream a base snapshot of the service to the edge servers of the cells the
+user is predicted to reach next, from the RSSI regression of
+get_handover_time. The pages of the snapshot land in the chunk store of the
+destination, so the pre-dump of the ``prepare`` command only sends the
+pages dirtied since.
+
+A staging ages: past its `ttl` the staged pages drift from the memory of
+the service, it is counted as expired and may be staged again. Every
+staging ends as used, the pre-migration went to its destination while it
+was fresh, wasted, the pre-migration went elsewhere, or expired.
+
+The snapshots staged by a source edge are limited to `budget` Mbps on
+average over a `window`, so staging does not starve the migrations.
+
+Example::
+
+    staging = StagingPolicy(top_k=2)
+    for server in staging.select(end_user, source, size,
+            rank_destinations(db, end_user, staging.horizon, 2)):
+        publish('pre_stage/' + source, service_json)
+    staging.use(end_user, dest_server) # when the pre-migration starts
+"""
+from __future__ import division
+
+import time
+import logging
+import collections
+
+# Default size of a snapshot in byte, while its service did not report one
+SNAPSHOT_SIZE = 100 << 20
+
+class Staging(object):
+    """A snapshot staged at a destination."""
+    def __init__(self, source, size, expires):
+        self.source = source
+        self.size = size
+        self.expires = expires
+
+def rank_destinations(db, end_user, horizon, top_k, hysteresis=2.0,
+                      timeout=10*10**6):
+    """Returns the likely next servers of `end_user`.
+
+    The neighbor cells heard within `timeout` us are ranked by their
+    predicted time to handover, a server is ranked by its first cell.
+
+    Returns:
+        list: (server name, time to handover in second) of the `top_k`
+        servers reached within `horizon` second, soonest first.
+    """
+    assign = db.query_cur_assign(end_user)
+    if assign is None:
+        return []
+    cur_bts, cur_server = assign
+    servers = {}
+    for neighbor in db.query_neighbor(end_user, timeout):
+        if neighbor.bts == cur_bts:
+            continue
+        till_ho = db.get_handover_time(end_user, cur_bts, neighbor.bts,
+                                       hysteresis)
+        if till_ho is None or till_ho > horizon:
+            continue
+        bts = db.get_bts(neighbor.bts)
+        if bts is None or bts.server_id is None or \
+                bts.server_id == cur_server:
+            continue
+        till_ho = max(till_ho, 0)
+        if till_ho < servers.get(bts.server_id, horizon + 1):
+            servers[bts.server_id] = till_ho
+    return sorted(servers.items(), key=lambda s: s[1])[:top_k]
+
+class StagingPolicy(object):
+    """Chooses the snapshots to stage and accounts for their use.
+
+    Args:
+        top_k (int): destinations staged per user.
+        horizon (float): in second, the destinations predicted to be reached
+            later are not staged.
+        ttl (float): in second, lifetime of a staged snapshot.
+        budget (float): in Mbps, average rate of the snapshots staged by a
+            source edge over `window` second.
+        interval (float): in second, between two rankings of the
+            destinations of a user.
+    """
+    def __init__(self, top_k=2, horizon=60, ttl=120, budget=20, window=60,
+                 interval=5, clock=time.time):
+        self.top_k = top_k
+        self.horizon = horizon
+        self.ttl = ttl
+        self.budget = budget
+        self.window = window
+        self.interval = interval
+        self.clock = clock
+        # end user -> time of its last ranking
+        self.ranked = {}
+        # (end user, server) -> Staging
+        self.staged = {}
+        # source -> deque of (time, size) of its stagings in the window
+        self.sent = collections.defaultdict(collections.deque)
+        self.counts = collections.Counter()
+
+    def is_due(self, end_user):
+        """Returns True if the destinations of `end_user` are to be ranked
+        again."""
+        now = self.clock()
+        if now - self.ranked.get(end_user, now - self.interval) < \
+                self.interval:
+            return False
+        self.ranked[end_user] = now
+        return True
+
+    def get_room(self, source, now):
+        """Returns the bytes `source` may still stage in the window."""
+        sent = self.sent[source]
+        while sent and sent[0][0] <= now - self.window:
+            sent.popleft()
+        return self.budget*1e6/8*self.window - sum(s for _, s in sent)
+
+    def select(self, end_user, source, size, candidates, bw=None):
+        """Returns the destinations to stage now, and books them.
+
+        Args:
+            size (float): of the snapshot in byte, None if unknown.
+            candidates (list): (server name, time to handover), see
+                rank_destinations.
+            bw (callable): bw(source, server) in Mbps, None if unknown. A
+                snapshot that cannot reach the server before the handover
+                is not staged.
+        """
+        now = self.clock()
+        self.expire(now)
+        size = size or SNAPSHOT_SIZE
+        selected = []
+        for server, till_ho in candidates[:self.top_k]:
+            if (end_user, server) in self.staged:
+                continue
+            link = bw(source, server) if bw is not None else None
+            if link and size*8/(link*1e6) > till_ho:
+                logging.debug("Snapshot of {} too late for {}".format(
+                    end_user, server))
+                continue
+            if size > self.get_room(source, now):
+                self.counts['over_budget'] += 1
+                logging.debug("Staging budget of {} spent".format(source))
+                break
+            self.sent[source].append((now, size))
+            self.staged[(end_user, server)] = Staging(source, size,
+                                                      now + self.ttl)
+            self.counts['staged'] += 1
+            self.counts['bytes_staged'] += size
+            selected.append(server)
+        return selected
+
+    def use(self, end_user, server):
+        """Ends the stagings of `end_user` as its pre-migration to `server`
+        starts.
+
+        Returns:
+            bool: the snapshot is staged at `server`.
+        """
+        now = self.clock()
+        self.expire(now)
+        used = False
+        for key in [k for k in self.staged if k[0] == end_user]:
+            staging = self.staged.pop(key)
+            if key[1] == server:
+                used = True
+                self.counts['used'] += 1
+                self.counts['bytes_used'] += staging.size
+            else:
+                self.counts['wasted'] += 1
+        if not used:
+            self.counts['missed'] += 1
+        logging.info("Staging of {} at {}: {}, stats {}".format(end_user,
+            server, 'used' if used else 'missed', self.get_stats()))
+        return used
+
+    def expire(self, now=None):
+        if now is None:
+            now = self.clock()
+        for key in [k for k, s in self.staged.items() if s.expires <= now]:
+            del self.staged[key]
+            self.counts['expired'] += 1
+
+    def get_stats(self):
+        """Returns the counts of the stagings and the ratio used."""
+        self.expire()
+        stats = dict(self.counts)
+        stats['live'] = len(self.staged)
+        ended = self.counts['used'] + self.counts['wasted'] + \
+            self.counts['expired']
+        stats['use_ratio'] = self.counts['used']/ended if ended else None
+        return stats
@@ -0,0 +1,152 @@
+"""Opt-in profiler of the SQL statements issued by the central database.
+
+The profiler hooks the SQLAlchemy engine events and records, for each
+statement fingerprint and for each calling DBCentral/StatsEdgeSql method,
+the number of executions, the total time and the 99th percentile. Records are
+grouped by scope, e.g. the MQTT handler or the planner round that issued
+them.
+
+Example::
+
+    database = DBCentral(database='central.db', profile_sql=True)
+    with database.profile_scope('planner'):
+        planner.compute_plan()
+    database.profiler.dump('sql_profile.json')
+"""
+from __future__ import division
+
+import re
+import sys
+import json
+import time
+import logging
+import threading
+import contextlib
+import collections
+
+import numpy as np
+from sqlalchemy import event
+
+#: Classes whose methods are reported as callers
+CALLER_CLASSES = ('DBCentral', 'StatsEdgeSql')
+#: Scope of statements issued outside any profile scope
+DEFAULT_SCOPE = 'other'
+
+def get_fingerprint(statement):
+    """Normalizes a statement so that statements differing only in their
+    literals or in the length of an IN list share one fingerprint."""
+    fp = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    fp = re.sub(r'\b\d+(?:\.\d+)?\b', '?', fp)
+    fp = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', fp)
+    return re.sub(r'\s+', ' ', fp).strip()
+
+def get_caller(frame):
+    """Finds the innermost DBCentral/StatsEdgeSql method on the stack."""
+    while frame is not None:
+        obj = frame.f_locals.get('self', None)
+        if obj is not None:
+            names = [c.__name__ for c in type(obj).__mro__]
+            if any(c in names for c in CALLER_CLASSES):
+                return '{}.{}'.format(type(obj).__name__,
+                                      frame.f_code.co_name)
+        frame = frame.f_back
+    return 'unknown'
+
+class StatementStats(object):
+    """Count, total time and the latest durations of one key."""
+    def __init__(self, max_samples):
+        self.count = 0
+        self.total = 0.0 # in second
+        self.samples = collections.deque(maxlen=max_samples)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.samples.append(duration)
+
+    def get_json(self):
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total/self.count,
+                'p99': float(np.percentile(self.samples, 99))}
+
+class SQLProfiler(object):
+    """Records the SQL statements of the engines it is attached to.
+
+    Args:
+        max_samples (int): durations kept per key for the percentile.
+    """
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stats = {}
+        self.start_time = time.time()
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_execute)
+        event.listen(engine, 'handle_error', self.on_error)
+
+    def get_scope(self):
+        scopes = getattr(self.local, 'scopes', None)
+        return scopes[-1] if scopes else DEFAULT_SCOPE
+
+    @contextlib.contextmanager
+    def scope(self, name):
+        """Groups the statements issued by this thread under `name`."""
+        if not hasattr(self.local, 'scopes'):
+            self.local.scopes = []
+        self.local.scopes.append(name)
+        try:
+            yield
+        finally:
+            self.local.scopes.pop()
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault('profile_start', []).append(time.time())
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        duration = time.time() - conn.info['profile_start'].pop()
+        self.record(statement, get_caller(sys._getframe(1)), duration)
+
+    def on_error(self, context):
+        starts = context.connection.info.get('profile_start', [])
+        if starts:
+            starts.pop()
+
+    def record(self, statement, caller, duration):
+        scope = self.get_scope()
+        fingerprint = get_fingerprint(statement)
+        with self.lock:
+            groups = self.stats.setdefault(scope, ({}, {}))
+            for group, key in zip(groups, (fingerprint, caller)):
+                if key not in group:
+                    group[key] = StatementStats(self.max_samples)
+                group[key].add(duration)
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.start_time = time.time()
+
+    def get_json(self):
+        """Returns the records as a JSON-serializable dict."""
+        with self.lock:
+            scopes = {}
+            for scope, (statements, callers) in self.stats.items():
+                scopes[scope] = {
+                    'statements': {k: v.get_json()
+                                   for k, v in statements.items()},
+                    'callers': {k: v.get_json() for k, v in callers.items()}}
+            return {'start_time': self.start_time,
+                    'dump_time': time.time(),
+                    'scopes': scopes}
+
+    def dump(self, path):
+        """Writes the records as JSON to `path`."""
+        with open(path, 'w') as f:
+            json.dump(self.get_json(), f, indent=2, sort_keys=True)
+        logging.info("Dump SQL profile to {}".format(path))
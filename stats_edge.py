@@ -1,7 +1,11 @@
 import random
 import logging
+import threading
+import contextlib
 import collections
 
+import numpy as np
+
 import Constants
 import central_database as cdb
 from wifi_spec import RSSI_MAP_80211n_HT40_1_1_extend
@@ -19,6 +23,29 @@ def wifi_rssi_to_bw(rssi):
             return spec[1].dr_400ns
     return RSSI_MAP_80211n_HT40_1_1_extend[0][1].dr_400ns
 
+class LinkMatrix(object):
+    """A matrix of link values with the indexes of its row and column names.
+
+    Args:
+        rows (list): names of the rows.
+        cols (list): names of the columns.
+        values (numpy.ndarray): values[i, j] of the link rows[i] -> cols[j],
+            NaN if unknown.
+    """
+    def __init__(self, rows, cols, values):
+        self.rows = {name: i for i, name in enumerate(rows)}
+        self.cols = {name: j for j, name in enumerate(cols)}
+        self.values = values
+
+    def get(self, row, col):
+        """Looks up one link, None if unknown."""
+        i = self.rows.get(row, None)
+        j = self.cols.get(col, None)
+        if i is None or j is None:
+            return None
+        value = self.values[i, j]
+        return None if np.isnan(value) else float(value)
+
 class StatsEdge(object):
     def __init__(self, edge_nodes, netMonitor):
         self.t_checkpoints = []
@@ -161,9 +188,51 @@ class StatsEdgeSql(StatsEdge):
     """
     def __init__(self, db_control=None, **kwargs):
         if db_control is not None:
-            self.db = db_control
+            self.live_db = db_control
         else:
-            self.db = cdb.DBCentral(**kwargs)
+            self.live_db = cdb.DBCentral(**kwargs)
+        self.round_lock = threading.Lock()
+        self.round_users = 0
+        self.round_db = None
+        # Snapshot bound to the planner calls of the thread, if any
+        self.local = threading.local()
+
+    @property
+    def db(self):
+        """The snapshot of the round run by the calling thread, else the
+        live database."""
+        snap = getattr(self.local, 'db', None)
+        return snap if snap is not None else self.live_db
+
+    @contextlib.contextmanager
+    def planning_round(self):
+        """Binds the stats to one database snapshot for a planning round.
+
+        Only the calls of the thread running the round see the snapshot.
+        Nested or concurrent rounds (several planners on the same stats)
+        share the snapshot taken by the first one.
+        """
+        with self.round_lock:
+            if self.round_users == 0:
+                self.round_db = self.live_db.snapshot()
+            self.round_users += 1
+            snap = self.round_db
+        outer = getattr(self.local, 'db', None)
+        self.local.db = snap
+        if outer is None:
+            self.local.links = {}
+        try:
+            with self.live_db.profile_scope('planner'):
+                yield snap
+        finally:
+            self.local.db = outer
+            if outer is None:
+                self.local.links = None
+            with self.round_lock:
+                self.round_users -= 1
+                if self.round_users == 0:
+                    self.round_db = None
+                    snap.close()
 
     def get_cur_assign(self, u, s, b):
         usr_assign = self.db.query_cur_assign(u)
@@ -172,13 +241,42 @@ class StatsEdgeSql(StatsEdge):
     def get_usr_assign(self, u):
         return self.db.query_cur_assign(u)
 
+    def get_links(self, kind, loader):
+        """Returns the LinkMatrix pair `kind`, built once per planning
+        round."""
+        links = getattr(self.local, 'links', None)
+        if links is None:
+            return loader()
+        if kind not in links:
+            links[kind] = loader()
+        return links[kind]
+
+    def get_edge_matrices(self):
+        """Returns the (bw, rtt) LinkMatrix between edge servers."""
+        def load():
+            names, bw, rtt = self.db.get_network_matrices()
+            return LinkMatrix(names, names, bw), LinkMatrix(names, names, rtt)
+        return self.get_links('edge', load)
+
+    def get_bts_edge_matrices(self):
+        """Returns the (bw, rtt) LinkMatrix from BTSs to edge servers."""
+        def load():
+            bts, servers, bw, rtt = self.db.get_bts_network_matrices()
+            return LinkMatrix(bts, servers, bw), LinkMatrix(bts, servers, rtt)
+        return self.get_links('bts', load)
+
     def get_RTT(self, s, next_s):
         if s == next_s:
             return 0
-        return self.db.query_rtt(s, next_s)
+        rtt = self.get_edge_matrices()[1].get(s, next_s)
+        if rtt is None:
+            return self.db.query_rtt(s, next_s)
+        return rtt
 
     def get_bts_edge_RTT(self, b, s):
-        rtt = self.db.query_bts_to_edge_rtt(b, s)
+        rtt = self.get_bts_edge_matrices()[1].get(b, s)
+        if rtt is None:
+            rtt = self.db.query_bts_to_edge_rtt(b, s)
         logging.debug("RTT {} - {} [microsec]:{}".format(b,s,rtt))
         return rtt
 
@@ -212,8 +310,10 @@ class StatsEdgeSql(StatsEdge):
     def get_edge_bw(self, s, next_s):
         if s == next_s:
             return 10e9
-        else:
+        bw = self.get_edge_matrices()[0].get(s, next_s)
+        if bw is None:
             return self.db.query_bw(s, next_s)
+        return bw
 
     def get_bts_to_edge_bw(self, b, next_s):
         """Queries BW from BTS to edge server.
@@ -221,7 +321,10 @@ class StatsEdgeSql(StatsEdge):
         .. note::
             This approach assumes that the BTS always link with a edge server.
         """
-        return self.db.query_bts_to_edge_bw(b, next_s)
+        bw = self.get_bts_edge_matrices()[0].get(b, next_s)
+        if bw is None:
+            return self.db.query_bts_to_edge_bw(b, next_s)
+        return bw
 
     def get_size_server(self, s):
         return self.db.query_server_size(s)
@@ -247,9 +350,12 @@ class StatsEdgeSql(StatsEdge):
         return [ i.bts for i in ret if i.rssi > Constants.RSSI_MINIMUM ]
 
     def get_estimated_neighbor(self, u, time):
-        return self.db.query_neighbor_candidates(u,
-                                            Constants.RSSI_MINIMUM,
-                                            time)
+        return self.db.query_estimated_neighbor(u, Constants.RSSI_MINIMUM,
+                                                time)
+
+    def get_estimated_neighbors(self, users, time):
+        return self.db.query_estimated_neighbors(users, time,
+                                                 Constants.RSSI_MINIMUM)
 
     """
     ====================== Cost of migration==========================
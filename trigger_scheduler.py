@@ -0,0 +1,143 @@
+"""One thread scheduling the delayed triggers of the centralized controller.
+
+The controller delays pre-migrations, migrations and handovers until the
+time given by the planner. Instead of one ``threading.Timer`` (one thread)
+per trigger, the triggers are kept in a heap served by a single thread. Each
+trigger has a key, e.g. (end user, 'handover'): scheduling a key again
+replaces the pending trigger, and the triggers of a user can be cancelled
+when its plan is superseded.
+
+Example::
+
+    scheduler = TriggerScheduler()
+    scheduler.start()
+    scheduler.schedule(('user1', 'handover'), 1.5, trigger_handover,
+                       ('user1', handover_json))
+    scheduler.cancel_user('user1')
+"""
+from __future__ import division
+
+import time
+import heapq
+import logging
+import threading
+import traceback
+
+class TriggerScheduler(threading.Thread):
+    """Runs callbacks after a delay, in order of their deadline.
+
+    Callbacks run on the scheduler thread, one at a time, so the triggers of
+    a user fire in the order of their deadlines. A slow callback delays the
+    next ones, which shows as lateness in get_stats().
+    """
+    def __init__(self):
+        super(TriggerScheduler, self).__init__(name='trigger_scheduler')
+        self.daemon = True
+        self.cond = threading.Condition()
+        self.heap = []
+        self.entries = {}
+        self.seq = 0
+        self.stopped = False
+        self.fired = 0
+        self.cancelled = 0
+        self.total_lateness = 0.0 # in second
+        self.max_lateness = 0.0 # in second
+
+    def schedule(self, key, delay, callback, args=()):
+        """Runs callback(*args) in `delay` seconds.
+
+        A pending trigger with the same key is cancelled.
+        """
+        with self.cond:
+            self.remove(key)
+            # [deadline, sequence, key, callback, args, active]
+            entry = [time.time() + max(delay, 0), self.seq, key, callback,
+                     args, True]
+            self.seq += 1
+            self.entries[key] = entry
+            heapq.heappush(self.heap, entry)
+            self.cond.notify()
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        # the entry is dropped from the heap when it reaches the top
+        entry[-1] = False
+        self.cancelled += 1
+        return True
+
+    def cancel(self, key):
+        """Cancels the pending trigger `key`.
+
+        Returns:
+            bool: True if a trigger was pending.
+        """
+        with self.cond:
+            return self.remove(key)
+
+    def cancel_user(self, end_user):
+        """Cancels all pending triggers whose key starts with `end_user`.
+
+        Returns:
+            int: number of cancelled triggers.
+        """
+        with self.cond:
+            keys = [k for k in self.entries
+                    if isinstance(k, tuple) and k[0] == end_user]
+            for key in keys:
+                self.remove(key)
+            return len(keys)
+
+    def is_pending(self, key):
+        with self.cond:
+            return key in self.entries
+
+    def run(self):
+        while True:
+            with self.cond:
+                entry = self.pop_due()
+                if entry is None:
+                    return
+                lateness = time.time() - entry[0]
+                self.fired += 1
+                self.total_lateness += lateness
+                self.max_lateness = max(self.max_lateness, lateness)
+            callback, args = entry[3], entry[4]
+            try:
+                callback(*args)
+            except Exception:
+                logging.error("Trigger {} failed: {}".format(entry[2],
+                    traceback.format_exc()))
+
+    def pop_due(self):
+        """Waits for the next due trigger, None once stopped."""
+        while not self.stopped:
+            while self.heap and not self.heap[0][-1]:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                self.cond.wait()
+                continue
+            timeout = self.heap[0][0] - time.time()
+            if timeout > 0:
+                self.cond.wait(timeout)
+                continue
+            entry = heapq.heappop(self.heap)
+            del self.entries[entry[2]]
+            return entry
+        return None
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def get_stats(self):
+        """Returns the pending count, and the lateness of fired triggers."""
+        with self.cond:
+            return {'pending': len(self.entries),
+                    'fired': self.fired,
+                    'cancelled': self.cancelled,
+                    'mean_lateness': self.total_lateness / self.fired
+                        if self.fired > 0 else 0.0,
+                    'max_lateness': self.max_lateness}
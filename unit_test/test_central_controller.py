@@ -1,6 +1,7 @@
 import os
 import json
 import subprocess
+import threading
 import collections
 
 import pytest
@@ -787,7 +788,8 @@ class TestCentralController(object):
                         'premigration':10,
                         'size_pre_rsync':10,
                         'size_rsync':'732336',
-                        'size_final_rsync':'1538523'}))
+                        'size_final_rsync':'1538523',
+                        'dedup_hit_ratio': 0.25}))
         message_dest = MQTTMsg('{}/{}/{}'.format(Constants.MIGRATE_REPORT,
                                'dest',
                                TestCentralController.SERVER_NAME2),
@@ -801,6 +803,7 @@ class TestCentralController(object):
         assert database.session.query(db.MigrateRecord).count() == 1
         obj = database.session.query(db.MigrateRecord).first()
         assert obj.restore == 10
+        assert obj.dedup_hit_ratio == 0.25
 
     def test_failed_migrate_report(self, central):
         database = central.db
@@ -833,3 +836,55 @@ class TestCentralController(object):
         topic, payload = central.publish.call_args[0]
         payload_json = yaml.safe_load(topic)
 
+
+def test_planning_outside_locks(tmpdir):
+    database = db.DBCentral(database=str(tmpdir.join('central.db')))
+    database.register_server(name='docker1', ip='10.0.99.10', bs='edge01')
+    with mock.patch('paho.mqtt.client.Client'):
+        server = controller.CentralizedController('127.0.0.1', 1883,
+            database, planner=Constants.RANDOM_PLAN)
+    server.publish = mock.Mock()
+    planning = threading.Event()
+    release = threading.Event()
+    def compute_plan():
+        planning.set()
+        release.wait(5)
+        return []
+    server.planner.compute_plan = compute_plan
+    callbacks = {c[0][0]: c[0][1] for c in
+                 server.client.message_callback_add.call_args_list}
+    planner = threading.Thread(
+        target=server.serialized(server.trigger_other_planners))
+    planner.start()
+    assert planning.wait(5)
+    # a monitor/server message is stored while the plan is computed
+    writer = threading.Thread(target=callbacks[Constants.MONITOR_SERVER_ALL],
+        args=(None, None, MQTTMsg('monitor/server/docker1',
+                                  '{"cpu_max": 2.5, "cpu_cores": 4}')))
+    writer.start()
+    writer.join(2)
+    done = not writer.is_alive()
+    release.set()
+    planner.join(5)
+    assert done
+    assert database.get_server('docker1').core_cpu == 4
+    server.scheduler.stop()
+    database.close()
+
+def test_profile_decode_report(tmpdir):
+    database = db.DBCentral(database=str(tmpdir.join('central.db')))
+    with mock.patch('paho.mqtt.client.Client'):
+        server = controller.CentralizedController('127.0.0.1', 1883,
+            database, planner=Constants.RANDOM_PLAN)
+    server.publish = mock.Mock()
+    server.process_profile_decode(None, None,
+                                  MQTTMsg(Constants.PROFILE_DECODE, '{}'))
+    topic, payload = server.publish.call_args[0]
+    assert topic == Constants.PROFILE_DECODE_REPORT
+    report = json.loads(payload)
+    assert set(['decode', 'locks', 'topology', 'scheduler']) <= set(report)
+    assert 'write_contended' in report['locks']
+    assert report['scheduler']['pending'] == 0
+    assert 'max_lateness' in report['scheduler']
+    server.scheduler.stop()
+    database.close()
@@ -140,6 +140,105 @@ def test_multiple_thread(database):
     th2.join()
 
 
+def test_wal_mode(database):
+    mode = database.engine.execute('PRAGMA journal_mode').scalar()
+    assert mode == 'wal'
+
+def test_read_session_snapshot(database):
+    database.session.commit()
+    before = database.session.query(db.NetworkRecord).count()
+    with database.read_session() as reader:
+        assert reader.query(db.NetworkRecord).count() == before
+        def writer():
+            database.insert_obj(db.NetworkRecord(timestamp=get_time(),
+                src_node='snap_src', dest_node='snap_dst', latency=1.0, bw=1.0))
+            database.session.commit()
+        th = threading.Thread(target=writer)
+        th.start()
+        th.join()
+        # The reader keeps its snapshot while the writer commits
+        assert reader.query(db.NetworkRecord).count() == before
+        with pytest.raises(sqlalchemy.exc.OperationalError):
+            reader.execute('DELETE FROM network_monitor')
+    with database.read_session() as reader:
+        assert reader.query(db.NetworkRecord).count() == before + 1
+    stats = database.get_lock_stats()
+    assert stats['write_acquired'] > 0
+    assert stats['read_sessions'] >= 2
+    assert stats['read_active'] == 0
+
+def test_writer_lock_contention(database):
+    contended = database.get_lock_stats()['write_contended']
+    database.write_lock.acquire()
+    th = threading.Thread(target=database.session.commit)
+    th.start()
+    time.sleep(0.1)
+    database.write_lock.release()
+    th.join()
+    stats = database.get_lock_stats()
+    assert stats['write_contended'] == contended + 1
+    assert stats['write_wait_max'] >= 0.05
+
+def test_unit_of_work(database):
+    database.session.commit()
+    before = database.session.query(db.NetworkRecord).count()
+    added = threading.Event()
+    def writer():
+        with database.unit_of_work():
+            database.insert_obj(db.NetworkRecord(timestamp=get_time(),
+                src_node='uow_src', dest_node='uow_dst', latency=1.0, bw=1.0))
+            added.set()
+            time.sleep(0.1)
+            database.insert_obj(db.NetworkRecord(timestamp=get_time(),
+                src_node='uow_src', dest_node='uow_dst', latency=2.0, bw=1.0))
+            database.session.commit()
+    th = threading.Thread(target=writer)
+    th.start()
+    added.wait(1)
+    # The reader waits until the writer thread commits both records
+    with database.unit_of_work():
+        assert database.session.query(db.NetworkRecord).count() == before + 2
+    th.join()
+    with pytest.raises(ValueError):
+        with database.unit_of_work():
+            database.insert_obj(db.NetworkRecord(timestamp=get_time(),
+                src_node='uow_src', dest_node='uow_dst', latency=3.0, bw=1.0))
+            raise ValueError()
+    assert database.session.query(db.NetworkRecord).count() == before + 2
+
+def test_snapshot(database):
+    database.session.commit()
+    before = database.session.query(db.NetworkRecord).count()
+    snap = database.snapshot()
+    assert snap.query_bw('snap_src', 'snap_dst') == 1.0
+    database.insert_obj(db.NetworkRecord(timestamp=get_time(),
+        src_node='snap_src', dest_node='snap_dst', latency=1.0, bw=3.0))
+    database.session.commit()
+    assert snap.query_bw('snap_src', 'snap_dst') == 1.0
+    # Changes on the snapshot never reach the live database
+    snap.insert_obj(db.NetworkRecord(timestamp=get_time(),
+        src_node='snap_src', dest_node='snap_dst', latency=1.0, bw=100.0))
+    snap.session.commit()
+    snap.close()
+    assert database.session.query(db.NetworkRecord).count() == before + 1
+    assert database.query_bw('snap_src', 'snap_dst') == 2.0
+
+def test_snapshot_history(database):
+    old = get_time() - int((database.snapshot_history + 60)*10**6)
+    database.insert_obj(db.RSSIMonitor(timestamp=old, user_id='snap_user',
+                                       bts='snap_bts', rssi=-50))
+    database.insert_obj(db.RSSIMonitor(timestamp=get_time(),
+        user_id='snap_user', bts='snap_bts', rssi=-40))
+    database.session.commit()
+    snap = database.snapshot()
+    # only the recent monitor rows are copied
+    assert [i.rssi for i in snap.session.query(db.RSSIMonitor).\
+            filter(db.RSSIMonitor.user_id == 'snap_user')] == [-40]
+    assert snap.session.query(db.NetworkRecord).count() <= \
+        database.session.query(db.NetworkRecord).count()
+    assert snap.net_matrix.loaded
+    snap.close()
+
 def test_add_large_number(database):
     for i in range(200):
         entry = db.EndUserService(timestamp=get_time(),
@@ -166,6 +265,8 @@ def test_get_bw(database):
         database.insert_obj(entry)
     assert database.query_bw('source', 'dest') == 14.5
     assert database.query_bw('source', 'dest', size=20) == 9.5
+    assert database.query_bw('source', 'nowhere') == 0.001
+    assert database.query_bw('source', 'nowhere', default=None) is None
     assert database.query_rtt('source', 'dest') == 29
     assert database.query_rtt('source', 'dest', size=20) == 19
 
@@ -245,6 +346,9 @@ class TestDatabaseQuery(object):
         assert database.update_network_monitor_ip('10.99.99.100',
                                                   '10.99.99.2',
                                                   12.0, 150) == True
+        # the matrices only see committed records
+        assert 'test_server' not in database.get_network_matrices()[0]
+        database.session.commit()
 
     def test_get_rtt_bts_to_edge(self, database):
         assert database.query_bts_to_edge_rtt('Foo1', 'Foo2') == 10.0
@@ -254,6 +358,27 @@ class TestDatabaseQuery(object):
         assert database.query_bw('test_server', 'Foo2') == 100
         assert database.query_bw('Foo2', 'FooCentre') == 150
 
+    def test_network_matrices(self, database):
+        names, bw, rtt = database.get_network_matrices()
+        src = names.index('test_server')
+        foo2 = names.index('Foo2')
+        centre = names.index('FooCentre')
+        assert bw[src, foo2] == database.query_bw('test_server', 'Foo2')
+        assert rtt[src, centre] == database.query_rtt('test_server',
+                                                      'FooCentre')
+        assert bw[foo2, centre] == 150
+        assert np.isnan(bw[centre, foo2])
+        bts, servers, bts_bw, bts_rtt = database.get_bts_network_matrices()
+        foo1 = bts.index('Foo1')
+        assert bts_rtt[foo1, servers.index('Foo2')] == \
+            database.query_bts_to_edge_rtt('Foo1', 'Foo2')
+        assert bts_bw[foo1, servers.index('test_server')] == 1e9
+
+    def test_network_matrix_rollback(self, database):
+        database.update_network_monitor('Foo2', 'test_server', 1.0, 1)
+        database.session.rollback()
+        names, bw, rtt = database.get_network_matrices()
+        assert np.isnan(bw[names.index('Foo2'), names.index('test_server')])
 
     def test_update_container_monitor(self, database):
         container_monitor_msg = {'container': 'test_test',
@@ -387,3 +512,37 @@ class TestDatabaseQuery(object):
 
         bts = database.get_max_rssi_bts('testuser')
         assert bts.name == bts2
+
+def test_update_rssi_monitor_batch(tmpdir):
+    database = db.DBCentral(database=str(tmpdir.join('batch.db')))
+    aps = [{'name': 'bts1', 'bssid': '51:3e:aa:49:98:c1', 'passwd': '',
+            'x': 0.0, 'y': 0.0, 'server': 'docker1'},
+           {'name': 'bts2', 'bssid': '51:3e:aa:49:98:c2', 'passwd': '',
+            'x': 70.0, 'y': 0.0, 'server': 'docker2'},
+           {'name': 'bts3', 'bssid': '51:3e:aa:49:98:c3', 'passwd': '',
+            'x': 40.0, 'y': 50.0, 'server': 'docker3'}]
+    btss = []
+    for ap in aps:
+        database.register_bts(**ap)
+        btss.append(BTSInfo(**ap))
+    database.register_user(name='user1', bts='bts1', status=True)
+    t0 = get_time()
+    scans = [(t0 + i*10**6, generate_rssi_report(20 + i, 0, btss))
+             for i in range(15)]
+    rssi = database.update_rssi_monitor_batch('user1', scans)
+    assert rssi == scans[-1][1][0]['level']
+    ts, erssis = database.query_last_eRSSIs('user1', 'bts1', 15)
+    assert len(ts) == 15 and ts == sorted(set(ts))
+    levels = [report[0]['level'] for _, report in scans]
+    expected = levels[:10]
+    for level in levels[10:]:
+        expected.append(get_exp_moving_average(level, expected[-1]))
+    assert erssis == approx(expected)
+    # the predictor is fitted on the newest sample only
+    assert all(v is not None
+               for v in database.query_rssi_predictor('user1', 'bts1'))
+    x, y = database.get_user_location('user1')
+    assert (x, y) == approx((34, 0), abs=2)
+    vx, vy = database.get_user_velocity('user1')
+    assert vx == approx(1, abs=0.1)
+    database.close()
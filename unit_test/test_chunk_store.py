@@ -0,0 +1,73 @@
+import os
+import hashlib
+
+from .. chunk_store import ChunkStore, file_digests, PAGE_SIZE
+
+def test_lru_eviction(tmpdir):
+    folder = str(tmpdir.join('store'))
+    store = ChunkStore(folder, budget=3*PAGE_SIZE)
+    chunks = [os.urandom(PAGE_SIZE) for _ in range(4)]
+    digests = [hashlib.sha1(c).digest() for c in chunks]
+    for digest, chunk in zip(digests[:3], chunks[:3]):
+        store.put(digest, chunk)
+    # chunk 0 becomes the most recently used, chunk 1 is evicted
+    assert store.get(digests[0]) == chunks[0]
+    store.put(digests[3], chunks[3])
+    assert digests[1] not in store
+    assert store.get(digests[1]) is None
+    assert store.get_stats()['evicted'] == 1
+    # the store is reloaded from disk
+    reloaded = ChunkStore(folder, budget=3*PAGE_SIZE)
+    assert len(reloaded) == 3
+    assert reloaded.get(digests[3]) == chunks[3]
+
+def test_add_file(tmpdir):
+    path = str(tmpdir.join('pages-1.img'))
+    page = os.urandom(PAGE_SIZE)
+    with open(path, 'wb') as f:
+        f.write(page + page + b'\x00' * PAGE_SIZE)
+    store = ChunkStore(str(tmpdir.join('store')))
+    assert store.add_file(path) == 2
+    assert [d in store for d in file_digests(path)] == [True] * 3
+
+def test_touch_batch(tmpdir):
+    folder = str(tmpdir.join('store'))
+    store = ChunkStore(folder, touch_batch=2)
+    chunks = [os.urandom(PAGE_SIZE) for _ in range(3)]
+    digests = [hashlib.sha1(c).digest() for c in chunks]
+    for digest, chunk in zip(digests, chunks):
+        store.put(digest, chunk)
+    # the chunks used are logged by batches
+    assert store.get(digests[0]) == chunks[0]
+    assert list(ChunkStore(folder).index) == digests
+    assert store.get(digests[1]) == chunks[1]
+    assert list(ChunkStore(folder).index) == \
+        [digests[2], digests[0], digests[1]]
+    assert store.get(digests[2]) == chunks[2]
+    store.flush()
+    assert list(ChunkStore(folder).index) == \
+        [digests[0], digests[1], digests[2]]
+
+def test_segments(tmpdir):
+    folder = str(tmpdir.join('store'))
+    store = ChunkStore(folder, budget=4*PAGE_SIZE, segment_size=4*PAGE_SIZE)
+    chunks = [os.urandom(PAGE_SIZE) for _ in range(16)]
+    digests = [hashlib.sha1(c).digest() for c in chunks]
+    for i, (digest, chunk) in enumerate(zip(digests, chunks)):
+        store.put(digest, chunk)
+        # chunks 0 and 4 stay in use, in two segments
+        for j in [0, 4]:
+            if j <= i:
+                assert store.get(digests[j]) == chunks[j]
+    stats = store.get_stats()
+    assert stats['chunks'] == 4
+    # the segments of the evicted chunks are removed or compacted
+    assert stats['compacted'] > 0
+    assert stats['disk'] <= 4*PAGE_SIZE + 4*PAGE_SIZE
+    assert len(os.listdir(folder)) == stats['segments'] + 1
+    reloaded = ChunkStore(folder, budget=4*PAGE_SIZE,
+                          segment_size=4*PAGE_SIZE)
+    assert [reloaded.get(d) for d in digests[-2:]] == chunks[-2:]
+    assert [reloaded.get(digests[j]) for j in [0, 4]] == \
+        [chunks[0], chunks[4]]
+    assert digests[1] not in reloaded
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from .. import Constants
+from .. compact_codec import Codebook, CodecError, is_compact, \
+    next_generation
+from .. mqtt_protocol import PayloadDecoder, PayloadError
+
+RSSI_REPORT = {'end_user': 'user1', 'service_name': 'openface',
+               'nearbyAP': [{'SSID': 'edge01', 'BSSID': '51:3e:aa:49:98:cb',
+                             'level': -58.5},
+                            {'SSID': 'other', 'BSSID': '52:3e:aa:49:98:cb',
+                             'level': -90.25}]}
+SERVICE_REPORT = {'end_user': 'user1', 'service_name': 'openface',
+                  'startTime[ns]': 1.5e18, 'endTime[ns]': 1.6e18,
+                  'processTime[ms]': 301.27978515625, 'sentSize[B]': 5765,
+                  'ssid': 'edge02', 'bssid': '51:3e:aa:49:98:cc'}
+
+def test_round_trip():
+    controller = Codebook(['edge01', 'edge02'])
+    user = Codebook.from_json(json.loads(json.dumps(controller.get_json())))
+    for report in [RSSI_REPORT, SERVICE_REPORT]:
+        payload = user.encode(report)
+        assert is_compact(payload)
+        assert len(payload) < len(json.dumps(report)) / 2
+        assert controller.decode(payload) == report
+    # BTS added later keep the ids of the older codebook
+    controller.add('edge03')
+    assert controller.decode(user.encode(RSSI_REPORT)) == RSSI_REPORT
+
+def test_fallback_and_errors():
+    codebook = Codebook(['edge01'], generation=1)
+    report = dict(SERVICE_REPORT, bssid='unknown')
+    assert json.loads(codebook.encode(report)) == report
+    with pytest.raises(CodecError):
+        Codebook(['edge01'], generation=2).decode(
+            codebook.encode(RSSI_REPORT))
+    with pytest.raises(CodecError):
+        codebook.decode(codebook.encode(RSSI_REPORT)[:-3])
+
+def test_payload_decoder():
+    codebook = Codebook(['edge01'], generation=1)
+    decoder = PayloadDecoder(codebook)
+    topic = Constants.MONITOR_EU_ALL
+    assert decoder.decode(codebook.encode(RSSI_REPORT), topic) == RSSI_REPORT
+    assert decoder.decode(json.dumps(RSSI_REPORT), topic) == RSSI_REPORT
+    with pytest.raises(PayloadError):
+        decoder.decode(Codebook(generation=2).encode(RSSI_REPORT), topic)
+    stats = decoder.get_stats()[topic]
+    assert (stats['compact'], stats['json'], stats['errors']) == (1, 1, 1)
+
+def test_next_generation(tmpdir):
+    path = str(tmpdir.join('central.db.codebook'))
+    first = next_generation(path)
+    assert 0 <= first < 0xFFFF
+    assert next_generation(path) == (first + 1) % 0xFFFF
+    with open(path, 'w') as f:
+        f.write('65534')
+    assert next_generation(path) == 0
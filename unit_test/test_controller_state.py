@@ -0,0 +1,58 @@
+import pytest
+
+from .. import central_database as db
+from .. import controller_state
+from .. planner import PlanResult
+
+USER = 'test_user'
+SERVICE_JSON = {'end_user': USER, 'server_name': 'edge02', 'ssid': 'bts02'}
+
+@pytest.fixture
+def database(tmpdir):
+    database = db.DBCentral(database=str(tmpdir.join('old-central.db')))
+    database.register_user(name=USER, bts='bts01')
+    database.est_time_users[USER].update_time('edge01', 'edge02', 1.5, 3.0)
+    database.rssi_history[(USER, 'bts01')] = [
+        (1000, 1.0, 2.0, -50.0, -50.0, None, None, None),
+        (2000, 1.5, 2.5, -55.0, -52.0, 0.1, 0.2, 0.3)]
+    yield database
+    database.close()
+
+def test_warm_start(database, tmpdir):
+    path = str(tmpdir.join('state.pkl'))
+    migration_state = {USER: 0b000011}
+    migrating_plan = {USER: {'plan': PlanResult(USER, 'bts02', 'edge02'),
+                             'service': SERVICE_JSON}}
+    handover_plan = {USER: {'next_ssid': 'bts02'}}
+    snapshotter = controller_state.StateSnapshotter(
+        lambda: controller_state.capture_state(database, migration_state,
+                                               migrating_plan, handover_plan),
+        path)
+    assert snapshotter.save()
+    assert not snapshotter.save()
+    migration_state[USER] = 0b000111
+    assert snapshotter.save()
+    assert snapshotter.get_stats()['written'] == 2
+
+    restarted = db.DBCentral(database=str(tmpdir.join('new-central.db')))
+    state = controller_state.load_state(path)
+    m_state, m_plan, h_plan = controller_state.restore_state(restarted, state)
+    assert m_state == {USER: 0b000111}
+    assert m_plan[USER]['plan'] == PlanResult(USER, 'bts02', 'edge02')
+    assert m_plan[USER]['plan'].next_server == 'edge02'
+    assert m_plan[USER]['service'] == SERVICE_JSON
+    assert h_plan == handover_plan
+    assert restarted.t0 == database.t0
+    assert restarted.get_est_mig_time(USER, 'edge01', 'edge02') == 3.0
+    assert restarted.query_avg_t_pre_mig(USER) == 1.5
+    ts, erssi = restarted.query_last_eRSSIs(USER, 'bts01', 10)
+    assert ts == [1000, 2000]
+    assert erssi == [-50.0, -52.0]
+    assert restarted.query_rssi_predictor(USER, 'bts01') == (0.1, 0.2, 0.3)
+    restarted.close()
+
+def test_load_missing_or_corrupted(tmpdir):
+    path = str(tmpdir.join('state.pkl'))
+    assert controller_state.load_state(path) is None
+    controller_state.save_state(path, b'garbage')
+    assert controller_state.load_state(path) is None
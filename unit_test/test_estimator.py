@@ -1,10 +1,28 @@
 import pytest
 
 from .. import estimator
+from .. import benchmark_import
 
 def test_coeffs():
     assert len(estimator.handover_coeffs) == 3
 
+def test_coeffs_match_symbolic():
+    sympy = pytest.importorskip('sympy')
+    x_src, y_src, x_dst, y_dst = sympy.symbols('x_src y_src x_dst y_dst')
+    x, a, b, omega = sympy.symbols('x a b omega')
+    y = a*x + b
+    eq = (x-x_src)**2 + (y-y_src)**2 - omega*((x-x_dst)**2 + (y-y_dst)**2)
+    symbolic = sympy.expand(eq).as_poly(x).all_coeffs()
+    values = (0.5, -3.0, 70.0, 20.0, 140.0, -5.0, 2.5)
+    subs = dict(zip((a, b, x_src, y_src, x_dst, y_dst, omega), values))
+    for coeff, expected in zip(estimator.handover_coeffs, symbolic):
+        assert coeff(*values) == pytest.approx(float(expected.subs(subs)))
+
+def test_lazy_imports():
+    result = benchmark_import.measure_import('centralized_controller',
+                                             repeat=1)
+    assert result['heavy'] == []
+
 def test_find_handover_points_hys0():
     hys = 0
     a = 1
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+import sqlalchemy
+
+from .. import central_database as db
+from .. import export_columnar
+
+@pytest.fixture(scope='module')
+def database(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('export').join('testcentral.db'))
+    d = db.DBCentral(database=path)
+    for i in range(25):
+        d.insert_obj(db.NetworkRecord(timestamp=i, src_node='docker1',
+                                      dest_node='docker2', latency=2.0*i,
+                                      bw=i))
+        d.insert_obj(db.EndUserService(timestamp=i, user_id='test',
+                                       service_id='yolotest', ssid='edge01',
+                                       proc_delay=1.5*i, request_size=i))
+    d.close()
+    return path
+
+def test_iter_chunks(database):
+    engine = sqlalchemy.create_engine('sqlite:///{}'.format(database))
+    table = db.NetworkRecord.__table__
+    chunks = list(export_columnar.iter_chunks(engine, table,
+                                              ['timestamp', 'bw'], 10))
+    assert [len(c['bw']) for c in chunks] == [10, 10, 5]
+    assert sorted(chunks[0].keys()) == ['bw', 'timestamp']
+
+def test_load_table_sqlite(database):
+    df = export_columnar.load_table(database, 'user_service',
+                                    columns=['proc_delay'])
+    assert list(df.columns) == ['proc_delay']
+    assert len(df) == 25
+
+@pytest.mark.parametrize('fmt', ['parquet', 'arrow'])
+def test_export_database(database, tmpdir, fmt):
+    pytest.importorskip('pyarrow')
+    out_dir = str(tmpdir.join(fmt))
+    exported = export_columnar.export_database(database, out_dir, fmt=fmt,
+                                               chunk_size=7)
+    assert sorted(exported.keys()) == ['migrate_history', 'network_monitor',
+                                       'rssi_monitor', 'user_service']
+    df = export_columnar.load_table(out_dir, 'network_monitor',
+                                    columns=['timestamp', 'latency'])
+    assert list(df.columns) == ['timestamp', 'latency']
+    assert list(df['latency']) == [2.0*i for i in range(25)]
+    assert len(export_columnar.load_table(out_dir, 'rssi_monitor')) == 0
+
+@pytest.mark.parametrize('fmt', ['parquet', 'arrow'])
+def test_export_partitions(database, tmpdir, monkeypatch, fmt):
+    pytest.importorskip('pyarrow')
+    monkeypatch.setattr(export_columnar, 'TIMESTAMP_UNIT', 1)
+    out_dir = str(tmpdir.join(fmt))
+    exported = export_columnar.export_database(database, out_dir, fmt=fmt,
+                                               chunk_size=7, partition=10)
+    folder = exported['network_monitor']
+    paths = sorted(os.listdir(folder))
+    assert [export_columnar.get_partition_start(p) for p in paths] == \
+        [0, 10, 20]
+    df = export_columnar.load_table(out_dir, 'network_monitor',
+                                    columns=['latency'], start=8, end=13)
+    assert list(df.columns) == ['latency']
+    assert list(df['latency']) == [2.0*i for i in range(8, 13)]
+    df = export_columnar.load_table(out_dir, 'network_monitor', start=20)
+    assert list(df['timestamp']) == list(range(20, 25))
+    df = export_columnar.load_table(database, 'network_monitor',
+                                    columns=['latency'], start=8, end=13)
+    assert list(df['latency']) == [2.0*i for i in range(8, 13)]
+
+def test_export_single_file(database, tmpdir):
+    pytest.importorskip('pyarrow')
+    out_dir = str(tmpdir.join('single'))
+    exported = export_columnar.export_database(database, out_dir,
+                                               partition=0)
+    assert os.path.isfile(exported['user_service'] + '.parquet')
+    df = export_columnar.load_table(out_dir, 'user_service',
+                                    columns=['proc_delay'])
+    assert list(df['proc_delay']) == [1.5*i for i in range(25)]
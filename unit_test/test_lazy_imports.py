@@ -0,0 +1,9 @@
+import pytest
+
+from .. import benchmark_import
+
+@pytest.mark.parametrize('module', ['central_database',
+                                    'centralized_controller'])
+def test_lazy_imports(module):
+    result = benchmark_import.measure_import(module, repeat=1)
+    assert result['heavy'] == []
@@ -0,0 +1,87 @@
+import os
+import time
+import socket
+import multiprocessing
+
+from .. import migrate_channel
+from .. migrate_stream import FRAME
+
+def serve(root, ports):
+    server = migrate_channel.DataChannelServer(port=0, root=root)
+    ports.put(server.port)
+    server.run()
+
+def write_files(folder, files):
+    os.makedirs(folder)
+    for name, data in files.items():
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(data)
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_copy_between_processes(tmpdir):
+    files = {'pages-1.img': os.urandom(3 << 20), 'core-1.img': b'\x01'*512,
+             'rootfs-diff.tar.gz.img': os.urandom(100), 'empty': b''}
+    source = str(tmpdir.join('src', 'snapshot_pre3'))
+    write_files(source, files)
+    dest = str(tmpdir.mkdir('dst'))
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(dest, ports))
+    process.daemon = True
+    process.start()
+    try:
+        channel = migrate_channel.DataChannel('127.0.0.1', ports.get(True, 5),
+                                              streams=3)
+        channel.connect()
+        # small files only, as the rsync of the pre-dump tarball
+        stats = channel.copy(source + '/', dest, include='*.tar.gz.img',
+                             exclude='*.img')
+        assert sorted(os.listdir(os.path.join(dest, 'snapshot_pre3'))) == \
+            ['empty', 'rootfs-diff.tar.gz.img']
+        # the same connections are used by the next stages
+        stats = channel.copy(source, dest)
+        assert stats['files'] == 4
+        assert stats['bytes'] == sum(len(v) for v in files.values())
+        for name, data in files.items():
+            assert read(os.path.join(dest, 'snapshot_pre3', name)) == data
+        channel.close()
+    finally:
+        process.terminate()
+
+def test_resume(tmpdir):
+    data = os.urandom(1 << 20)
+    source = str(tmpdir.join('pages-1.img'))
+    with open(source, 'wb') as f:
+        f.write(data)
+    dest = str(tmpdir.mkdir('dst').join('pages-1.img'))
+    server = migrate_channel.DataChannelServer(port=0, root=str(tmpdir))
+    server.start()
+    channel = migrate_channel.DataChannel('127.0.0.1', server.port)
+    # a stream breaks in the middle of the file
+    sock = channel.open_stream()
+    name = dest.encode('utf-8')
+    sock.sendall(FRAME.pack(migrate_channel.DATA, len(name),
+        migrate_channel.DATA_HEADER.size + len(data)) + name +
+        migrate_channel.DATA_HEADER.pack(0, len(data)) + data[:1000])
+    sock.close()
+    deadline = time.time() + 5
+    while not os.path.exists(dest) and time.time() < deadline:
+        time.sleep(0.01)
+    channel.pool.put(None)
+    sent, wire = channel.send_retry(source, dest)
+    assert channel.resumed == 1
+    assert sent == wire == len(data) - 1000
+    assert read(dest) == data
+    # files outside the root are refused
+    channel.pool.put(None)
+    channel.retries = 0
+    try:
+        channel.send_retry(source, '/etc/pages-1.img')
+        assert False
+    except (socket.error, OSError, migrate_channel.StreamError):
+        pass
+    assert not os.path.exists('/etc/pages-1.img')
+    channel.close()
+    server.stop()
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+from .. import migrate_codec
+from .. import migrate_channel
+from .. migrate_node import MigrateRecord
+
+def test_codec_round_trip():
+    data = os.urandom(1000) + b'\x00'*100000
+    for spec in migrate_codec.CODECS:
+        codec = migrate_codec.get_codec(spec)
+        assert migrate_codec.is_available(codec.spec)
+        payload = codec.compress(data)
+        assert migrate_codec.decode(payload) == data
+        if spec != 'none':
+            assert len(payload) < len(data)
+    with pytest.raises(ValueError):
+        migrate_codec.decode(b'\x7f')
+
+def test_policy(monkeypatch):
+    monkeypatch.setattr(migrate_codec, 'get_headroom', lambda: 4)
+    policy = migrate_codec.CompressionPolicy(codecs=['none', 'zlib-1',
+                                                     'zlib-6'], workers=4)
+    # unknown link
+    assert policy.choose(1 << 30).spec == 'zlib-1'
+    # fast links are not worth compressing, slow links compress harder
+    assert policy.choose(1 << 30, bw=10000).spec == 'none'
+    assert policy.choose(1 << 30, bw=10).spec == 'zlib-6'
+    # a long RTT bounds the throughput of a fast link
+    assert policy.get_bw(10000, rtt=0.1) == pytest.approx(
+        migrate_codec.TCP_WINDOW / 0.1)
+    # zlib-6 turns out worse than zlib-1 on these images
+    for _ in range(20):
+        policy.update('zlib-6', 1000, 600, 1000 / 20e6)
+    assert policy.choose(1 << 30, bw=10).spec == 'zlib-1'
+    # the link is learned from the migrations
+    policy.learn(MigrateRecord(dest_ip='10.0.0.2', size_sent=10 << 20,
+                               final_rsync=1.0))
+    assert policy.get_stats()['links']['10.0.0.2'] == 10 << 20
+    assert policy.choose(1 << 30, dest='10.0.0.2').spec == 'zlib-1'
+    # rsync transfers are not learned
+    policy.learn(MigrateRecord(dest_ip='10.0.0.3', codec='rsync',
+                               size_sent=10 << 20, final_rsync=1.0))
+    assert '10.0.0.3' not in policy.get_stats()['links']
+
+def test_compressed_channel(tmpdir):
+    data = b'\x00'*(migrate_channel.BLOCK_SIZE + 5000) + os.urandom(3000)
+    source = tmpdir.mkdir('src')
+    source.join('pages-1.img').write(data, 'wb')
+    source.join('empty').write(b'', 'wb')
+    dest = str(tmpdir.mkdir('dst'))
+    server = migrate_channel.DataChannelServer(port=0, root=str(tmpdir))
+    server.start()
+    policy = migrate_codec.CompressionPolicy(codecs=['zlib-1'])
+    channel = migrate_channel.DataChannel('127.0.0.1', server.port, bw=10)
+    channel.connect()
+    assert channel.rtt > 0
+    stats = channel.copy(str(source), dest, policy=policy)
+    assert stats['codec'] == 'zlib-1'
+    assert stats['bytes'] == len(data)
+    assert stats['size_sent'] < len(data) // 10
+    assert open(os.path.join(dest, 'src', 'pages-1.img'), 'rb').read() == \
+        data
+    assert os.path.getsize(os.path.join(dest, 'src', 'empty')) == 0
+    assert policy.get_stats()['codecs']['zlib-1'][0] < 0.5
+    channel.close()
+    server.stop()
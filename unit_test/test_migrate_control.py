@@ -0,0 +1,63 @@
+import socket
+import threading
+
+import pytest
+
+from .. import migrate_control
+
+@pytest.fixture
+def server():
+    received = []
+    def handler(msg_type, payload, addr):
+        received.append((msg_type, payload))
+        if msg_type == 'fail':
+            raise ValueError("Unknown command fail")
+        return payload.upper()
+    s = migrate_control.ControlServer(handler, port=0)
+    s.received = received
+    s.start()
+    yield s
+    s.stop()
+
+def test_pipelined_requests(server):
+    client = migrate_control.ControlClient('127.0.0.1', server.port)
+    pending = [client.send('prepare', 'service {}'.format(i))
+               for i in range(20)]
+    assert [p.wait(5) for p in pending] == \
+        ['SERVICE {}'.format(i) for i in range(20)]
+    # a service JSON larger than a datagram of the old protocol
+    payload = 'x' * 100000
+    assert client.request('migrate', payload) == payload.upper()
+    with pytest.raises(migrate_control.ControlError):
+        client.request('fail', '')
+    # requests from several threads share the connection
+    replies = []
+    threads = [threading.Thread(target=lambda i=i: replies.append(
+        client.request('prepare', str(i)))) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(replies) == [str(i) for i in range(8)]
+    # a closed connection is opened again
+    client.close()
+    assert client.request('migrate', 'again') == 'AGAIN'
+    assert len(server.received) == 31
+    client.close()
+
+def test_lost_connection():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1)
+    def accept():
+        conn, _ = sock.accept()
+        conn.recv(16)
+        conn.close()
+    t = threading.Thread(target=accept)
+    t.daemon = True
+    t.start()
+    client = migrate_control.ControlClient('127.0.0.1',
+                                           sock.getsockname()[1], timeout=5)
+    with pytest.raises(socket.error):
+        client.request('prepare', 'service')
+    sock.close()
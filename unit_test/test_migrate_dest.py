@@ -1,3 +1,6 @@
+import time
+import threading
+
 import mock
 import pytest
 
@@ -85,4 +88,91 @@ def test_process_line(mock_socket):
     d.handle_cmd_migrate.assert_called()
     d.handle_cmd_prepare.assert_called()
 
+@mock.patch('socket.socket')
+@mock.patch('docker.from_env')
+def test_concurrent_migrations(mock_docker, mock_socket):
+    d = migrate_dest.MigrateDest()
+    calls = []
+    restoring = threading.Event()
+    restored = threading.Event()
+    def migrate(addr, **kwargs):
+        calls.append(('migrate', kwargs['end_user']))
+        restoring.set()
+        restored.wait(5)
+    d.handle_cmd_prepare = mock.Mock(side_effect=lambda addr, **kwargs:
+                                     calls.append(('prepare',
+                                                   kwargs['end_user'])))
+    d.handle_cmd_migrate = mock.Mock(side_effect=migrate)
+    kwargs = {
+        'service_name': Constants.OPENFACE,
+        'ip' : '10.0.99.10',
+        'server_name' : 'docker1',
+        'port' : 9900,
+        'container_img' : Constants.OPENFACE_DOCKER_IMAGE,
+        'container_port' : 9999,
+        'method' : 'delta'}
+    addr = ('10.0.99.11', Constants.BETWEEN_EDGES_PORT)
+    d.dispatch_line('prepare {}'.format(dict(kwargs, end_user='u1')), addr)
+    d.dispatch_line('migrate {}'.format(dict(kwargs, end_user='u1')), addr)
+    assert restoring.wait(5)
+    # the second service is prepared while the first one is restoring
+    d.dispatch_line('prepare {}'.format(dict(kwargs, end_user='u2')), addr)
+    deadline = time.time() + 5
+    while ('prepare', 'u2') not in calls and time.time() < deadline:
+        time.sleep(0.01)
+    assert calls == [('prepare', 'u1'), ('migrate', 'u1'), ('prepare', 'u2')]
+    assert d.engine.get_stats()['running'] == 2
+    restored.set()
+    migration = d.engine.get_migration('{}u2'.format(Constants.OPENFACE))
+    assert migration.queue_wait < 1
+
+@mock.patch('socket.socket')
+@mock.patch('docker.from_env')
+def test_migrate_without_prepare(mock_docker, mock_socket):
+    d = migrate_dest.MigrateDest()
+    d.controller = mock.Mock()
+    d.handle_cmd_prepare = mock.Mock(side_effect=RuntimeError('pull'))
+    kwargs = {'service_name': Constants.OPENFACE, 'end_user': 'u3',
+              'method': 'delta'}
+    addr = ('10.0.99.11', Constants.BETWEEN_EDGES_PORT)
+    with pytest.raises(ValueError):
+        d.dispatch('migrate', str(kwargs), addr)
+    # a failed prepare releases its slot, its migrate is refused
+    d.dispatch('prepare', str(kwargs), addr)
+    deadline = time.time() + 5
+    while (d.engine.workers or not d.handle_cmd_prepare.called) and \
+            time.time() < deadline:
+        time.sleep(0.01)
+    with pytest.raises(ValueError):
+        d.dispatch('migrate', str(kwargs), addr)
+    # a migrate that was queued behind the failed prepare
+    with pytest.raises(RuntimeError):
+        migrate_dest.MigrateDest.handle_cmd_migrate(d, addr, **kwargs)
+    d.controller.docker_restore.assert_not_called()
 
+@mock.patch('socket.socket')
+@mock.patch('docker.from_env')
+def test_wait_prepared(mock_docker, mock_socket):
+    d = migrate_dest.MigrateDest()
+    rebuilding = threading.Event()
+    rebuilt = threading.Event()
+    def prepare(addr, **kwargs):
+        rebuilding.set()
+        rebuilt.wait(5)
+        migration = d.engine.get_migration('{}u4'.format(Constants.OPENFACE),
+                                           addr[0])
+        with d.engine.cond:
+            migration.state = 'prepared'
+            d.engine.cond.notify_all()
+    d.handle_cmd_prepare = mock.Mock(side_effect=prepare)
+    kwargs = {'service_name': Constants.OPENFACE, 'end_user': 'u4',
+              'method': 'stream'}
+    addr = ('10.0.99.11', Constants.BETWEEN_EDGES_PORT)
+    name = '{}u4'.format(Constants.OPENFACE)
+    d.dispatch('prepare', str(kwargs), addr)
+    assert rebuilding.wait(5)
+    # the stream of the snapshot waits for the pre-dumps
+    assert not d.wait_prepared(name, addr[0], 0.1)
+    rebuilt.set()
+    assert d.wait_prepared(name, addr[0], 5)
+    assert not d.wait_prepared(name, '10.0.99.12', 0.1)
@@ -0,0 +1,111 @@
+import time
+import threading
+
+from .. import migrate_engine
+
+def make_engine(**kwargs):
+    events = []
+    reports = []
+    gates = {}
+    def prepare(data):
+        events.append(('prepare', data['name']))
+        gates.setdefault(data['name'], threading.Event()).wait(5)
+    def migrate(data):
+        events.append(('migrate', data['name']))
+        if data.get('fail'):
+            raise RuntimeError('checkpoint failed')
+    engine = migrate_engine.MigrationEngine(
+        {'prepare': prepare, 'migrate': migrate},
+        lambda data: (data['name'], data['ip']), report=reports.append,
+        **kwargs)
+    return engine, events, reports, gates
+
+def wait_for(condition):
+    deadline = time.time() + 5
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+def test_link_limit():
+    engine, events, reports, gates = make_engine(max_per_link=1)
+    for name in ['a', 'b', 'c']:
+        gates[name] = threading.Event()
+    engine.submit('prepare', {'name': 'a', 'ip': '10.0.0.2'})
+    wait_for(lambda: ('prepare', 'a') in events)
+    engine.submit('prepare', {'name': 'b', 'ip': '10.0.0.2'})
+    engine.submit('prepare', {'name': 'c', 'ip': '10.0.0.3'})
+    # c does not wait behind the link of a and b
+    wait_for(lambda: ('prepare', 'c') in events)
+    assert ('prepare', 'b') not in events
+    assert engine.get_stats() == {'running': 2, 'waiting': 1,
+                                  'links': {'10.0.0.2': 1, '10.0.0.3': 1}}
+    # b gets the slot of a at the end of its migration
+    gates['a'].set()
+    engine.submit('migrate', {'name': 'a', 'ip': '10.0.0.2'})
+    wait_for(lambda: ('prepare', 'b') in events)
+    assert events.index(('prepare', 'b')) > events.index(('migrate', 'a'))
+    gates['b'].set()
+    gates['c'].set()
+    engine.submit('migrate', {'name': 'c', 'ip': '10.0.0.3'})
+    # a failed migration releases its slot too
+    engine.submit('migrate', {'name': 'b', 'ip': '10.0.0.2', 'fail': True})
+    wait_for(lambda: len(reports) == 1)
+    stats = reports[0]
+    assert sorted(m['service'] for m in stats['migrations']) == \
+        ['a', 'b', 'c']
+    waits = dict((m['service'], m['queue_wait'])
+                 for m in stats['migrations'])
+    assert waits['b'] > waits['a']
+    assert stats['makespan'] >= waits['b']
+    assert engine.get_stats()['running'] == 0
+    assert engine.migrations == {}
+
+def test_bw_share():
+    engine, _, _, gates = make_engine(max_per_link=2)
+    assert engine.get_bw('10.0.0.2', 100) == 100
+    assert engine.get_bw('10.0.0.2', None) is None
+    for name in ['a', 'b']:
+        engine.submit('prepare', {'name': name, 'ip': '10.0.0.2'})
+    wait_for(lambda: engine.get_stats()['running'] == 2)
+    assert engine.get_bw('10.0.0.2', 100) == 50
+    assert engine.get_migration('a', '10.0.0.2').state == 'running'
+    for name in ['a', 'b']:
+        gates[name].set()
+        engine.submit('migrate', {'name': name, 'ip': '10.0.0.2'})
+    wait_for(lambda: engine.get_stats()['running'] == 0)
+    assert engine.get_bw('10.0.0.2', 100) == 100
+
+def test_slot_release():
+    engine, events, _, gates = make_engine(max_per_link=2, idle_timeout=0.5)
+    for name in ['a', 'b']:
+        gates[name] = threading.Event()
+        gates[name].set()
+    # pre-migrations never followed by their migrate
+    engine.submit('prepare', {'name': 'a', 'ip': '10.0.0.2'})
+    engine.submit('prepare', {'name': 'b', 'ip': '10.0.0.2'})
+    wait_for(lambda: engine.workers == 0)
+    assert engine.get_stats()['links'] == {'10.0.0.2': 2}
+    # a is re-planned to another destination, b is prepared again
+    engine.submit('prepare', {'name': 'a', 'ip': '10.0.0.3'})
+    engine.submit('prepare', {'name': 'b', 'ip': '10.0.0.2'})
+    wait_for(lambda: events.count(('prepare', 'b')) == 2 and
+             engine.workers == 0)
+    assert engine.get_stats()['links'] == {'10.0.0.2': 1, '10.0.0.3': 1}
+    assert engine.cancel('a')
+    assert engine.get_stats()['links'] == {'10.0.0.2': 1}
+    # the slot of b is released once idle
+    wait_for(lambda: engine.get_stats()['running'] == 0)
+    assert engine.get_migration('b').state == 'expired'
+
+def test_cancel_waiting():
+    engine, events, _, gates = make_engine(max_per_link=1)
+    engine.submit('prepare', {'name': 'a', 'ip': '10.0.0.2'})
+    wait_for(lambda: ('prepare', 'a') in events)
+    engine.submit('prepare', {'name': 'b', 'ip': '10.0.0.2'})
+    wait_for(lambda: engine.get_stats()['waiting'] == 1)
+    engine.cancel('b')
+    wait_for(lambda: engine.get_stats()['waiting'] == 0)
+    assert ('prepare', 'b') not in events
+    gates['a'].set()
+    engine.submit('migrate', {'name': 'a', 'ip': '10.0.0.2'})
+    wait_for(lambda: engine.get_stats()['running'] == 0)
@@ -100,7 +100,6 @@ class TestMigrateSource(object):
 
     def test_handle_cmd_migrate(self, source):
         source.controller = mock.Mock()
-        source.sock = mock.Mock()
         source.controller.docker_checkpoint.return_value = (None, 0)
         service=Constants.OPENFACE
         tmp_dir = '/{}/{}'.format('tmp', '{}{}'.format(service,
@@ -116,6 +115,9 @@ class TestMigrateSource(object):
                   'container_img' : Constants.OPENFACE_DOCKER_IMAGE,
                   'container_port' : 9999,
                   'method' : 'delta'}
+        migration = source.get_migration(migrate_source.MigrateNode(**kwargs))
+        migration.sock = mock.Mock()
+        source.send_command = mock.Mock()
         source.handle_cmd_migrate(kwargs)
         source.controller.docker_checkpoint.assert_called_with(
             '{}{}'.format(Constants.OPENFACE, TestMigrateSource.USER), 'snapshot',
@@ -126,5 +128,84 @@ class TestMigrateSource(object):
                       exclude="*.img", wait=False),
             mock.call('{}/snapshot_delta/'.format(tmp_dir), 'root',
                       TestMigrateSource.IP, tmp_dir)])
-        source.sock.sendto.assert_called()
-        source.sock.close.assert_called()
+        assert source.send_command.call_args[0][2] == 'migrate'
+        migration.sock.close.assert_called()
+
+    def test_handle_cmd_stage(self, source):
+        source.controller = mock.Mock()
+        source.sender = mock.Mock()
+        source.sender.send.return_value = {'size_sent': 100}
+        service=Constants.OPENFACE
+        tmp_dir = '/{}/{}'.format('tmp', '{}{}'.format(service,
+                                                       TestMigrateSource.USER))
+        kwargs = {'service_name': service,
+                  'end_user': TestMigrateSource.USER,
+                  'ip' : TestMigrateSource.IP,
+                  'server_name' : TestMigrateSource.SERVER_NAME,
+                  'port' : 9900,
+                  'container_img' : Constants.OPENFACE_DOCKER_IMAGE,
+                  'container_port' : 9999,
+                  'method' : 'delta'}
+        # only the pre-dump of the stream method is deduplicated
+        source.handle_cmd_stage(kwargs)
+        source.controller.docker_checkpoint.assert_not_called()
+        kwargs['method'] = 'stream'
+        source.handle_cmd_stage(kwargs)
+        source.controller.docker_checkpoint.assert_called_with(
+            '{}{}'.format(Constants.OPENFACE, TestMigrateSource.USER),
+            'snapshot_stage', tmp_dir)
+        args, kwargs = source.sender.send.call_args
+        assert args[2] == '{}/snapshot_stage/'.format(tmp_dir)
+        assert kwargs['target'] == migrate_source.STAGE
+
+def test_pre_copy_policy():
+    policy = migrate_source.PreCopyPolicy(downtime_target=1.0,
+                                          max_pre_dumps=6)
+    stats = {'size': 10*10**6, 'checkpoint': 0.2, 'diff': 0.1,
+             'transfer': 2.0}
+    # 10 MB over 100 Mbps
+    assert policy.predict(stats, 100) == pytest.approx(1.1)
+    # measured throughput without the BW of the link
+    assert policy.predict(stats) == pytest.approx(2.3)
+    assert policy.next_round(3, stats, bw=100)
+    assert not policy.next_round(3, stats, bw=1000)
+    assert not policy.next_round(6, stats, bw=100)
+    # the delta does not shrink any more
+    assert not policy.next_round(4, stats, dict(stats, size=10.5*10**6),
+                                 bw=100)
+
+def test_pre_copy_rounds():
+    source = mock.Mock()
+    source.policy = migrate_source.PreCopyPolicy(downtime_target=0.35)
+    source.pre_dumps = {}
+    rounds = [{'size': size, 'checkpoint': 0.1, 'diff': 0.1, 'transfer': 0}
+              for size in [4*10**6, 2*10**6, 10**6]]
+    source.pre_copy_round.side_effect = rounds[1:]
+    service = migrate_source.MigrateNode(end_user='u1', bw=80)
+    record = migrate_source.MigrateRecord()
+    migrate_source.MigrateSource.pre_copy.__func__(source, service, record,
+                                                   rounds[0])
+    # 0.2s + 1 MB over 80 Mbps is under the target after pre5
+    assert [c[0][1] for c in source.pre_copy_round.call_args_list] == [4, 5]
+    assert service.pre_dumps == 5
+    assert source.pre_dumps[service.get_container_name()] == 5
+    assert record.rounds == 4
+    assert record.predicted_downtime == pytest.approx(0.3)
+
+def test_stream_pre_dump_fallback():
+    source = mock.Mock()
+    source.sender.send.side_effect = IOError('reset')
+    source.controller.transfer.return_value = (None, 0)
+    service = migrate_source.MigrateNode(service_name='openface',
+        end_user='u1', ip='10.0.99.10', method='stream')
+    stream = migrate_source.MigrateSource.stream_pre_dump.__func__(source,
+        service, migrate_source.MigrateRecord())
+    assert stream.wait() == 0
+    source.controller.transfer.assert_called_once_with(
+        '/tmp/openfaceu1/snapshot_pre2/', 'root', '10.0.99.10',
+        '/tmp/openfaceu1')
+    # the pre-dump is lost if the copy fails too
+    source.controller.transfer.return_value = (None, 1)
+    stream = migrate_source.MigrateSource.stream_pre_dump.__func__(source,
+        service, migrate_source.MigrateRecord())
+    assert stream.wait() == 1
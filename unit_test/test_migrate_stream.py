@@ -0,0 +1,235 @@
+import os
+import socket
+import threading
+import hashlib
+
+import pytest
+
+from .. import migrate_stream
+from .. migrate_node import MigrateNode
+from .. chunk_store import ChunkStore
+
+def xor_diff(old, new, patch, filename, verbose):
+    with open(old + filename, 'rb') as f_old, open(new + filename, 'rb') as f:
+        data = bytearray(a ^ b for a, b in zip(bytearray(f_old.read()),
+                                               bytearray(f.read())))
+    with open(patch + filename, 'wb') as f:
+        f.write(data)
+
+def xor_patch(old, new, patch, filename, verbose):
+    xor_diff(old, patch, new, filename, verbose)
+
+def write_files(folder, files):
+    os.makedirs(folder)
+    for name, data in files.items():
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(data)
+
+def test_stream_folder(tmpdir):
+    old = {'pages-1.img': os.urandom(4096), 'core-1.img': b'\x01' * 512}
+    new = {'pages-1.img': old['pages-1.img'][:4000] + b'\x00' * 96,
+           'core-1.img': b'\x02' * 512,
+           'rootfs-diff.tar.gz.img': os.urandom(100),
+           'descriptors.json': b'{}'}
+    src = MigrateNode(dump_dir=str(tmpdir.join('src')), end_user='u1')
+    dst = MigrateNode(dump_dir=str(tmpdir.join('dst')), end_user='u1')
+    write_files(src.get_snapshot_pre(3), old)
+    write_files(src.get_snapshot_folder(), new)
+    write_files(dst.get_snapshot_pre(3), old)
+    receiver = migrate_stream.StreamReceiver(port=0, patch=xor_patch,
+                                             workers=2)
+    receiver.start()
+    sender = migrate_stream.StreamSender(diff=xor_diff, workers=2)
+    sock = socket.create_connection(('127.0.0.1', receiver.port))
+    stats = sender.send_folder(sock, dst.get_migrate_service(),
+                               src.get_snapshot_pre(3),
+                               src.get_snapshot_folder(),
+                               src.get_snapshot_delta())
+    sock.close()
+    assert stats['files'] == 4
+    # patches of nearly identical files compress well
+    assert stats['size_sent'] < sum(len(v) for v in new.values())
+    assert stats['dest']['files'] == 4
+    assert receiver.wait(dst.get_container_name(), 1) is not None
+    for name, data in new.items():
+        with open(os.path.join(dst.get_snapshot_folder(), name), 'rb') as f:
+            assert f.read() == data
+    assert sorted(os.listdir(dst.get_snapshot_delta())) == \
+        ['core-1.img', 'pages-1.img']
+    receiver.stop()
+
+def test_truncated_stream(tmpdir):
+    receiver = migrate_stream.StreamReceiver(port=0)
+    receiver.start()
+    dst = MigrateNode(dump_dir=str(tmpdir), end_user='u2')
+    sock = socket.create_connection(('127.0.0.1', receiver.port))
+    migrate_stream.send_frame(sock, migrate_stream.BEGIN, '',
+                              '{{"dump_dir": "{}", "end_user": "u2"}}'.
+                              format(str(tmpdir)))
+    migrate_stream.send_frame(sock, migrate_stream.FILE, 'a.json', b'{}')
+    sock.close()
+    assert receiver.wait(dst.get_container_name(), 0.5) is None
+    receiver.stop()
+
+def test_dedup_pre_dump(tmpdir):
+    page = migrate_stream.PAGE_SIZE
+    pages = [os.urandom(page) for _ in range(8)]
+    # repeated and zero pages, and a short last page
+    data = b''.join(pages) + pages[0] + b'\x00' * 2 * page + b'\x01' * 10
+    src = MigrateNode(dump_dir=str(tmpdir.join('src')), end_user='u3')
+    dst = MigrateNode(dump_dir=str(tmpdir.join('dst')), end_user='u3')
+    write_files(src.get_snapshot_pre(2), {'pages-1.img': data,
+                                          'core-1.img': b'core'})
+    store = ChunkStore(str(tmpdir.join('store')))
+    store.put(hashlib.sha1(pages[1]).digest(), pages[1])
+    receiver = migrate_stream.StreamReceiver(port=0, store=store)
+    receiver.start()
+    sender = migrate_stream.StreamSender(dedup=True)
+    service = dst.get_migrate_service()
+    service[migrate_stream.TARGET] = migrate_stream.PRE_DUMP
+    ratios = []
+    for _ in range(2):
+        sock = socket.create_connection(('127.0.0.1', receiver.port))
+        stats = sender.send_folder(sock, service, None,
+                                   src.get_snapshot_pre(2), None)
+        sock.close()
+        with open(os.path.join(dst.get_snapshot_pre(2), 'pages-1.img'),
+                  'rb') as f:
+            assert f.read() == data
+        ratios.append(stats['dest']['dedup'])
+    assert (ratios[0]['chunks'], ratios[0]['hits'], ratios[0]['sent']) == \
+        (12, 1, 9)
+    assert ratios[1]['hit_ratio'] == 1
+    assert len(store) == 10
+    # pre-dumps are not waited for
+    assert receiver.wait(dst.get_container_name(), 0.1) is None
+    receiver.stop()
+
+def test_staged_snapshot(tmpdir):
+    page = migrate_stream.PAGE_SIZE
+    pages = [os.urandom(page) for _ in range(8)]
+    src = MigrateNode(dump_dir=str(tmpdir.join('src')), end_user='u4')
+    dst = MigrateNode(dump_dir=str(tmpdir.join('dst')), end_user='u4')
+    write_files(src.get_snapshot_stage(), {'pages-1.img': b''.join(pages),
+                                           'core-1.img': b'core'})
+    # one page is dirtied between the staging and the pre-dump
+    pages[3] = os.urandom(page)
+    write_files(src.get_snapshot_pre(2), {'pages-1.img': b''.join(pages),
+                                          'core-1.img': b'core'})
+    write_files(dst.get_snapshot_delta(), {'pages-1.img': b'delta'})
+    store = ChunkStore(str(tmpdir.join('store')))
+    receiver = migrate_stream.StreamReceiver(port=0, store=store)
+    receiver.start()
+    sender = migrate_stream.StreamSender(dedup=True)
+    for folder, target in [(src.get_snapshot_stage(), migrate_stream.STAGE),
+                           (src.get_snapshot_pre(2), migrate_stream.PRE_DUMP)]:
+        service = dst.get_migrate_service()
+        service[migrate_stream.TARGET] = target
+        sock = socket.create_connection(('127.0.0.1', receiver.port))
+        stats = sender.send_folder(sock, service, None, folder, None)
+        sock.close()
+        if target == migrate_stream.STAGE:
+            # the staged folder is removed, the delta of a migration of
+            # the container is kept
+            assert not os.path.exists(dst.get_snapshot_stage())
+            assert os.listdir(dst.get_snapshot_delta()) == ['pages-1.img']
+    # the pre-dump only sent the dirty page
+    assert stats['dest']['dedup']['sent'] == 1
+    with open(os.path.join(dst.get_snapshot_pre(2), 'pages-1.img'),
+              'rb') as f:
+        assert f.read() == b''.join(pages)
+    receiver.stop()
+
+def test_stream_confined(tmpdir):
+    root = tmpdir.mkdir('dump')
+    receiver = migrate_stream.StreamReceiver(port=0, root=str(root))
+    receiver.start()
+    for dump_dir, filename in [(str(tmpdir), 'core-1.img'),
+                               (str(root), '../evil'),
+                               (str(root), '/tmp/evil')]:
+        sock = socket.create_connection(('127.0.0.1', receiver.port))
+        # the receiver drops the connection without acknowledging
+        try:
+            migrate_stream.send_frame(sock, migrate_stream.BEGIN, '',
+                '{{"dump_dir": "{}", "end_user": "u5"}}'.format(dump_dir))
+            migrate_stream.send_frame(sock, migrate_stream.FILE, filename,
+                                      b'x')
+            migrate_stream.send_frame(sock, migrate_stream.END, '',
+                                      '{"files": 1}')
+            assert sock.recv(1) == b''
+        except socket.error:
+            pass
+        sock.close()
+    # the folders outside the root are left alone
+    assert sorted(os.listdir(str(tmpdir))) == ['dump']
+    snapshot = MigrateNode(dump_dir=str(root), end_user='u5').\
+        get_snapshot_folder()
+    assert os.listdir(snapshot) == []
+    assert not os.path.exists(os.path.join(os.path.dirname(
+        snapshot.rstrip('/')), 'evil'))
+    receiver.stop()
+
+def test_stream_waits_prepare(tmpdir):
+    old = {'pages-1.img': os.urandom(4096)}
+    new = {'pages-1.img': os.urandom(4096)}
+    src = MigrateNode(dump_dir=str(tmpdir.join('src')), end_user='u6')
+    dst = MigrateNode(dump_dir=str(tmpdir.join('dst')), end_user='u6')
+    write_files(src.get_snapshot_pre(3), old)
+    write_files(src.get_snapshot_folder(), new)
+    prepared = threading.Event()
+    def ready(name, link):
+        assert (name, link) == (dst.get_container_name(), '127.0.0.1')
+        # the prepare rebuilds the last pre-dump meanwhile
+        write_files(dst.get_snapshot_pre(3), old)
+        prepared.set()
+        return True
+    receiver = migrate_stream.StreamReceiver(port=0, patch=xor_patch,
+        workers=2, root=str(tmpdir), ready=ready)
+    receiver.start()
+    sender = migrate_stream.StreamSender(diff=xor_diff, workers=2)
+    sock = socket.create_connection(('127.0.0.1', receiver.port))
+    stats = sender.send_folder(sock, dst.get_migrate_service(),
+                               src.get_snapshot_pre(3),
+                               src.get_snapshot_folder(),
+                               src.get_snapshot_delta())
+    sock.close()
+    assert prepared.is_set()
+    assert 'ready' in stats['dest']
+    with open(os.path.join(dst.get_snapshot_folder(), 'pages-1.img'),
+              'rb') as f:
+        assert f.read() == new['pages-1.img']
+    # the deltas are not patched if the prepare failed
+    receiver.ready = lambda name, link: False
+    sock = socket.create_connection(('127.0.0.1', receiver.port))
+    with pytest.raises(Exception):
+        sender.send_folder(sock, dst.get_migrate_service(),
+                           src.get_snapshot_pre(3),
+                           src.get_snapshot_folder(),
+                           src.get_snapshot_delta())
+    sock.close()
+    receiver.stop()
+
+def test_stream_parts(tmpdir, monkeypatch):
+    page = migrate_stream.PAGE_SIZE
+    monkeypatch.setattr(migrate_stream, 'PART_SIZE', 2 * page)
+    monkeypatch.setattr(migrate_stream, 'PART_CHUNKS', 2)
+    pages = [os.urandom(page) for _ in range(5)]
+    files = {'pages-1.img': b''.join(pages) + b'\x01' * 10,
+             'core-1.img': os.urandom(5 * page), 'empty.img': b''}
+    src = MigrateNode(dump_dir=str(tmpdir.join('src')), end_user='u6')
+    dst = MigrateNode(dump_dir=str(tmpdir.join('dst')), end_user='u6')
+    write_files(src.get_snapshot_pre(2), files)
+    receiver = migrate_stream.StreamReceiver(port=0)
+    receiver.start()
+    sender = migrate_stream.StreamSender(dedup=True, workers=2)
+    service = dst.get_migrate_service()
+    service[migrate_stream.TARGET] = migrate_stream.PRE_DUMP
+    sock = socket.create_connection(('127.0.0.1', receiver.port))
+    stats = sender.send_folder(sock, service, None,
+                               src.get_snapshot_pre(2), None)
+    sock.close()
+    assert stats['dest']['files'] == 3
+    for name, data in files.items():
+        with open(os.path.join(dst.get_snapshot_pre(2), name), 'rb') as f:
+            assert f.read() == data
+    receiver.stop()
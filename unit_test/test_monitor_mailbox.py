@@ -0,0 +1,52 @@
+import threading
+
+import pytest
+
+from .. monitor_mailbox import LatestValueMailbox, MERGE, DROP
+
+class BlockedHandler(object):
+    """Records the samples, the first call blocks until released."""
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.done = threading.Event()
+
+    def __call__(self, key, samples):
+        self.calls.append((key, samples))
+        self.release.wait(2)
+        if key == 'last':
+            self.done.set()
+
+@pytest.mark.parametrize('policy', [MERGE, DROP])
+def test_coalesce(policy):
+    handler = BlockedHandler()
+    mailbox = LatestValueMailbox(handler, policy, max_samples=4)
+    mailbox.start()
+    mailbox.put('u1', [0])
+    # u1 is being processed, its next samples are coalesced
+    while not handler.calls:
+        pass
+    for i in range(1, 7):
+        mailbox.put('u1', [i])
+    mailbox.put('u2', [10, 11])
+    mailbox.put('last', [None])
+    handler.release.set()
+    assert handler.done.wait(2)
+    stats = mailbox.get_stats()
+    if policy == MERGE:
+        assert handler.calls[1] == ('u1', [3, 4, 5, 6])
+        assert (stats['merged'], stats['dropped']) == (3, 2)
+    else:
+        assert handler.calls[1] == ('u1', [6])
+        assert (stats['merged'], stats['dropped']) == (0, 5)
+    # users are served in the order their slot was filled
+    assert [key for key, _ in handler.calls] == ['u1', 'u1', 'u2', 'last']
+    assert handler.calls[2] == ('u2', [10, 11])
+    assert (stats['received'], stats['processed']) == (10, 4)
+    mailbox.stop()
+    mailbox.join(1)
+    assert not mailbox.is_alive()
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        LatestValueMailbox(None, 'latest')
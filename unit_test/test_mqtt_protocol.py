@@ -1,6 +1,7 @@
 import pytest
 import time
-from ..mqtt_protocol import MqttClient
+import yaml
+from ..mqtt_protocol import MqttClient, PayloadDecoder, PayloadError, STRING
 
 t1 = 'testMqttTopic1'
 t2 = 'testMqttTopic2'
@@ -56,3 +57,31 @@ def test_mqtt_protocol(select_server):
     time.sleep(0.5)
     assert mqttClient.test1 == True
     assert mqttClient.test2 == True
+
+def test_decode_payload():
+    decoder = PayloadDecoder()
+    schema = {'end_user': STRING, 'nearbyAP': list}
+    msg = decoder.decode('{"end_user": "u1", "nearbyAP": [{"SSID": "e1"}]}',
+                         'monitor/eu/+', schema)
+    assert msg == {'end_user': 'u1', 'nearbyAP': [{'SSID': 'e1'}]}
+    assert type(msg['end_user']) is str
+    # Legacy producers publish '{}'.format(dict)
+    msg = decoder.decode("{'end_user': 'u1', 'nearbyAP': [], 'debug': True}",
+                         'monitor/eu/+', schema)
+    assert msg['debug'] is True
+    assert decoder.decode('', 'monitor/eu/+') is None
+    with pytest.raises(PayloadError):
+        decoder.decode('{"end_user": "u1"}', 'monitor/eu/+', schema)
+    with pytest.raises(yaml.YAMLError):
+        decoder.decode('{"end_user": 1, "nearbyAP": []}', 'monitor/eu/+',
+                       schema)
+    with pytest.raises(yaml.YAMLError):
+        decoder.decode('{a: [}', 'other')
+    stats = decoder.get_stats()
+    assert stats['monitor/eu/+']['count'] == 5
+    assert stats['monitor/eu/+']['json'] == 2
+    assert stats['monitor/eu/+']['yaml'] == 1
+    assert stats['monitor/eu/+']['errors'] == 2
+    assert stats['other']['errors'] == 1
+    decoder.reset()
+    assert decoder.get_stats() == {}
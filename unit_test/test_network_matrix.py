@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from .. network_matrix import NetworkMatrix
+
+def test_windowed_mean():
+    matrix = NetworkMatrix(window=10, capacity=1)
+    for i in range(20):
+        matrix.update('source', 'dest', 2*i, i)
+    names, bw, rtt = matrix.get_matrices()
+    assert names == ['source', 'dest']
+    assert bw[0, 1] == 14.5
+    assert rtt[0, 1] == 29
+    assert np.isnan(bw[1, 0])
+    with pytest.raises(ValueError):
+        bw[0, 1] = 0
+
+def test_partial_window_and_skip():
+    matrix = NetworkMatrix(window=10)
+    matrix.update('a', 'b', 10.0, 100)
+    matrix.update('a', 'b', 20.0, None)
+    matrix.update('a', None, 20.0, 50)
+    matrix.update('a', 'b', 20.0, 200)
+    names, bw, rtt = matrix.get_matrices()
+    assert bw[0, 1] == 150
+    assert rtt[0, 1] == 15
+
+def test_bts_matrices():
+    matrix = NetworkMatrix()
+    matrix.update('s1', 's2', 10.0, 100)
+    matrix.update('s1', 'cloud', 7.0, 200)
+    bts, servers, bw, rtt = matrix.get_bts_matrices(
+        [('b1', 's1'), ('b2', 's2'), ('b3', None)], ['cloud', 's1', 's2'])
+    assert bts == ['b1', 'b2', 'b3']
+    assert list(bw[0]) == [200, 1e9, 100]
+    assert list(rtt[0]) == [7.0, 0, 10.0]
+    assert rtt[1, 2] == 0
+    assert np.isnan(rtt[1, 0])
+    assert np.isnan(bw[2]).all()
+
+def test_copy():
+    matrix = NetworkMatrix()
+    matrix.update('a', 'b', 10.0, 100)
+    other = matrix.copy()
+    matrix.update('a', 'b', 30.0, 300)
+    assert other.get_matrices()[1][0, 1] == 100
+    assert matrix.get_matrices()[1][0, 1] == 200
@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+from .. import page_diff
+from .. diff_patch import create_xdelta_diff, create_xdelta_patch
+
+PAGE = page_diff.PAGE_SIZE
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+@pytest.mark.parametrize('new_size', [10*PAGE, 12*PAGE + 100, 7*PAGE + 1, 0])
+def test_round_trip(tmpdir, new_size):
+    old = os.urandom(10*PAGE)
+    new = bytearray(old[:new_size].ljust(new_size, b'\x00'))
+    for page in [1, 2, 5]:
+        if page*PAGE < min(new_size, 7*PAGE):
+            new[page*PAGE + 10] ^= 0xff
+    new = bytes(new)
+    paths = [str(tmpdir.join(name)) for name in ['old', 'new', 'patch',
+                                                 'out']]
+    write(paths[0], old)
+    write(paths[1], new)
+    count = page_diff.diff_file(*paths[:3])
+    assert page_diff.is_page_patch(paths[2])
+    if new_size == 10*PAGE:
+        assert count == 3
+        assert os.path.getsize(paths[2]) < 4*PAGE
+    page_diff.patch_file(paths[0], paths[3], paths[2])
+    assert read(paths[3]) == new
+
+def test_folder(tmpdir):
+    old, new, patch = [str(tmpdir.mkdir(name)) + '/'
+                       for name in ['old', 'new', 'patch']]
+    data = os.urandom(64*PAGE)
+    write(old + 'pages-1.img', data)
+    write(new + 'pages-1.img', data[:PAGE] + os.urandom(PAGE) + data[2*PAGE:])
+    # new pages image, without pre-dump
+    write(new + 'pages-2.img', os.urandom(PAGE))
+    create_xdelta_diff(old, new, patch, False, pages=True)
+    assert os.path.getsize(patch + 'pages-1.img') < 2*PAGE
+    out = str(tmpdir.mkdir('out')) + '/'
+    create_xdelta_patch(old, out, patch, False)
+    for name in ['pages-1.img', 'pages-2.img']:
+        assert read(out + name) == read(new + name)
+
+def test_index(tmpdir):
+    index = page_diff.PageIndex()
+    paths = [str(tmpdir.join(name)) for name in
+             ['pre1', 'pre2', 'pre3', 'patch', 'out']]
+    data = bytearray(os.urandom(64*PAGE + 100))
+    write(paths[0], bytes(data))
+    for path, page in [(paths[1], 3), (paths[2], 40)]:
+        data[page*PAGE + 7] ^= 0x01
+        write(path, bytes(data))
+    page_diff.diff_file(paths[0], paths[1], paths[3], index=index)
+    assert index.get_stats()['read'] == 2*len(data)
+    # pre2 is indexed, only pre3 is read
+    count = page_diff.diff_file(paths[1], paths[2], paths[3], index=index)
+    stats = index.get_stats()
+    assert stats['read'] == 3*len(data)
+    assert stats['hits'] == 1
+    # changed page and partial last page
+    assert count == 2
+    page_diff.patch_file(paths[1], paths[4], paths[3])
+    assert read(paths[4]) == bytes(data)
+    # a rewritten image is not trusted
+    write(paths[2], os.urandom(10*PAGE))
+    page_diff.diff_file(paths[2], paths[1], paths[3], index=index)
+    assert index.get_stats()['misses'] == 2
+    page_diff.patch_file(paths[2], paths[4], paths[3])
+    assert read(paths[4]) == read(paths[1])
+
+def test_index_sign_bits(tmpdir):
+    index = page_diff.PageIndex()
+    paths = [str(tmpdir.join(name)) for name in
+             ['pre1', 'pre2', 'pre3', 'patch', 'out']]
+    data = bytearray(os.urandom(8*PAGE))
+    write(paths[0], bytes(data))
+    write(paths[1], bytes(data))
+    # flips the sign bit of two words, which cancel in a linear hash
+    for offset in [2*PAGE + 7, 2*PAGE + 15]:
+        data[offset] ^= 0x80
+    write(paths[2], bytes(data))
+    page_diff.diff_file(paths[0], paths[1], paths[3], index=index)
+    count = page_diff.diff_file(paths[1], paths[2], paths[3], index=index)
+    assert index.get_stats()['hits'] == 1
+    assert count == 1
+    page_diff.patch_file(paths[1], paths[4], paths[3])
+    assert read(paths[4]) == bytes(data)
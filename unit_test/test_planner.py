@@ -2,6 +2,7 @@ from __future__ import division
 
 import os
 import time
+import threading
 
 import mock
 import pytest
@@ -68,5 +69,125 @@ def test_random_planner(edgestats):
         assert i.next_server in ['docker1', 'docker2', 'docker3']
         assert i.next_bts in ['edge01', 'edge02', 'edge03']
 
+def test_planning_round_snapshot(edgestats, database):
+    rssi_planner = planner.RSSIPlanner(stats=edgestats)
+    random_planner = planner.RandomPlanner(stats=edgestats)
+    live = edgestats.db
+    count = live.session.query(db.RSSIMonitor).count()
+    with edgestats.planning_round() as snap:
+        assert edgestats.db is snap
+        # A late RSSI report does not change the inputs of the round
+        database.insert_obj(db.RSSIMonitor(timestamp=db.get_time(),
+            user_id='test', bts='edge01', rssi=-30))
+        database.session.commit()
+        assert snap.session.query(db.RSSIMonitor).count() == count
+        res = rssi_planner.compute_plan()[0]
+        assert res.next_bts == 'edge03'
+        with edgestats.planning_round() as nested:
+            assert nested is snap
+            random_planner.compute_plan()
+        assert edgestats.db is snap
+        # The other threads keep the live database
+        seen = []
+        th = threading.Thread(target=lambda: seen.append(edgestats.db))
+        th.start()
+        th.join()
+        assert seen == [live]
+        assert snap.rssi_history == live.rssi_history
+        assert snap.rssi_history is not live.rssi_history
+    assert edgestats.db is live
+    assert live.session.query(db.RSSIMonitor).count() == count + 1
+
+def test_link_matrices(edgestats):
+    # the matrices are kept by the DBCentral of the stats
+    edgestats.live_db.update_network_monitor('docker1', 'docker2', 5.0, 80)
+    edgestats.live_db.session.commit()
+    with edgestats.planning_round():
+        bw, rtt = edgestats.get_edge_matrices()
+        # built once per round
+        assert edgestats.get_edge_matrices() == (bw, rtt)
+        assert bw.get('docker1', 'docker2') == 80
+        assert bw.get('docker2', 'docker1') is None
+        assert rtt.get('docker1', 'unknown') is None
+        assert edgestats.get_RTT('docker1', 'docker2') == 5.0
+    assert edgestats.get_edge_matrices()[0] is not bw
+
+def test_topology_cache(database):
+    assert database.get_server_ip('docker1') == '10.0.99.10'
+    assert database.get_server_ip('docker1') == '10.0.99.10'
+    assert database.get_server_name_from_ip('10.0.99.11') == 'docker2'
+    assert database.get_bts('edge01') is database.get_bts_info('edge01', '')
+    assert database.is_associated_bts('edge03')
+    assert not database.is_associated_bts('edge04')
+    stats = database.get_topology_stats()
+    assert stats['server_ip']['hit_rate'] >= 0.5
+    assert stats['bts']['hits'] >= 1
+    assert stats['bts_names']['hits'] >= 1
+    database.register_server(name='docker4', ip='10.0.99.13', bs='edge04')
+    assert database.is_associated_bts('edge04')
+    assert database.get_server_ip('docker4') == '10.0.99.13'
+    database.remove_server('docker4')
+    assert database.get_server_ip('docker4') is None
+    assert database.get_topology_stats()['invalidations'] >= 2
+
+def test_topology_cache_no_reload(database):
+    bts = database.get_bts('edge01')
+    server = database.get_server('docker1')
+    database.insert_obj(db.RSSIMonitor(timestamp=db.get_time(),
+        user_id='walker', bts='edge01', rssi=-60))
+    database.session.commit()
+    statements = []
+    def count(*args):
+        statements.append(args[2])
+    sqlalchemy.event.listen(database.engine, 'before_cursor_execute', count)
+    try:
+        assert database.get_bts('edge01') is bts
+        assert bts.name == 'edge01' and bts.x is not None
+        assert database.get_server('docker1').ip == server.ip
+    finally:
+        sqlalchemy.event.remove(database.engine, 'before_cursor_execute',
+                                count)
+    assert statements == []
+
+@pytest.fixture
+def line_database(tmpdir):
+    """BTSs edge01 to edge03 on a line, 1 km apart, and edge04."""
+    d = db.DBCentral(database=str(tmpdir.join('line.db')))
+    for i, x in enumerate([0, 1000, 2000]):
+        d.register_server(name='docker{}'.format(i + 1),
+                          ip='10.0.99.{}'.format(10 + i),
+                          bs='edge0{}'.format(i + 1), bs_x=x)
+    d.register_bts(name='edge04')
+    yield d
+    d.close()
+
+def test_query_estimated_neighbors(line_database):
+    database = line_database
+    database.register_user(name='walker', bts='edge02')
+    # Walks from edge02 toward edge01 at 100 m/s
+    database.update_eu_position('walker', 990, 0, -100, 0, 0, 0)
+    for bts, rssi in [('edge01', -95), ('edge02', -55), ('edge03', -99),
+                      ('edge04', -70)]:
+        database.insert_obj(db.RSSIMonitor(timestamp=db.get_time(),
+            user_id='walker', bts=bts, rssi=rssi))
+    database.session.commit()
+    res = database.query_estimated_neighbors(['walker', 'nobody'], 9.8)
+    assert sorted(res['walker']) == ['edge01', 'edge02', 'edge04']
+    assert res['nobody'] == []
+    assert database.query_estimated_neighbor('walker',
+        Constants.RSSI_MINIMUM, 0) == database.query_estimated_neighbors(
+            ['walker'], 0)['walker']
+    assert 'edge01' not in database.query_estimated_neighbor('walker',
+        Constants.RSSI_MINIMUM, 0)
+    # a user without a position is judged on the measured RSSI only
+    database.register_user(name='lost', bts='edge01')
+    for bts, rssi in [('edge01', -60), ('edge02', -95)]:
+        database.insert_obj(db.RSSIMonitor(timestamp=db.get_time(),
+            user_id='lost', bts=bts, rssi=rssi))
+    database.session.commit()
+    assert database.get_user('lost').x is None
+    assert database.query_estimated_neighbors(['lost'], 9.8) == \
+        {'lost': ['edge01']}
+
 def test_rssi_to_bw():
     assert 150 == stats_edge.wifi_rssi_to_bw(-30)
@@ -252,3 +252,19 @@ class TestApp(object):
                       }))
         app.process_migrated(client, userdata, msg)
         assert app.state == simulation.EU_STATE.NORMAL
+
+def test_report_batcher():
+    batches = []
+    batcher = simulation.ReportBatcher(batches.append, max_size=3,
+                                       max_delay=0.1)
+    for i in range(4):
+        batcher.add({Constants.END_USER: 'user1', 'level': i})
+    assert len(batches) == 1
+    assert [r['level'] for r in batches[0]] == [0, 1, 2]
+    assert all(Constants.END_USER not in r and Constants.BATCH_TIME in r
+               for r in batches[0])
+    # the last report is flushed after max_delay
+    time.sleep(0.3)
+    assert [r['level'] for r in batches[1]] == [3]
+    batcher.flush()
+    assert (batcher.batches, batcher.count) == (2, 4)
@@ -0,0 +1,82 @@
+import collections
+
+import pytest
+
+from .. import snapshot_staging
+
+Neighbor = collections.namedtuple('Neighbor', ['bts'])
+BTS = collections.namedtuple('BTS', ['name', 'server_id'])
+
+class FakeDb(object):
+    def __init__(self):
+        self.handover = {'ap1': 3, 'ap2': 10, 'ap3': 20, 'ap4': 2,
+                         'ap5': 500}
+        self.servers = {'ap0': 'edge0', 'ap1': 'edge1', 'ap2': 'edge2',
+                        'ap3': 'edge2', 'ap4': 'edge0', 'ap5': 'edge5'}
+
+    def query_cur_assign(self, user):
+        return ('ap0', 'edge0')
+
+    def query_neighbor(self, user, timeout):
+        return [Neighbor(b) for b in sorted(self.servers)]
+
+    def get_handover_time(self, user, cur_bts, dst_bts, hys):
+        return self.handover.get(dst_bts, None)
+
+    def get_bts(self, name):
+        return BTS(name, self.servers[name])
+
+def test_rank_destinations():
+    db = FakeDb()
+    # the cells of the current server and those reached after the horizon
+    # are left out, a server is ranked by its first cell
+    assert snapshot_staging.rank_destinations(db, 'u1', 60, 3) == \
+        [('edge1', 3), ('edge2', 10)]
+    assert snapshot_staging.rank_destinations(db, 'u1', 60, 1) == \
+        [('edge1', 3)]
+
+def test_staging_policy():
+    now = [0]
+    size = 10 << 20
+    # 10 Mbps over 60s leaves room for 7 snapshots of 10 MB
+    policy = snapshot_staging.StagingPolicy(top_k=2, ttl=30, budget=10,
+                                            clock=lambda: now[0])
+    candidates = [('edge1', 3), ('edge2', 10), ('edge3', 20)]
+    assert policy.select('u1', 'edge0', size, candidates) == \
+        ['edge1', 'edge2']
+    # staged snapshots are not staged again while they are fresh
+    assert policy.select('u1', 'edge0', size, candidates) == []
+    # a link too slow to stage before the handover is skipped, an unknown
+    # link is not
+    assert policy.select('u2', 'edge0', size, candidates,
+        bw=lambda src, dst: 10 if dst == 'edge1' else None) == ['edge2']
+    assert policy.use('u1', 'edge2')
+    assert not policy.use('u2', 'edge1')
+    stats = policy.get_stats()
+    assert (stats['used'], stats['wasted'], stats['missed']) == (1, 2, 1)
+    assert stats['bytes_used'] == size
+    # the budget of the window is spent
+    assert policy.select('u3', 'edge0', size, candidates) == \
+        ['edge1', 'edge2']
+    assert policy.select('u4', 'edge0', size, candidates) == \
+        ['edge1', 'edge2']
+    assert policy.select('u5', 'edge0', size, candidates) == []
+    assert policy.get_stats()['over_budget'] == 1
+    # the snapshots expire, the budget is back after the window
+    now[0] = 61
+    assert policy.get_stats()['expired'] == 4
+    assert policy.select('u5', 'edge0', size, candidates) == \
+        ['edge1', 'edge2']
+    stats = policy.get_stats()
+    assert stats['live'] == 2
+    assert stats['use_ratio'] == pytest.approx(1 / 7.0)
+
+def test_is_due():
+    now = [100]
+    policy = snapshot_staging.StagingPolicy(interval=5,
+                                            clock=lambda: now[0])
+    assert policy.is_due('u1')
+    assert not policy.is_due('u1')
+    assert policy.is_due('u2')
+    now[0] = 105
+    assert policy.is_due('u1')
@@ -0,0 +1,57 @@
+import os
+import json
+
+import pytest
+
+from .. import central_database as db
+from .. import stats_edge
+from .. sql_profiler import get_fingerprint
+
+DATABASE_NAME = 'unit-test-profiler.db'
+
+@pytest.fixture(scope='module')
+def database():
+    if os.path.isfile(DATABASE_NAME):
+        os.remove(DATABASE_NAME)
+    d = db.DBCentral(database=DATABASE_NAME, profile_sql=True)
+    d.register_server(name='docker1', ip='10.0.99.10', bs='edge01')
+    d.register_server(name='docker2', ip='10.0.99.11', bs='edge02')
+    yield d
+    d.close()
+    os.remove(DATABASE_NAME)
+
+def test_fingerprint():
+    assert get_fingerprint("SELECT a FROM t WHERE x = 'foo' AND y IN "
+                           "(?, ?,  ?) LIMIT 10") == \
+        "SELECT a FROM t WHERE x = ? AND y IN (?) LIMIT ?"
+
+def test_profile_scopes(database, tmpdir):
+    with database.profile_scope('mqtt:monitor/edge/+'):
+        database.update_network_monitor('docker1', 'docker2', 10.0, 100)
+        database.session.commit()
+        database.query_bw('docker1', 'docker2')
+        database.query_bw('docker2', 'docker1')
+    stats = stats_edge.StatsEdgeSql(db_control=database)
+    with stats.planning_round():
+        stats.get_server_names()
+    path = str(tmpdir.join('profile.json'))
+    database.profiler.dump(path)
+    with open(path) as f:
+        profile = json.load(f)
+    scope = profile['scopes']['mqtt:monitor/edge/+']
+    assert scope['callers']['DBCentral.query_bw']['count'] == 2
+    assert scope['callers']['DBCentral.query_bw']['p99'] >= 0
+    assert any(s['count'] == 2 and 'network_monitor' in fp
+               for fp, s in scope['statements'].items())
+    assert 'DBSnapshot.get_server_names' in \
+        profile['scopes']['planner']['callers']
+    database.profiler.reset()
+    assert database.profiler.get_json()['scopes'] == {}
+
+def test_profile_disabled(tmpdir):
+    path = str(tmpdir.join('plain.db'))
+    d = db.DBCentral(database=path)
+    with d.profile_scope('planner'):
+        d.get_server_names()
+    assert d.profiler is None
+    d.close()
@@ -0,0 +1,52 @@
+import time
+import threading
+
+from .. trigger_scheduler import TriggerScheduler
+
+def test_order_and_reschedule():
+    scheduler = TriggerScheduler()
+    scheduler.start()
+    fired = []
+    done = threading.Event()
+    scheduler.schedule(('u1', 'handover'), 0.05, fired.append, ('u1-old',))
+    scheduler.schedule(('u2', 'handover'), 0.02, fired.append, ('u2',))
+    # Rescheduling replaces the pending trigger of u1
+    scheduler.schedule(('u1', 'handover'), 0.04, fired.append, ('u1',))
+    scheduler.schedule(('u3', 'handover'), 0.08, lambda: done.set())
+    assert scheduler.get_stats()['pending'] == 3
+    assert done.wait(2)
+    assert fired == ['u2', 'u1']
+    stats = scheduler.get_stats()
+    assert stats['pending'] == 0
+    assert stats['fired'] == 3
+    assert stats['max_lateness'] >= 0
+    scheduler.stop()
+    scheduler.join(1)
+    assert not scheduler.is_alive()
+
+def test_cancel_user():
+    scheduler = TriggerScheduler()
+    scheduler.start()
+    fired = []
+    threads = threading.active_count()
+    for i in range(50):
+        scheduler.schedule(('u{}'.format(i), 'pre_migrate'), 0.05,
+                           fired.append, (i,))
+    scheduler.schedule(('u1', 'migrate'), 0.05, fired.append, ('m',))
+    assert threading.active_count() == threads
+    assert scheduler.cancel_user('u1') == 2
+    assert scheduler.cancel(('u2', 'pre_migrate'))
+    assert not scheduler.cancel(('u2', 'pre_migrate'))
+    assert scheduler.is_pending(('u3', 'pre_migrate'))
+    time.sleep(0.3)
+    assert sorted(fired) == [i for i in range(50) if i not in (1, 2)]
+    scheduler.stop()
+
+def test_failing_callback():
+    scheduler = TriggerScheduler()
+    scheduler.start()
+    done = threading.Event()
+    scheduler.schedule('bad', 0, lambda: 1/0)
+    scheduler.schedule('good', 0.01, done.set)
+    assert done.wait(2)
+    scheduler.stop()